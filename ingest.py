@@ -0,0 +1,5 @@
+#!/usr/bin/env python3
+from wifiology_node_poc.procedures import ingest_argument_parser, ingest_argparse_args_to_kwargs, run_ingest
+
+if __name__ == "__main__":
+    run_ingest(**ingest_argparse_args_to_kwargs(ingest_argument_parser.parse_args()))
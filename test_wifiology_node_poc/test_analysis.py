@@ -1,6 +1,240 @@
+import copy
 from unittest import TestCase
 from assertpy import assert_that
 
+from scapy.all import raw, Raw
+from scapy.layers.dot11 import RadioTap, Dot11, Dot11Beacon, Dot11Elt, Dot11EltRates, Dot11EltRSN
+from scapy.layers.l2 import LLC, SNAP
+
+from wifiology_node_poc.analysis import CaptureAnalyzer, BeaconCache
+
+AP_MAC = "00:11:22:33:44:55"
+CLIENT_MAC = "66:77:88:99:aa:bb"
+REMOTE_MAC = "de:ad:be:ef:00:01"
+
+
+def radiotap_header(signal=-40, noise=-92, rate=12, flags='FCS'):
+    return RadioTap(
+        present='Flags+Rate+dBm_AntSignal+dBm_AntNoise',
+        Flags=flags, Rate=rate, dBm_AntSignal=signal, dBm_AntNoise=noise
+    )
+
+
+def beacon_frame(timestamp, ssid=b'TestNet', channel=6, dtim_count=0, **radiotap_kwargs):
+    return raw(
+        radiotap_header(**radiotap_kwargs) /
+        Dot11(type=0, subtype=8, addr1='ff:ff:ff:ff:ff:ff', addr2=AP_MAC, addr3=AP_MAC) /
+        Dot11Beacon(timestamp=timestamp, beacon_interval=100, cap='ESS+privacy') /
+        Dot11Elt(ID=0, info=ssid) /
+        Dot11EltRates(rates=[0x82, 0x84, 0x0b]) /
+        Dot11Elt(ID=3, info=bytes([channel])) /
+        Dot11Elt(ID=5, info=bytes([dtim_count, 3, 0, 0])) /
+        Dot11EltRSN()
+    ) + b'\x00' * 4
+
+
+def to_ds_data_frame(payload_length, **radiotap_kwargs):
+    return raw(
+        radiotap_header(**radiotap_kwargs) /
+        Dot11(type=2, subtype=0, FCfield=1, addr1=AP_MAC, addr2=CLIENT_MAC, addr3=REMOTE_MAC) /
+        LLC() / SNAP() / Raw(b'x' * payload_length)
+    ) + b'\x00' * 4
+
+
+def ack_frame(**radiotap_kwargs):
+    return raw(
+        radiotap_header(**radiotap_kwargs) / Dot11(type=1, subtype=13, addr1=CLIENT_MAC)
+    ) + b'\x00' * 4
+
+
+class PcapHeader(object):
+    """
+    Stand-in for a pcap packet header, only carrying the captured and wire lengths.
+    """
+    def __init__(self, caplen, length):
+        self.caplen = caplen
+        self.length = length
+
+    def getcaplen(self):
+        return self.caplen
+
+    def getlen(self):
+        return self.length
+
+
+def truncated(frame, radiotap_length, data_snaplen):
+    kept = frame[:radiotap_length + data_snaplen]
+    return PcapHeader(len(kept), len(frame)), kept
+
+
+def sample_frames():
+    return [
+        beacon_frame(1000),
+        to_ds_data_frame(100, signal=-50, rate=24),
+        ack_frame(),
+        beacon_frame(103424),
+        to_ds_data_frame(20, signal=-60, rate=48),
+    ]
+
 
 class AnalysisUnitTest(TestCase):
-    pass
\ No newline at end of file
+    def analyze(self, frames, channel=6, beacon_cache=None):
+        analyzer = CaptureAnalyzer(channel, beacon_cache=beacon_cache)
+        for frame in frames:
+            analyzer.process_frame(None, frame)
+        return analyzer.results(1.0, 2.0, 1)
+
+    def test_capture_analyzer_counters(self):
+        results = self.analyze(sample_frames())
+
+        measurement = results['measurement']
+        assert_that(measurement.channel).is_equal_to(6)
+        assert_that(measurement.average_noise).is_equal_to(-92)
+        assert_that(measurement.management_frame_count).is_equal_to(2)
+        assert_that(measurement.data_frame_count).is_equal_to(2)
+        assert_that(measurement.extra_data).is_equal_to({'weird_frame_count': 0})
+
+        station_counters = results['station_counters']
+        assert_that(station_counters).contains_key(AP_MAC, CLIENT_MAC, REMOTE_MAC)
+        # LLC + SNAP headers are counted as payload.
+        assert_that(station_counters[CLIENT_MAC].data_throughput_out).is_equal_to(136)
+        assert_that(station_counters[REMOTE_MAC].data_throughput_in).is_equal_to(136)
+        assert_that(station_counters[CLIENT_MAC].data_frame_count).is_equal_to(2)
+        assert_that(station_counters[CLIENT_MAC].ack_frame_count).is_equal_to(1)
+        assert_that(station_counters[CLIENT_MAC].average_power).is_equal_to(-55)
+        assert_that(station_counters[CLIENT_MAC].lowest_rate).is_equal_to(24)
+        assert_that(station_counters[CLIENT_MAC].highest_rate).is_equal_to(48)
+
+    def test_capture_analyzer_service_sets(self):
+        results = self.analyze(sample_frames())
+
+        assert_that(results['service_sets']).is_length(1)
+        service_set = results['service_sets'][0]
+        assert_that(service_set.bssid).is_equal_to(AP_MAC)
+        assert_that(service_set.network_name).is_equal_to(b'TestNet')
+        assert_that(service_set.extra_data).contains_entry({'ssid': 'TestNet'}, {'channel': 6})
+        assert_that(service_set.extra_data['crypto']).is_equal_to(['WPA2'])
+
+        assert_that(results['bssid_infra_macs'][AP_MAC]).is_equal_to({AP_MAC, REMOTE_MAC})
+        assert_that(results['bssid_associated_macs'][AP_MAC]).is_equal_to({CLIENT_MAC})
+        assert_that(results['bssid_to_power_map'][AP_MAC]).is_equal_to([-40, -40])
+        # The two beacons are 24us further apart than the 100 TU beacon interval.
+        assert_that(results['bssid_to_jitter_map'][AP_MAC]).is_equal_to(([24], False, [100]))
+
+    def test_capture_analyzer_off_channel_beacons(self):
+        results = self.analyze([beacon_frame(1000, channel=11), beacon_frame(103400, channel=11)])
+        assert_that(results['bssid_to_jitter_map']).is_empty()
+        assert_that(results['bssid_to_power_map']).is_empty()
+
+    def test_capture_analyzer_truncated_data_frames(self):
+        frames = sample_frames()
+        full_results = self.analyze(frames)
+
+        radiotap_length = len(radiotap_header())
+        analyzer = CaptureAnalyzer(6)
+        for frame in frames:
+            if frame[radiotap_length] & 0x0c == 0x08:
+                analyzer.process_frame(*truncated(frame, radiotap_length, 40))
+            else:
+                analyzer.process_frame(PcapHeader(len(frame), len(frame)), frame)
+        truncated_results = analyzer.results(1.0, 2.0, 1)
+
+        for mac in (CLIENT_MAC, REMOTE_MAC, AP_MAC):
+            full_counter = full_results['station_counters'][mac]
+            truncated_counter = truncated_results['station_counters'][mac]
+            assert_that(truncated_counter.data_throughput_in).is_equal_to(full_counter.data_throughput_in)
+            assert_that(truncated_counter.data_throughput_out).is_equal_to(full_counter.data_throughput_out)
+            assert_that(truncated_counter.data_frame_count).is_equal_to(full_counter.data_frame_count)
+        assert_that(truncated_results['measurement'].extra_data['weird_frame_count']).is_equal_to(0)
+
+    def test_capture_analyzer_beacon_cache(self):
+        beacon_cache = BeaconCache()
+        frames = [beacon_frame(1000 + i * 102400, dtim_count=i % 3) for i in range(5)]
+        results = self.analyze(frames, beacon_cache=beacon_cache)
+        uncached_results = self.analyze(frames)
+
+        assert_that(results['measurement'].extra_data).contains_entry(
+            {'beacon_cache_hits': 4}, {'beacon_cache_misses': 1}
+        )
+        assert_that(results['service_sets'][0].extra_data).is_equal_to(
+            uncached_results['service_sets'][0].extra_data
+        )
+        assert_that(results['bssid_to_ssid_map']).is_equal_to(uncached_results['bssid_to_ssid_map'])
+        assert_that(results['bssid_to_jitter_map']).is_equal_to(uncached_results['bssid_to_jitter_map'])
+
+        # The cache carries over to the next analyzer, only the changed beacon needs decoding.
+        results = self.analyze([beacon_frame(1000), beacon_frame(2000, ssid=b'Renamed')], beacon_cache=beacon_cache)
+        assert_that(results['measurement'].extra_data).contains_entry(
+            {'beacon_cache_hits': 1}, {'beacon_cache_misses': 1}
+        )
+        assert_that(results['bssid_to_ssid_map'][AP_MAC]).is_equal_to(b'Renamed')
+
+    def test_beacon_cache_returns_copies(self):
+        beacon_cache = BeaconCache()
+        results = self.analyze([beacon_frame(1000)], beacon_cache=beacon_cache)
+        extra_data = results['service_sets'][0].extra_data
+        expected = copy.deepcopy(extra_data)
+        extra_data['channel'] = 11
+        extra_data['rates'].append(0x0c)
+        extra_data['crypto'].clear()
+
+        # Neither the beacon decoded into the cache nor one served from it share anything with earlier results.
+        for _ in range(2):
+            results = self.analyze([beacon_frame(1000)], beacon_cache=beacon_cache)
+            assert_that(results['measurement'].extra_data).contains_entry({'beacon_cache_hits': 1})
+            assert_that(results['service_sets'][0].extra_data).is_equal_to(expected)
+            results['service_sets'][0].extra_data['rates'].clear()
+
+    def test_capture_analyzer_merge(self):
+        frames = sample_frames() + [beacon_frame(205824)]
+        full_results = self.analyze(frames)
+
+        beacon_cache = BeaconCache()
+        merged = CaptureAnalyzer(6)
+        for chunk in (frames[:2], frames[2:4], frames[4:]):
+            analyzer = CaptureAnalyzer(6, beacon_cache=beacon_cache)
+            for frame in chunk:
+                analyzer.process_frame(None, frame)
+            merged.merge(analyzer.partial())
+        results = merged.results(1.0, 2.0, 1)
+
+        assert_that(merged.frame_count).is_equal_to(len(frames))
+        assert_that(results['measurement'].average_noise).is_equal_to(full_results['measurement'].average_noise)
+        assert_that(results['measurement'].extra_data).contains_entry(
+            {'beacon_cache_hits': 2}, {'beacon_cache_misses': 1}
+        )
+        for key in ('bssid_infra_macs', 'bssid_associated_macs', 'bssid_to_ssid_map', 'bssid_to_power_map',
+                    'bssid_to_jitter_map'):
+            assert_that(results[key]).is_equal_to(full_results[key])
+        for mac, counters in full_results['station_counters'].items():
+            assert_that(results['station_counters'][mac].to_row()).is_equal_to(counters.to_row())
+
+    def test_beacon_cache_eviction(self):
+        beacon_cache = BeaconCache(max_size=2)
+        beacon_cache.put('a', 1)
+        beacon_cache.put('b', 2)
+        assert_that(beacon_cache.get('a')).is_equal_to(1)
+        beacon_cache.put('c', 3)
+
+        assert_that(beacon_cache).is_length(2)
+        assert_that(beacon_cache.get('b')).is_none()
+        assert_that(beacon_cache.get('a')).is_equal_to(1)
+        assert_that(beacon_cache.get('c')).is_equal_to(3)
+        assert_that(beacon_cache.hits).is_equal_to(3)
+        assert_that(beacon_cache.misses).is_equal_to(1)
+
+    def test_capture_analyzer_empty(self):
+        results = self.analyze([])
+        assert_that(results['stations']).is_empty()
+        assert_that(results['service_sets']).is_empty()
+        assert_that(results['measurement'].average_noise).is_none()
+
+    def test_capture_analyzer_capture_stats(self):
+        analyzer = CaptureAnalyzer(6)
+        measurement = analyzer.results(1.0, 2.0, 1, capture_stats={
+            'frame_count': 0, 'pcap_received': 10, 'pcap_dropped': 1, 'pcap_interface_dropped': 0,
+            'channel_switch_seconds': 0.004
+        })['measurement']
+        assert_that(measurement.pcap_received).is_equal_to(10)
+        assert_that(measurement.channel_switch_seconds).is_equal_to(0.004)
+        assert_that(measurement.extra_data).contains_key('frame_count').does_not_contain_key('channel_switch_seconds')
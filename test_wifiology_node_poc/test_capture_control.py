@@ -0,0 +1,143 @@
+from unittest import TestCase
+from assertpy import assert_that
+
+from scapy.all import raw, Raw
+from scapy.layers.dot11 import Dot11, Dot11QoS
+
+from wifiology_node_poc.capture_control import AdaptiveBufferSizer, drop_rate, MEGABYTE, DwellScheduler, \
+    split_channel_plan, header_only_filter_program, MAX_SNAPLEN, MIN_DATA_SNAPLEN, BPF_LDB_ABS, BPF_LDB_IND, \
+    BPF_LSH_K, BPF_OR_X, BPF_AND_K, BPF_ADD_K, BPF_JEQ_K, BPF_TAX, BPF_TXA, BPF_RET_A, BPF_RET_K
+from wifiology_node_poc.decoders import DecodeError, parse_radiotap, parse_dot11_header, FCS_LENGTH
+from test_wifiology_node_poc.test_analysis import AP_MAC, CLIENT_MAC, REMOTE_MAC, beacon_frame, to_ds_data_frame, \
+    ack_frame, radiotap_header
+
+
+def run_bpf_program(program, packet):
+    """
+    Minimal classic BPF interpreter covering the instructions used by the capture filters.
+    """
+    a = x = pc = 0
+    while True:
+        code, jt, jf, k = program[pc]
+        pc += 1
+        if code == BPF_LDB_ABS:
+            if k >= len(packet):
+                return 0
+            a = packet[k]
+        elif code == BPF_LDB_IND:
+            if x + k >= len(packet):
+                return 0
+            a = packet[x + k]
+        elif code == BPF_LSH_K:
+            a = (a << k) & 0xffffffff
+        elif code == BPF_OR_X:
+            a |= x
+        elif code == BPF_AND_K:
+            a &= k
+        elif code == BPF_ADD_K:
+            a = (a + k) & 0xffffffff
+        elif code == BPF_JEQ_K:
+            pc += jt if a == k else jf
+        elif code == BPF_TAX:
+            x = a
+        elif code == BPF_TXA:
+            a = x
+        elif code == BPF_RET_A:
+            return a
+        elif code == BPF_RET_K:
+            return k
+        else:
+            raise ValueError("Unsupported BPF instruction {0:#x}".format(code))
+
+
+class CaptureControlUnitTest(TestCase):
+    def test_drop_rate(self):
+        assert_that(drop_rate(0, 0)).is_equal_to(0.0)
+        assert_that(drop_rate(1000, 10)).is_equal_to(0.01)
+        assert_that(drop_rate(10, 20)).is_equal_to(1.0)
+
+    def test_adaptive_buffer_grows_on_drops(self):
+        sizer = AdaptiveBufferSizer(8 * MEGABYTE, 2 * MEGABYTE, 20 * MEGABYTE)
+        assert_that(sizer.buffer_size(6)).is_equal_to(8 * MEGABYTE)
+        assert_that(sizer.record(6, 10000, 500)).is_equal_to(16 * MEGABYTE)
+        assert_that(sizer.record(6, 10000, 500)).is_equal_to(20 * MEGABYTE)
+        assert_that(sizer.buffer_size(6)).is_equal_to(20 * MEGABYTE)
+        assert_that(sizer.buffer_size(1)).is_equal_to(8 * MEGABYTE)
+
+    def test_adaptive_buffer_shrinks_when_clean(self):
+        sizer = AdaptiveBufferSizer(4 * MEGABYTE, 2 * MEGABYTE, 20 * MEGABYTE, shrink_after=2)
+        assert_that(sizer.record(1, 100, 0)).is_equal_to(4 * MEGABYTE)
+        assert_that(sizer.record(1, 100, 0)).is_equal_to(3 * MEGABYTE)
+        # A few drops below the growth threshold hold the size and restart the clean streak.
+        assert_that(sizer.record(1, 1000000, 1)).is_equal_to(3 * MEGABYTE)
+        assert_that(sizer.record(1, 100, 0)).is_equal_to(3 * MEGABYTE)
+        assert_that(sizer.record(1, 100, 0)).is_equal_to(int(2.25 * MEGABYTE))
+        assert_that(sizer.record(1, 100, 0)).is_equal_to(int(2.25 * MEGABYTE))
+        assert_that(sizer.record(1, 100, 0)).is_equal_to(2 * MEGABYTE)
+
+    def test_adaptive_buffer_rejects_bad_limits(self):
+        assert_that(AdaptiveBufferSizer).raises(ValueError).when_called_with(
+            4 * MEGABYTE, 8 * MEGABYTE, 2 * MEGABYTE
+        )
+
+    def test_dwell_scheduler_even_without_activity(self):
+        scheduler = DwellScheduler(33.0, channels=(1, 6, 11))
+        assert_that(scheduler.dwell_times({})).is_equal_to({1: 11.0, 6: 11.0, 11: 11.0})
+
+    def test_dwell_scheduler_follows_activity(self):
+        scheduler = DwellScheduler(30.0, channels=(1, 6, 11), min_dwell_seconds=2.0)
+        activity = {
+            1: {"totalDuration": 10.0, "frameCount": 300, "stationCount": 6, "serviceSetCount": 3},
+            6: {"totalDuration": 10.0, "frameCount": 100, "stationCount": 2, "serviceSetCount": 1}
+        }
+        dwell_times = scheduler.dwell_times(activity)
+
+        assert_that(sum(dwell_times.values())).is_close_to(30.0, 1e-9)
+        assert_that(dwell_times[1]).is_close_to(2.0 + 24.0 * 0.75, 1e-9)
+        assert_that(dwell_times[6]).is_close_to(2.0 + 24.0 * 0.25, 1e-9)
+        assert_that(dwell_times[11]).is_equal_to(2.0)
+
+    def test_dwell_scheduler_rejects_small_budget(self):
+        assert_that(DwellScheduler).raises(ValueError).when_called_with(10.0, channels=(1, 6, 11),
+                                                                       min_dwell_seconds=4.0)
+
+    def test_split_channel_plan(self):
+        plans = split_channel_plan({channel: 10.0 for channel in range(1, 12)}, 2)
+        assert_that([[channel for channel, _ in plan] for plan in plans]).is_equal_to(
+            [[1, 3, 5, 7, 9, 11], [2, 4, 6, 8, 10]]
+        )
+
+        plans = split_channel_plan({1: 20.0, 6: 8.0, 11: 6.0, 3: 4.0, 9: 2.0}, 2)
+        assert_that(plans).is_equal_to([[(1, 20.0)], [(3, 4.0), (6, 8.0), (9, 2.0), (11, 6.0)]])
+        assert_that(split_channel_plan({1: 5.0}, 3)).is_equal_to([[(1, 5.0)], [], []])
+        assert_that(split_channel_plan).raises(ValueError).when_called_with({1: 5.0}, 0)
+
+    def test_header_only_filter_program(self):
+        program = header_only_filter_program(64)
+        radiotap_length = len(radiotap_header())
+
+        assert_that(run_bpf_program(program, to_ds_data_frame(500))).is_equal_to(radiotap_length + 64)
+        assert_that(run_bpf_program(program, beacon_frame(1000))).is_equal_to(MAX_SNAPLEN)
+        assert_that(run_bpf_program(program, ack_frame())).is_equal_to(MAX_SNAPLEN)
+        assert_that(run_bpf_program(program, b'\x00\x00')).is_equal_to(0)
+
+    def test_header_only_filter_program_min_snaplen(self):
+        # The longest data frame header: four addresses, QoS control and HT control.
+        frame = raw(
+            radiotap_header() /
+            Dot11(type=2, subtype=8, FCfield='to_DS+from_DS+order', addr1=AP_MAC, addr2=CLIENT_MAC, addr3=REMOTE_MAC,
+                  addr4=REMOTE_MAC) /
+            Dot11QoS() / Raw(b'\x00' * 4 + b'x' * 200)
+        ) + b'\x00' * FCS_LENGTH
+        truncated = frame[:run_bpf_program(header_only_filter_program(MIN_DATA_SNAPLEN), frame)]
+
+        def decode(payload):
+            radiotap = parse_radiotap(payload)
+            return parse_dot11_header(payload, radiotap.length, len(payload) - FCS_LENGTH)
+
+        assert_that(len(truncated)).is_equal_to(len(radiotap_header()) + MIN_DATA_SNAPLEN)
+        assert_that(decode(truncated).data_addresses()).is_equal_to(decode(frame).data_addresses())
+        assert_that(decode(truncated).body_length).is_equal_to(0)
+        assert_that(decode).raises(DecodeError).when_called_with(truncated[:-1])
+        assert_that(header_only_filter_program).raises(ValueError).when_called_with(MIN_DATA_SNAPLEN - 1)
+        assert_that(header_only_filter_program).raises(ValueError).when_called_with(MAX_SNAPLEN + 1)
@@ -0,0 +1,61 @@
+import os
+import tempfile
+from unittest import TestCase
+from assertpy import assert_that
+
+from wifiology_node_poc.core_sqlite import create_connection, transaction_wrapper, deferred_transaction_wrapper
+
+
+class CoreSqliteUnitTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.database_loc = os.path.join(self.tmp_dir.name, "test.db")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    @staticmethod
+    def pragma(connection, name):
+        return connection.execute("PRAGMA {0}".format(name)).fetchone()[0]
+
+    def test_default_profile(self):
+        connection = create_connection(self.database_loc)
+        assert_that(self.pragma(connection, "journal_mode")).is_equal_to("delete")
+        assert_that(connection.profile).is_equal_to("default")
+        connection.close()
+
+    def test_writer_profile(self):
+        connection = create_connection(self.database_loc, profile="writer")
+        assert_that(self.pragma(connection, "journal_mode")).is_equal_to("wal")
+        # synchronous=NORMAL
+        assert_that(self.pragma(connection, "synchronous")).is_equal_to(1)
+        assert_that(self.pragma(connection, "cache_size")).is_equal_to(-8192)
+        assert_that(self.pragma(connection, "busy_timeout")).is_equal_to(60000)
+
+        with transaction_wrapper(connection) as t:
+            t.execute("CREATE TABLE test(value INTEGER)")
+        with deferred_transaction_wrapper(connection) as t:
+            t.execute("SELECT * FROM test")
+        assert_that(connection.lock_wait_stats()).contains_entry({"profile": "writer"}, {"transactions": 1})
+        connection.close()
+
+        # An explicit timeout wins over the profile's busy_timeout.
+        connection = create_connection(self.database_loc, 2, profile="reader")
+        assert_that(self.pragma(connection, "busy_timeout")).is_equal_to(2000)
+        with transaction_wrapper(connection) as t:
+            t.execute("SELECT * FROM test")
+        assert_that(connection.lock_wait_stats()["transactions"]).is_equal_to(0)
+        connection.close()
+
+    def test_profile_busy_timeout_without_timeout(self):
+        # The CLIs pass their --db-timeout-seconds, None unless it is given.
+        connection = create_connection(self.database_loc, timeout=None, profile="reader")
+        assert_that(self.pragma(connection, "busy_timeout")).is_equal_to(5000)
+        connection.close()
+
+        connection = create_connection(self.database_loc, timeout=3, profile="reader")
+        assert_that(self.pragma(connection, "busy_timeout")).is_equal_to(3000)
+        connection.close()
+
+    def test_unknown_profile(self):
+        assert_that(create_connection).raises(ValueError).when_called_with(self.database_loc, profile="nope")
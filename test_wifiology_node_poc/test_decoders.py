@@ -0,0 +1,177 @@
+import struct
+from unittest import TestCase
+from assertpy import assert_that
+
+import dpkt
+from scapy.all import raw, Raw
+from scapy.layers.dot11 import RadioTap, Dot11, Dot11QoS, Dot11Auth, Dot11Beacon, Dot11Elt, Dot11EltRates, \
+    Dot11EltRSN, Dot11EltMicrosoftWPA, Dot11EltVendorSpecific
+
+from wifiology_node_poc.analysis import binary_to_mac, int_to_mac, network_stats
+from wifiology_node_poc.decoders import DecodeError, parse_radiotap, parse_dot11_header, parse_beacon_fields, \
+    iter_information_elements, information_elements_digest, rate_decoder
+
+
+def radiotap_frames():
+    body = Dot11(type=1, subtype=13, addr1='66:77:88:99:aa:bb')
+    return [
+        raw(RadioTap(
+            present='Flags+Rate+dBm_AntSignal+dBm_AntNoise',
+            Flags='FCS', Rate=12, dBm_AntSignal=-40, dBm_AntNoise=-92
+        ) / body),
+        raw(RadioTap(
+            present='TSFT+Flags+Rate+Channel+dBm_AntSignal+dBm_AntNoise+Antenna',
+            mac_timestamp=123456789, Flags='FCS+badFCS', Rate=54, ChannelFrequency=2437,
+            ChannelFlags='2GHz+OFDM', dBm_AntSignal=-71, dBm_AntNoise=-101, Antenna=1
+        ) / body),
+        # TSFT + dBm_AntSignal behind an extended present bitmask, so TSFT needs 4 bytes of padding.
+        struct.pack('<BBHII4xQb', 0, 0, 25, 0x80000021, 0, 987654321, -20) + raw(body),
+        raw(RadioTap(present='Rate', Rate=1) / body),
+        raw(RadioTap(present=0) / body),
+    ]
+
+
+def dot11_data_frames():
+    addresses = dict(addr1='00:11:22:33:44:55', addr2='66:77:88:99:aa:bb', addr3='de:ad:be:ef:00:01')
+    return [
+        raw(Dot11(type=2, subtype=0, FCfield=0, **addresses) / Raw(b'x' * 10)),
+        raw(Dot11(type=2, subtype=0, FCfield='to_DS+retry', **addresses) / Raw(b'x' * 20)),
+        raw(Dot11(type=2, subtype=0, FCfield='from_DS', **addresses) / Raw(b'x' * 30)),
+        raw(Dot11(type=2, subtype=0, FCfield='to_DS+from_DS', addr4='01:02:03:04:05:06', **addresses) /
+            Raw(b'x' * 40)),
+        raw(Dot11(type=2, subtype=8, FCfield='to_DS', **addresses) / Dot11QoS() / Raw(b'x' * 50)),
+    ]
+
+
+def beacon_body(cap='ESS', elements=None):
+    return raw(Dot11Beacon(timestamp=123456789012, beacon_interval=100, cap=cap) / (elements or Dot11Elt(ID=0)))
+
+
+class DecodersUnitTest(TestCase):
+    def test_parse_radiotap_matches_scapy(self):
+        for frame in radiotap_frames():
+            expected = RadioTap(frame)
+            decoded = parse_radiotap(frame)
+
+            assert_that(decoded.length).is_equal_to(expected.len)
+            assert_that(decoded.antenna_signal).is_equal_to(expected.dBm_AntSignal)
+            assert_that(decoded.antenna_noise).is_equal_to(expected.dBm_AntNoise)
+            assert_that(decoded.rate).is_equal_to(expected.Rate)
+            if expected.Flags is None:
+                assert_that(decoded.bad_fcs).is_none()
+                assert_that(decoded.has_fcs).is_false()
+            else:
+                assert_that(decoded.bad_fcs).is_equal_to(expected.Flags.badFCS)
+                assert_that(decoded.has_fcs).is_equal_to(expected.Flags.FCS)
+
+    def test_parse_radiotap_truncated(self):
+        frame = radiotap_frames()[1]
+        assert_that(parse_radiotap).raises(DecodeError).when_called_with(frame[:6])
+        assert_that(parse_radiotap).raises(DecodeError).when_called_with(frame[:12])
+
+    def test_parse_dot11_header_data_frames_match_dpkt(self):
+        for frame in dot11_data_frames():
+            expected = dpkt.ieee80211.IEEE80211(frame)
+            decoded = parse_dot11_header(frame)
+            src, dst, bssid = decoded.data_addresses()
+
+            assert_that(decoded.frame_type).is_equal_to(expected.type)
+            assert_that(decoded.subtype).is_equal_to(expected.subtype)
+            assert_that(decoded.to_ds).is_equal_to(bool(expected.to_ds))
+            assert_that(decoded.from_ds).is_equal_to(bool(expected.from_ds))
+            assert_that(decoded.retry).is_equal_to(bool(expected.retry))
+            assert_that(int_to_mac(src)).is_equal_to(binary_to_mac(expected.data_frame.src))
+            assert_that(int_to_mac(dst)).is_equal_to(binary_to_mac(expected.data_frame.dst))
+            if hasattr(expected.data_frame, 'bssid'):
+                assert_that(int_to_mac(bssid)).is_equal_to(binary_to_mac(expected.data_frame.bssid))
+            else:
+                assert_that(bssid).is_none()
+            assert_that(decoded.body_length).is_equal_to(len(expected.data_frame.data))
+            assert_that(frame[decoded.body_offset:]).is_equal_to(expected.data_frame.data)
+
+    def test_parse_dot11_header_management_and_control_frames(self):
+        auth = raw(Dot11(type=0, subtype=11, addr1='00:11:22:33:44:55', addr2='66:77:88:99:aa:bb',
+                         addr3='00:11:22:33:44:55') / Dot11Auth(seqnum=1)) + b'\xaa' * 4
+        decoded = parse_dot11_header(auth, end=len(auth) - 4)
+        assert_that(decoded.frame_type).is_equal_to(0)
+        assert_that(decoded.subtype).is_equal_to(11)
+        assert_that(int_to_mac(decoded.addr2)).is_equal_to('66:77:88:99:aa:bb')
+        assert_that(int_to_mac(decoded.addr3)).is_equal_to('00:11:22:33:44:55')
+        assert_that(decoded.body_length).is_equal_to(6)
+
+        rts = raw(Dot11(type=1, subtype=11, addr1='00:11:22:33:44:55', addr2='66:77:88:99:aa:bb'))
+        decoded = parse_dot11_header(rts)
+        assert_that(int_to_mac(decoded.addr1)).is_equal_to('00:11:22:33:44:55')
+        assert_that(int_to_mac(decoded.addr2)).is_equal_to('66:77:88:99:aa:bb')
+        assert_that(decoded.addr3).is_none()
+
+        ack = raw(Dot11(type=1, subtype=13, addr1='66:77:88:99:aa:bb'))[:10]
+        decoded = parse_dot11_header(ack)
+        assert_that(int_to_mac(decoded.addr1)).is_equal_to('66:77:88:99:aa:bb')
+        assert_that(decoded.addr2).is_none()
+
+    def test_parse_dot11_header_truncated(self):
+        frame = dot11_data_frames()[3]
+        assert_that(parse_dot11_header).raises(DecodeError).when_called_with(frame[:8])
+        assert_that(parse_dot11_header).raises(DecodeError).when_called_with(frame[:26])
+        assert_that(parse_dot11_header).raises(DecodeError).when_called_with(b'\x0c\x00' + frame[2:])
+
+    def test_int_to_mac(self):
+        assert_that(int_to_mac(0x001122aabbcc)).is_equal_to('00:11:22:aa:bb:cc')
+        assert_that(int_to_mac(0)).is_equal_to('00:00:00:00:00:00')
+
+    def test_parse_beacon_fields(self):
+        body = beacon_body(cap='ESS+privacy')
+        fields = parse_beacon_fields(body, 0, len(body))
+        assert_that(fields.timestamp).is_equal_to(123456789012)
+        assert_that(fields.beacon_interval).is_equal_to(100)
+        assert_that(fields.privacy).is_true()
+        assert_that(parse_beacon_fields).raises(DecodeError).when_called_with(body, 0, 11)
+
+    def test_iter_information_elements(self):
+        elements = raw(Dot11Elt(ID=0, info=b'TestNet') / Dot11Elt(ID=3, info=b'\x06'))
+        assert_that(list(iter_information_elements(elements, 0, len(elements)))).is_equal_to(
+            [(0, b'TestNet'), (3, b'\x06')]
+        )
+        assert_that(list(iter_information_elements(elements, 0, 6))).is_equal_to([(0, b'Test')])
+        assert_that(list(iter_information_elements(elements, 0, 1))).is_empty()
+
+    def test_information_elements_digest_ignores_tim(self):
+        def digest(dtim_count, ssid=b'TestNet'):
+            elements = raw(
+                Dot11Elt(ID=0, info=ssid) / Dot11Elt(ID=5, info=bytes([dtim_count, 3, 0, 0])) / Dot11EltRSN()
+            )
+            return information_elements_digest(elements, 0, len(elements))
+
+        assert_that(digest(0)).is_equal_to(digest(2))
+        assert_that(digest(0)).is_not_equal_to(digest(0, ssid=b'Other'))
+
+    def test_network_stats(self):
+        body = beacon_body(cap='ESS+privacy', elements=(
+            Dot11Elt(ID=0, info=b'TestNet') /
+            Dot11EltRates(rates=[0x82, 0x84, 0x0b]) /
+            Dot11Elt(ID=3, info=b'\x0b') /
+            Dot11Elt(ID=7, info=b'US\x20\x01\x0b\x1e') /
+            Dot11Elt(ID=33, info=b'\x05\x14') /
+            Dot11EltVendorSpecific(oui=0x00904c, info=b'\x33\x00') /
+            Dot11EltRSN() /
+            Dot11EltMicrosoftWPA()
+        ))
+        summary = network_stats(parse_beacon_fields(body, 0, len(body)), iter_information_elements(body, 12, len(body)))
+        assert_that(summary).contains_entry(
+            {'ssid': 'TestNet'}, {'channel': 11}, {'country': 'US'}, {'power_capability': {'min': 5, 'max': 20}},
+            {'rates': [0x82, 0x84, 0x0b]}
+        )
+        assert_that(summary['crypto']).contains_only('WPA', 'WPA2')
+
+    def test_network_stats_without_crypto_elements(self):
+        for cap, crypto in (('ESS+privacy', ['WEP']), ('ESS', ['OPN'])):
+            body = beacon_body(cap=cap)
+            summary = network_stats(
+                parse_beacon_fields(body, 0, len(body)), iter_information_elements(body, 12, len(body))
+            )
+            assert_that(summary['crypto']).is_equal_to(crypto)
+            assert_that(summary).does_not_contain_key('rates')
+
+    def test_rate_decoder(self):
+        assert_that(rate_decoder([0x82, 0x0b, 0x6c])).is_equal_to([(1.0, True), (5.5, False), (54.0, False)])
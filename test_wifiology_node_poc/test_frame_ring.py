@@ -0,0 +1,116 @@
+import multiprocessing
+import threading
+from unittest import TestCase
+from assertpy import assert_that
+
+from wifiology_node_poc.frame_ring import FrameRing, RECORD_FRAME, RECORD_SAMPLE_START, RECORD_SAMPLE_END, \
+    POSITION, HEAD_OFFSET
+from wifiology_node_poc.pcap_file import PcapRecordHeader
+from test_wifiology_node_poc.test_analysis import sample_frames
+
+
+def header_for(frame, i=0):
+    return PcapRecordHeader(1000 + i, 500, len(frame), len(frame) + 10)
+
+
+def read_records(ring, wait=True):
+    return [
+        (kind, header, None if frame is None else bytes(frame)) for kind, header, frame in ring.records(wait)
+    ]
+
+
+def consume(ring_name, ring_lock, result_queue):
+    ring = FrameRing.attach(ring_name, ring_lock)
+    try:
+        result_queue.put([
+            (kind, header, None if frame is None else bytes(frame)) for kind, header, frame in ring.records()
+        ])
+    finally:
+        ring.release()
+
+
+class FrameRingUnitTest(TestCase):
+    def setUp(self):
+        self.ring = FrameRing.create(4096)
+
+    def tearDown(self):
+        self.ring.release()
+
+    def test_records(self):
+        frames = sample_frames()
+        self.ring.write_marker(RECORD_SAMPLE_START, 6)
+        for i, frame in enumerate(frames):
+            assert_that(self.ring.write_frame(header_for(frame, i), frame)).is_true()
+        self.ring.write_marker(RECORD_SAMPLE_END)
+        self.ring.close()
+
+        records = read_records(self.ring)
+        assert_that(records[0]).is_equal_to((RECORD_SAMPLE_START, 6, None))
+        assert_that(records[-1]).is_equal_to((RECORD_SAMPLE_END, 0, None))
+        assert_that([frame for _, _, frame in records[1:-1]]).is_equal_to(frames)
+        assert_that(records[2][1]).is_equal_to(header_for(frames[1], 1))
+
+    def test_wraparound_and_overruns(self):
+        # 920 byte records don't divide the ring, so writes wrap around with padding at the end.
+        frame = b'\xab' * 900
+        read = []
+        for i in range(20):
+            assert_that(self.ring.write_frame(header_for(frame, i), frame)).is_true()
+            if i % 3 == 2:
+                read.extend(read_records(self.ring, wait=False))
+        read.extend(read_records(self.ring, wait=False))
+        assert_that([header.ts_sec for _, header, _ in read]).is_equal_to(list(range(1000, 1020)))
+
+        self.ring.reset_high_water_mark()
+        assert_that(self.ring.high_water_mark).is_equal_to(0)
+        written = sum(self.ring.write_frame(header_for(frame, i), frame) for i in range(5))
+        assert_that(self.ring.overrun_count).is_equal_to(5 - written).is_greater_than(0)
+        # Wrap padding counts as used space.
+        assert_that(self.ring.high_water_mark).is_between(written * 920, self.ring.capacity)
+        self.ring.reset_high_water_mark()
+        assert_that(self.ring.write_frame(header_for(frame), b'x' * 5000)).is_false()
+        assert_that(self.ring.overrun_count).is_equal_to(6 - written)
+
+        self.ring.close()
+        read.extend(read_records(self.ring))
+        assert_that(read).is_length(20 + written)
+        assert_that({frame for _, _, frame in read}).is_equal_to({frame})
+
+    def test_marker_timeout(self):
+        frame = b'\xab' * 1000
+        while self.ring.write_frame(header_for(frame), frame):
+            pass
+        self.ring.write_frame(header_for(b'x' * 900), b'x' * 900)
+        assert_that(self.ring.write_marker).raises(TimeoutError).when_called_with(
+            RECORD_SAMPLE_END, timeout_seconds=0.01
+        )
+
+    def test_positions_published_under_lock(self):
+        frame = sample_frames()[0]
+        writer = threading.Thread(target=self.ring.write_frame, args=(header_for(frame), frame))
+        with self.ring.lock:
+            writer.start()
+            writer.join(0.05)
+            # The record may be copied, but its head can't be published while the lock is held.
+            assert_that(writer.is_alive()).is_true()
+            assert_that(POSITION.unpack_from(self.ring.buf, HEAD_OFFSET)[0]).is_equal_to(0)
+        writer.join(5)
+        assert_that(read_records(self.ring, wait=False)).is_equal_to([(RECORD_FRAME, header_for(frame), frame)])
+
+    def test_across_processes(self):
+        frames = sample_frames() * 200
+        result_queue = multiprocessing.Queue()
+        consumer = multiprocessing.Process(target=consume, args=(self.ring.name, self.ring.lock, result_queue))
+        consumer.start()
+        self.ring.write_marker(RECORD_SAMPLE_START, 11)
+        for i, frame in enumerate(frames):
+            while not self.ring.write_frame(header_for(frame, i), frame):
+                pass
+        self.ring.write_marker(RECORD_SAMPLE_END)
+        self.ring.close()
+        records = result_queue.get(timeout=30)
+        consumer.join(30)
+
+        assert_that([frame for kind, _, frame in records if kind == RECORD_FRAME]).is_equal_to(frames)
+        assert_that(records[0]).is_equal_to((RECORD_SAMPLE_START, 11, None))
+        assert_that(self.ring.high_water_mark).is_less_than_or_equal_to(self.ring.capacity)
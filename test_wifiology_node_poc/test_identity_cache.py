@@ -0,0 +1,58 @@
+from unittest import TestCase
+from assertpy import assert_that
+
+from wifiology_node_poc.core_sqlite import create_connection, transaction_wrapper
+from wifiology_node_poc.identity_cache import LRUIdentityMap, IdentityCache, bump_identity_generation
+from wifiology_node_poc.queries.core import write_schema, insert_station, insert_service_set
+from wifiology_node_poc.models import Station, ServiceSet
+
+
+class IdentityCacheUnitTest(TestCase):
+    def setUp(self):
+        self.connection = create_connection(":memory:")
+        write_schema(self.connection)
+
+    def tearDown(self):
+        self.connection.close()
+        self.connection = None
+
+    def test_lru_identity_map(self):
+        identity_map = LRUIdentityMap(2)
+        assert_that(identity_map.hit_rate()).is_none()
+        identity_map.put("a", 1)
+        identity_map.put("b", 2)
+        assert_that(identity_map.get("a")).is_equal_to(1)
+        # "b" is now the least recently used.
+        identity_map.put("c", 3)
+        assert_that(identity_map.get("b")).is_none()
+        assert_that(identity_map.get("c")).is_equal_to(3)
+        assert_that(identity_map.stats()).is_equal_to({"size": 2, "hits": 2, "misses": 1, "hit_rate": 2 / 3})
+        assert_that(LRUIdentityMap).raises(ValueError).when_called_with(0)
+
+    def test_identity_cache(self):
+        with transaction_wrapper(self.connection) as t:
+            station_id = insert_station(t, Station.new("01:02:03:04:05:06", {}))
+            service_set_id = insert_service_set(t, ServiceSet.new("0a:00:00:00:00:01"))
+        identity_cache = IdentityCache().warm(self.connection)
+
+        stations = [Station.new("01:02:03:04:05:06"), Station.new("01:02:03:04:05:07")]
+        service_sets = [ServiceSet.new("0a:00:00:00:00:01")]
+        identity_cache.validate(self.connection)
+        identity_cache.fill_ids(stations, service_sets)
+        assert_that([station.station_id for station in stations]).is_equal_to([station_id, None])
+        assert_that(service_sets[0].service_set_id).is_equal_to(service_set_id)
+
+        stations[1].station_id = 42
+        identity_cache.remember(stations, service_sets)
+        stations = [Station.new("01:02:03:04:05:07")]
+        identity_cache.fill_ids(stations, [])
+        assert_that(stations[0].station_id).is_equal_to(42)
+        assert_that(identity_cache.stats()["stations"]["hits"]).is_equal_to(2)
+
+        with transaction_wrapper(self.connection) as t:
+            bump_identity_generation(t)
+        identity_cache.validate(self.connection)
+        stations = [Station.new("01:02:03:04:05:06")]
+        identity_cache.fill_ids(stations, [])
+        assert_that(stations[0].station_id).is_none()
+        assert_that(identity_cache.stats()).contains_entry({"invalidations": 1})
@@ -0,0 +1,113 @@
+import random
+import statistics
+from unittest import TestCase
+from assertpy import assert_that
+
+from wifiology_node_poc.models import DataCounters
+from wifiology_node_poc.utils import RunningStatistics
+
+
+def counters_with_measurements(powers, rates, keep_samples=False):
+    counters = DataCounters.zero(keep_samples=keep_samples)
+    counters.data_frame_count = len(powers)
+    for power in powers:
+        counters.add_power_measurement(power)
+    for rate in rates:
+        counters.add_rate_measurement(rate)
+    return counters
+
+
+class ModelsUnitTest(TestCase):
+    def setUp(self):
+        self.random = random.Random(1234)
+
+    def test_running_statistics(self):
+        values = [self.random.randint(-95, -20) for _ in range(1000)]
+        running = RunningStatistics()
+        for value in values:
+            running.push(value)
+
+        assert_that(running.count).is_equal_to(len(values))
+        assert_that(running.average).is_close_to(statistics.mean(values), 1e-9)
+        assert_that(running.std_dev).is_close_to(statistics.stdev(values), 1e-9)
+        assert_that(running.minimum).is_equal_to(min(values))
+        assert_that(running.maximum).is_equal_to(max(values))
+
+    def test_running_statistics_edge_cases(self):
+        running = RunningStatistics()
+        assert_that(running.average).is_none()
+        assert_that(running.std_dev).is_none()
+        running.push(-40)
+        assert_that(running.average).is_equal_to(-40)
+        assert_that(running.std_dev).is_equal_to(0.0)
+
+    def test_running_statistics_merge(self):
+        left_values = [self.random.uniform(-95, -20) for _ in range(300)]
+        right_values = [self.random.uniform(-60, -10) for _ in range(50)]
+        left, right = RunningStatistics(), RunningStatistics()
+        for value in left_values:
+            left.push(value)
+        for value in right_values:
+            right.push(value)
+
+        merged = left.merge(right)
+        assert_that(merged.count).is_equal_to(350)
+        assert_that(merged.average).is_close_to(statistics.mean(left_values + right_values), 1e-9)
+        assert_that(merged.std_dev).is_close_to(statistics.stdev(left_values + right_values), 1e-9)
+        assert_that(merged.minimum).is_equal_to(min(left_values))
+        assert_that(merged.maximum).is_equal_to(max(right_values))
+        assert_that(left.merge(RunningStatistics()).average).is_equal_to(left.average)
+        assert_that(RunningStatistics().merge(right).average).is_equal_to(right.average)
+
+    def test_data_counters_add_is_exact(self):
+        left = counters_with_measurements([-40, -42, -44], [6.0, 54.0])
+        right = counters_with_measurements([-80, -82], [1.0, 24.0])
+        total = left + right
+
+        assert_that(total.data_frame_count).is_equal_to(5)
+        assert_that(total.average_power).is_close_to(statistics.mean([-40, -42, -44, -80, -82]), 1e-9)
+        assert_that(total.std_dev_power).is_close_to(statistics.stdev([-40, -42, -44, -80, -82]), 1e-9)
+        assert_that(total.lowest_rate).is_equal_to(1.0)
+        assert_that(total.highest_rate).is_equal_to(54.0)
+        assert_that(total.power_measurements).is_empty()
+        assert_that(DataCounters.zero().add(DataCounters.zero()).average_power).is_none()
+
+    def test_data_counters_keep_samples(self):
+        left = counters_with_measurements([-40, -42], [6.0], keep_samples=True)
+        right = counters_with_measurements([-80], [1.0], keep_samples=True)
+        total = left + right
+
+        assert_that(total.power_measurements).is_equal_to([-40, -42, -80])
+        assert_that(total.rate_measurements).is_equal_to([6.0, 1.0])
+        assert_that(counters_with_measurements([-40], [6.0]).power_measurements).is_empty()
+
+    def test_data_counters_add_precomputed(self):
+        loaded = DataCounters(
+            0, 0, 0, 0, 0, 0, 0, 0, 2, 0, 0, 0, average_power=-50.0, std_dev_power=0.0, lowest_rate=6.0,
+            higest_rate=12.0
+        )
+        total = loaded + counters_with_measurements([-30, -30], [54.0])
+
+        assert_that(total.average_power).is_equal_to(-40.0)
+        assert_that(total.lowest_rate).is_equal_to(6.0)
+        assert_that(total.highest_rate).is_equal_to(54.0)
+
+    def test_data_counters_add_precomputed_stays_estimated(self):
+        loaded = DataCounters(
+            0, 0, 0, 0, 0, 0, 0, 0, 2, 0, 0, 0, average_power=-50.0, std_dev_power=0.0, lowest_rate=6.0,
+            higest_rate=12.0
+        )
+        exact = counters_with_measurements([-30, -30], [54.0])
+        assert_that(exact.power_statistics_estimated).is_false()
+
+        # Added up from an estimate, in either order and over several rollups.
+        for total in (loaded + exact, exact + loaded, (loaded + exact) + exact):
+            assert_that(total.power_statistics_estimated).is_true()
+            row = total.to_row()
+            assert_that(row).contains_entry({'powerCount': None}, {'powerSum': None}, {'powerSumSquares': None})
+            assert_that(row['averagePower']).is_not_none()
+        assert_that(((loaded + exact) + exact).average_power).is_close_to(-110 / 3, 1e-9)
+
+        total = exact + exact
+        assert_that(total.power_statistics_estimated).is_false()
+        assert_that(total.to_row()).contains_entry({'powerCount': 4}, {'powerSum': -120})
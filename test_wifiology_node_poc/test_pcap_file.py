@@ -0,0 +1,128 @@
+import os
+import struct
+import tempfile
+from unittest import TestCase
+from assertpy import assert_that
+
+from wifiology_node_poc.analysis import CaptureAnalyzer, BeaconCache
+from wifiology_node_poc.decoders import DecodeError
+from wifiology_node_poc.pcap_file import PcapFile, LINKTYPE_IEEE802_11_RADIOTAP
+from test_wifiology_node_poc.test_analysis import sample_frames
+
+
+def pcap_bytes(frames, byte_order='<', nanoseconds=False, snaplen=65535, linktype=LINKTYPE_IEEE802_11_RADIOTAP):
+    magic = 0xa1b23c4d if nanoseconds else 0xa1b2c3d4
+    data = struct.pack(byte_order + 'IHHiIII', magic, 2, 4, 0, 0, snaplen, linktype)
+    for i, frame in enumerate(frames):
+        kept = frame[:snaplen]
+        data += struct.pack(byte_order + 'IIII', 1000 + i, 500 * (1000 if nanoseconds else 1), len(kept), len(frame))
+        data += kept
+    return data
+
+
+class PcapFileUnitTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write(self, data, name='capture.pcap'):
+        path = os.path.join(self.tmp_dir.name, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def read_all(self, path, *args, **kwargs):
+        with PcapFile(path) as pcap:
+            return [(header, bytes(frame)) for header, frame in pcap.frames(*args, **kwargs)]
+
+    def test_frames(self):
+        frames = sample_frames()
+        for byte_order in ('<', '>'):
+            for nanoseconds in (False, True):
+                path = self.write(pcap_bytes(frames, byte_order, nanoseconds))
+                records = self.read_all(path)
+
+                assert_that([frame for _, frame in records]).is_equal_to(frames)
+                header = records[1][0]
+                assert_that(header.getts()).is_equal_to((1001, 500))
+                assert_that(header.getcaplen()).is_equal_to(len(frames[1]))
+                assert_that(header.getlen()).is_equal_to(len(frames[1]))
+        with PcapFile(path) as pcap:
+            assert_that(pcap.linktype).is_equal_to(LINKTYPE_IEEE802_11_RADIOTAP)
+            assert_that(pcap.frame_count()).is_equal_to(len(frames))
+
+    def test_frame_ranges(self):
+        frames = sample_frames()
+        path = self.write(pcap_bytes(frames))
+
+        assert_that([frame for _, frame in self.read_all(path, 1, 3)]).is_equal_to(frames[1:3])
+        assert_that([frame for _, frame in self.read_all(path, 3)]).is_equal_to(frames[3:])
+        assert_that(self.read_all(path, 10)).is_empty()
+        with PcapFile(path) as pcap:
+            offset = pcap.index()[2]
+        assert_that([frame for _, frame in self.read_all(path, 2, 4, offset=offset)]).is_equal_to(frames[2:4])
+
+    def test_truncated_file(self):
+        frames = sample_frames()
+        path = self.write(pcap_bytes(frames)[:-10])
+        assert_that([frame for _, frame in self.read_all(path)]).is_equal_to(frames[:-1])
+        with PcapFile(path) as pcap:
+            assert_that(pcap.frame_count()).is_equal_to(len(frames) - 1)
+
+        assert_that(PcapFile).raises(DecodeError).when_called_with(self.write(b'\x00' * 10, 'short.pcap'))
+        assert_that(PcapFile).raises(DecodeError).when_called_with(self.write(b'\x00' * 40, 'bad.pcap'))
+
+    def test_other_linktype(self):
+        # An Ethernet capture, e.g. picked up from an archive by wifiology_ingest.
+        path = self.write(pcap_bytes(sample_frames(), linktype=1), 'ethernet.pcap')
+        assert_that(PcapFile).raises(ValueError).when_called_with(path).is_equal_to(
+            "{0} is not a radiotap capture, link type 1".format(path)
+        )
+
+    def test_truncated_frames_analysis(self):
+        frames = sample_frames()
+        analyzer = CaptureAnalyzer(6)
+        for frame in frames:
+            analyzer.process_frame(None, frame)
+        expected = analyzer.results(1.0, 2.0, 1)
+
+        analyzer = CaptureAnalyzer(6)
+        with PcapFile(self.write(pcap_bytes(frames, snaplen=100))) as pcap:
+            for header, frame in pcap.frames():
+                analyzer.process_frame(header, frame)
+        results = analyzer.results(1.0, 2.0, 1)
+
+        assert_that(results['station_counters']['66:77:88:99:aa:bb'].data_throughput_out).is_equal_to(
+            expected['station_counters']['66:77:88:99:aa:bb'].data_throughput_out
+        )
+        assert_that(results['bssid_to_jitter_map']).is_equal_to(expected['bssid_to_jitter_map'])
+
+    def test_close_after_analysis(self):
+        path = self.write(pcap_bytes(sample_frames()))
+        # The way analyze_capture_file reads a capture: the last frame is still bound to the loop variable when
+        # the file is closed.
+        analyzer = CaptureAnalyzer(6, beacon_cache=BeaconCache())
+        with PcapFile(path) as pcap:
+            for header, payload in pcap.frames():
+                analyzer.process_frame(header, payload)
+        assert_that(pcap.closed).is_true()
+        assert_that(analyzer.frame_count).is_equal_to(len(sample_frames()))
+
+        # An analysis failing half way through doesn't leave the mapping open either.
+        try:
+            with PcapFile(path) as pcap:
+                for header, payload in pcap.frames():
+                    raise ValueError
+        except ValueError:
+            pass
+        assert_that(pcap.closed).is_true()
+
+        # A copy kept of a frame's buffer is a leak, not silently ignored.
+        pcap = PcapFile(path)
+        for header, payload in pcap.frames():
+            kept = payload[1:]
+            break
+        assert_that(pcap.close).raises(BufferError).when_called_with()
+        kept.release()
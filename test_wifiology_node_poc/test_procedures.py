@@ -0,0 +1,348 @@
+import contextlib
+import io
+import logging
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase
+from assertpy import assert_that
+
+from wifiology_node_poc.analysis import CaptureAnalyzer
+from wifiology_node_poc.core_sqlite import create_connection
+from wifiology_node_poc.queries.core import write_schema, select_all_measurements, \
+    select_stage_timings_for_measurement
+from wifiology_node_poc.capture_control import MIN_DATA_SNAPLEN
+from wifiology_node_poc.procedures import CapturePipeline, run_live_capture, find_capture_files, \
+    read_capture_manifest, run_ingest, capture_argument_parser, capture_argparse_args_to_kwargs, submit_in_order, \
+    write_timed_analysis_batch_to_database
+from wifiology_node_poc.stage_timing import StageTimingSummary, STAGE_LIVE_CAPTURE, STAGE_DB_WRITE, \
+    STAGE_OPTIMIZE_DB
+from test_wifiology_node_poc.test_analysis import sample_frames
+from test_wifiology_node_poc.test_pcap_file import pcap_bytes
+
+
+def analysis_data(start_time, channel=6):
+    analyzer = CaptureAnalyzer(channel)
+    for frame in sample_frames():
+        analyzer.process_frame(None, frame)
+    return analyzer.results(start_time, start_time + 10, 10)
+
+
+class CaptureArgumentsUnitTest(TestCase):
+    def kwargs(self, *args):
+        return capture_argparse_args_to_kwargs(capture_argument_parser.parse_args(["wlan0", "/tmp"] + list(args)))
+
+    def test_header_only_snaplen(self):
+        assert_that(self.kwargs()["data_snaplen"]).is_none()
+        assert_that(self.kwargs("--header-only")["data_snaplen"]).is_equal_to(64)
+        assert_that(
+            self.kwargs("--header-only", "--header-only-snaplen", str(MIN_DATA_SNAPLEN))["data_snaplen"]
+        ).is_equal_to(MIN_DATA_SNAPLEN)
+        with contextlib.redirect_stderr(io.StringIO()):
+            assert_that(self.kwargs).raises(SystemExit).when_called_with(
+                "--header-only", "--header-only-snaplen", str(MIN_DATA_SNAPLEN - 1)
+            )
+        # Not checked unless header only capture is on.
+        assert_that(self.kwargs("--header-only-snaplen", "0")["data_snaplen"]).is_none()
+
+
+class FakePcapHandle(object):
+    """
+    Non-blocking pcap handle whose selectable fd is a pipe, readable while frames are buffered.
+    """
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        os.set_blocking(self.read_fd, False)
+        self.lock = threading.Lock()
+        self.buffered = []
+        self.received = 0
+        self.dispatched = []
+        self.dumped = []
+        self.closed = False
+
+    def arrive(self, frames):
+        with self.lock:
+            self.buffered.extend(frames)
+            self.received += len(frames)
+            os.write(self.write_fd, b"x")
+
+    def getfd(self):
+        return self.read_fd
+
+    def dispatch(self, count, callback):
+        with self.lock:
+            try:
+                os.read(self.read_fd, 4096)
+            except BlockingIOError:
+                pass
+            frames, self.buffered = self.buffered, []
+        for frame in frames:
+            callback(None, frame)
+        self.dispatched.append(len(frames))
+        return len(frames)
+
+    def stats(self):
+        return self.received, 1, 0
+
+    def dump_open(self, capture_file):
+        handle = self
+
+        class Dumper(object):
+            def dump(self, hdr, data):
+                handle.dumped.append(data)
+
+            def close(self):
+                pass
+        return Dumper()
+
+    def close(self):
+        self.closed = True
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+
+class FakeCaptureInterface(object):
+    def __init__(self):
+        self.pcap_dev = FakePcapHandle()
+        self.switch_start_time = None
+
+    def pcap_handle(self, buffer_size, data_snaplen):
+        return self.pcap_dev
+
+
+class LiveCaptureUnitTest(TestCase):
+    def setUp(self):
+        self.capture_interface = FakeCaptureInterface()
+        self.pcap_dev = self.capture_interface.pcap_dev
+
+    def tearDown(self):
+        self.pcap_dev.close()
+
+    def test_timer_expiry(self):
+        self.capture_interface.switch_start_time = time.time()
+        start = time.monotonic()
+        start_time, end_time, duration, capture_stats = run_live_capture(
+            "wlan0", None, 0.1, capture_interface=self.capture_interface
+        )
+
+        assert_that(time.monotonic() - start).is_greater_than_or_equal_to(0.1)
+        assert_that(end_time - start_time).is_greater_than_or_equal_to(0.09)
+        assert_that(duration).is_equal_to(0.1)
+        assert_that(capture_stats).contains_entry({"frame_count": 0}, {"loop_wakeups": 1})
+        assert_that(capture_stats["channel_switch_seconds"]).is_greater_than_or_equal_to(0)
+        assert_that(self.capture_interface.switch_start_time).is_none()
+        # The handle belongs to the capture interface, which keeps it open across captures.
+        assert_that(self.pcap_dev.closed).is_false()
+
+    def test_dispatch_batching(self):
+        frames = sample_frames()
+        self.pcap_dev.arrive(frames[:2])
+        arrivals = threading.Timer(0.05, self.pcap_dev.arrive, (frames,))
+        arrivals.start()
+        received = []
+        try:
+            start_time, end_time, duration, capture_stats = run_live_capture(
+                "wlan0", "capture.pcap", 0.3, frame_callback=lambda hdr, data: received.append(data),
+                capture_interface=self.capture_interface
+            )
+        finally:
+            arrivals.join()
+
+        # Frames left from before the capture are flushed, the others are drained by a single dispatch call.
+        assert_that(capture_stats).contains_entry({"flushed_frame_count": 2}, {"frame_count": len(frames)})
+        assert_that(self.pcap_dev.dispatched).contains(len(frames))
+        assert_that(capture_stats["loop_wakeups"]).is_equal_to(2)
+        assert_that(received).is_equal_to(frames)
+        assert_that(self.pcap_dev.dumped).is_equal_to(frames)
+        # The pcap counters are counted from the start of the capture.
+        assert_that(capture_stats).contains_entry({"pcap_received": len(frames)}, {"pcap_dropped": 0})
+
+
+class TimedWriteUnitTest(TestCase):
+    def test_one_transaction(self):
+        connection = create_connection(":memory:")
+        write_schema(connection)
+        batch = [analysis_data(start_time) for start_time in (100.0, 200.0)]
+        for data in batch:
+            data["stage_timings"] = {STAGE_LIVE_CAPTURE: (10.0, 0.5)}
+        hook_calls = []
+        statements = []
+        connection.set_trace_callback(statements.append)
+        timing_summary = StageTimingSummary()
+        write_timed_analysis_batch_to_database(
+            connection, batch, timing_summary, transaction_hook=lambda t: hook_calls.append(t.in_transaction)
+        )
+        connection.set_trace_callback(None)
+
+        assert_that(hook_calls).is_equal_to([True])
+        assert_that([s for s in statements if s.startswith("BEGIN")]).is_length(1)
+        for data in batch:
+            stage_timings = select_stage_timings_for_measurement(connection, data["measurement"].measurement_id)
+            assert_that(stage_timings).contains_key(STAGE_LIVE_CAPTURE, STAGE_DB_WRITE)
+            # Only the summary gets the optimize_db that runs after the commit.
+            assert_that(stage_timings).does_not_contain_key(STAGE_OPTIMIZE_DB)
+        summary = timing_summary.percentiles()
+        assert_that(summary).contains_key(STAGE_DB_WRITE, STAGE_OPTIMIZE_DB)
+        assert_that(summary[STAGE_DB_WRITE]["count"]).is_equal_to(2)
+        connection.close()
+
+
+class CapturePipelineUnitTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.database_loc = os.path.join(self.tmp_dir.name, "test.db")
+        connection = create_connection(self.database_loc)
+        write_schema(connection)
+        connection.close()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def measurements(self):
+        connection = create_connection(self.database_loc)
+        try:
+            return sorted(select_all_measurements(connection), key=lambda m: m.measurement_start_time)
+        finally:
+            connection.close()
+
+    def write_capture_file(self, name):
+        capture_file = os.path.join(self.tmp_dir.name, name)
+        with open(capture_file, "wb") as f:
+            f.write(pcap_bytes(sample_frames()))
+        return capture_file
+
+    def test_write_stage_only(self):
+        pipeline = CapturePipeline(self.database_loc, analysis_workers=0, put_timeout_seconds=0.1).start()
+        for start_time in (100.0, 200.0, 300.0):
+            pipeline.submit_results(analysis_data(start_time))
+        assert_that(pipeline.submit).raises(ValueError).when_called_with("capture.pcap", 1.0, 2.0, 1, 6)
+        pipeline.close()
+
+        assert_that(pipeline.written_count).is_equal_to(3)
+        assert_that(pipeline.writer_thread.is_alive()).is_false()
+        assert_that([m.measurement_start_time for m in self.measurements()]).is_equal_to([100.0, 200.0, 300.0])
+
+    def test_analysis_stage(self):
+        capture_files = [self.write_capture_file("channel{0}-100.pcap".format(channel)) for channel in (1, 6)]
+        pipeline = CapturePipeline(self.database_loc, analysis_workers=2, put_timeout_seconds=0.1).start()
+        pipeline.submit(capture_files[0], 100.0, 110.0, 10, 1)
+        pipeline.submit(capture_files[1], 200.0, 210.0, 10, 6)
+        # Every submitted capture is analyzed and written before close returns.
+        pipeline.close()
+
+        assert_that(pipeline.written_count).is_equal_to(2)
+        assert_that([worker.is_alive() for worker in pipeline.analysis_workers]).does_not_contain(True)
+        assert_that([m.channel for m in self.measurements()]).is_equal_to([1, 6])
+        for capture_file in capture_files:
+            assert_that(os.path.exists(capture_file)).is_false()
+
+    def test_write_stage_failure(self):
+        pipeline = CapturePipeline(
+            self.database_loc, analysis_workers=0, queue_size=1, put_timeout_seconds=0.1
+        ).start()
+        pipeline.submit_results({})
+        pipeline.writer_thread.join(5)
+
+        assert_that(pipeline.writer_exception).is_instance_of(KeyError)
+        assert_that(pipeline.submit_results).raises(RuntimeError).when_called_with(analysis_data(100.0))
+        assert_that(pipeline.close).raises(RuntimeError).when_called_with()
+        assert_that(self.measurements()).is_empty()
+
+    def test_invalid_arguments(self):
+        assert_that(CapturePipeline).raises(ValueError).when_called_with(":memory:")
+        assert_that(CapturePipeline).raises(ValueError).when_called_with(self.database_loc, analysis_workers=-1)
+
+
+class IngestUnitTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.capture_dir = os.path.join(self.tmp_dir.name, "captures")
+        os.mkdir(self.capture_dir)
+        self.database_loc = os.path.join(self.tmp_dir.name, "test.db")
+        self.root_handlers = list(logging.getLogger('').handlers)
+
+    def tearDown(self):
+        # run_ingest adds its log handler to the root logger.
+        root_logger = logging.getLogger('')
+        for handler in list(root_logger.handlers):
+            if handler not in self.root_handlers:
+                root_logger.removeHandler(handler)
+                handler.close()
+        self.tmp_dir.cleanup()
+
+    def write_capture_file(self, name, data=None):
+        capture_file = os.path.join(self.capture_dir, name)
+        with open(capture_file, "wb") as f:
+            f.write(pcap_bytes(sample_frames()) if data is None else data)
+        return capture_file
+
+    def write_manifest(self, rows):
+        manifest = os.path.join(self.tmp_dir.name, "manifest.csv")
+        with open(manifest, "w") as f:
+            f.write("\n".join(rows) + "\n")
+        return manifest
+
+    def test_find_capture_files(self):
+        self.write_capture_file("channel11-200.5.pcap")
+        self.write_capture_file("channel1-100.pcap")
+        self.write_capture_file("survey.pcap")
+        self.write_capture_file("notes.txt")
+
+        assert_that(find_capture_files(self.capture_dir, 10)).is_equal_to([
+            (os.path.join(self.capture_dir, "channel1-100.pcap"), 1, 100.0, 110.0),
+            (os.path.join(self.capture_dir, "channel11-200.5.pcap"), 11, 200.5, 210.5),
+        ])
+
+    def test_read_capture_manifest(self):
+        manifest = self.write_manifest([
+            "file,channel,start_time,end_time",
+            "b.pcap,6,300,305",
+            "/archive/a.pcap,1,100,",
+        ])
+
+        assert_that(read_capture_manifest(manifest, self.capture_dir, 10)).is_equal_to([
+            ("/archive/a.pcap", 1, 100.0, 110.0),
+            (os.path.join(self.capture_dir, "b.pcap"), 6, 300.0, 305.0),
+        ])
+
+    def test_submit_in_order(self):
+        submitted = []
+
+        def call(value, offset=0):
+            submitted.append(value)
+            return value + offset
+
+        results = []
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            for arguments, future in submit_in_order(executor, call, [(i,) for i in range(10)], 3, offset=100):
+                # The yielded call plus at most 3 submitted ahead of it.
+                assert_that(len(submitted)).is_less_than_or_equal_to(arguments[0] + 4)
+                results.append(future.result())
+        assert_that(results).is_equal_to(list(range(100, 110)))
+
+    def test_run_ingest(self):
+        self.write_capture_file("a.pcap")
+        self.write_capture_file("b.pcap")
+        self.write_capture_file("truncated.pcap", pcap_bytes([])[:10])
+        manifest = self.write_manifest([
+            "file,channel,start_time,end_time",
+            "b.pcap,6,200,210",
+            "truncated.pcap,6,300,310",
+            "a.pcap,1,100,105",
+        ])
+        run_ingest(
+            self.capture_dir, self.database_loc, os.path.join(self.tmp_dir.name, "ingest.log"), False,
+            manifest=manifest, workers=2
+        )
+
+        # Captures that fail to analyze are skipped, the others are written in capture order.
+        connection = create_connection(self.database_loc)
+        try:
+            measurements = sorted(select_all_measurements(connection), key=lambda m: m.measurement_id)
+        finally:
+            connection.close()
+        assert_that([(m.channel, m.measurement_start_time, m.measurement_duration) for m in measurements]).is_equal_to(
+            [(1, 100.0, 5.0), (6, 200.0, 10.0)]
+        )
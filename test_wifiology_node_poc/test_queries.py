@@ -1,3 +1,4 @@
+import statistics
 from unittest import TestCase
 from assertpy import assert_that
 
@@ -12,11 +13,16 @@ from wifiology_node_poc.queries.core import write_schema, insert_measurement, \
     select_associated_mac_addresses_for_measurement_service_set, \
     select_infrastructure_mac_addresses_for_measurement_service_set, \
     select_measurements_that_need_upload, update_measurements_upload_status, update_service_set_network_name, \
-    delete_old_measurements
+    delete_old_measurements, select_table_column_names, select_data_counters_for_measurements, \
+    insert_jitter_measurement, select_channel_activity, insert_stage_timings, select_stage_timings_for_measurement, \
+    write_staging_schema, bulk_insert_measurement_stations, bulk_insert_service_sets, insert_jitter_measurements, \
+    bulk_insert_service_set_stations, bulk_update_service_set_network_names, \
+    select_jitter_measurements_by_measurement_id, select_station_ids, select_service_set_ids, \
+    delete_orphaned_stations, delete_orphaned_service_sets, select_schema_version, MIGRATIONS
 
 
 from wifiology_node_poc.queries.kv import kv_store_del, kv_store_get, kv_store_get_all, kv_store_set, kv_store_get_prefix
-from wifiology_node_poc.models import Measurement, Station, ServiceSet, DataCounters
+from wifiology_node_poc.models import Measurement, Station, ServiceSet, DataCounters, ServiceSetJitterMeasurement
 
 
 class QueriesUnitTest(TestCase):
@@ -64,6 +70,10 @@ class QueriesUnitTest(TestCase):
         assert_that(left.measurement_duration).is_equal_to(right.measurement_duration)
         assert_that(left.channel).is_equal_to(right.channel)
         assert_that(left.extra_data).is_equal_to(right.extra_data)
+        assert_that(left.pcap_received).is_equal_to(right.pcap_received)
+        assert_that(left.pcap_dropped).is_equal_to(right.pcap_dropped)
+        assert_that(left.pcap_interface_dropped).is_equal_to(right.pcap_interface_dropped)
+        assert_that(left.channel_switch_seconds).is_equal_to(right.channel_switch_seconds)
 
         if check_data_counters:
             cls.assert_data_counters_equal(left.data_counters, right.data_counters)
@@ -131,6 +141,75 @@ class QueriesUnitTest(TestCase):
         assert_that(count).is_equal_to(2)
         assert_that(select_all_measurements(self.connection, limit=500, offset=0)).is_empty()
 
+    def test_measurement_pcap_counters(self):
+        new_measurement = Measurement.new(
+            1.0, 2.0, 1.0, 6, [], pcap_received=1000, pcap_dropped=12, pcap_interface_dropped=0,
+            channel_switch_seconds=0.025
+        )
+        with transaction_wrapper(self.connection) as t:
+            new_measurement.measurement_id = insert_measurement(t, new_measurement)
+
+        stored_measurement = select_measurement_by_id(self.connection, new_measurement.measurement_id)
+        self.assert_measurements_equal(new_measurement, stored_measurement)
+        assert_that(stored_measurement.to_api_response()).contains_entry(
+            {'pcapReceived': 1000}, {'pcapDropped': 12}, {'pcapInterfaceDropped': 0}, {'channelSwitchSeconds': 0.025}
+        )
+
+    def test_write_schema_adds_missing_columns(self):
+        legacy_connection = create_connection(":memory:")
+        legacy_connection.execute(
+            """
+            CREATE TABLE measurement(
+              measurementID INTEGER PRIMARY KEY,
+              measurementStartTime REAL NOT NULL,
+              measurementEndTime REAL NOT NULL,
+              measurementDuration REAL NOT NULL,
+              channel INTEGER NOT NULL,
+              averageNoise REAL,
+              stdDevNoise REAL,
+              hasBeenUploaded BOOLEAN NOT NULL DEFAULT 0,
+              extraJSONData TEXT NOT NULL DEFAULT '{}'
+            )
+            """
+        )
+        try:
+            write_schema(legacy_connection)
+            assert_that(select_table_column_names(legacy_connection, "measurement")).contains(
+                "pcapReceived", "pcapDropped", "pcapInterfaceDropped", "channelSwitchSeconds"
+            )
+            with transaction_wrapper(legacy_connection) as t:
+                measurement_id = insert_measurement(t, Measurement.new(1.0, 2.0, 1.0, 6, [], pcap_dropped=3))
+            assert_that(select_measurement_by_id(legacy_connection, measurement_id).pcap_dropped).is_equal_to(3)
+        finally:
+            legacy_connection.close()
+
+    def test_write_schema_migrations(self):
+        assert_that(select_schema_version(self.connection)).is_equal_to(len(MIGRATIONS))
+
+        applied = []
+
+        def add_rollup_table(transaction):
+            applied.append(select_schema_version(transaction))
+            transaction.execute("CREATE TABLE rollup(rollupID INTEGER PRIMARY KEY)")
+
+        def failing_migration(transaction):
+            transaction.execute("CREATE TABLE halfDone(halfDoneID INTEGER PRIMARY KEY)")
+            raise ValueError("Migration failed")
+
+        migrations = MIGRATIONS + [add_rollup_table]
+        write_schema(self.connection, migrations)
+        write_schema(self.connection, migrations)
+        assert_that(applied).is_equal_to([len(MIGRATIONS)])
+        assert_that(select_schema_version(self.connection)).is_equal_to(len(migrations))
+        assert_that(select_table_column_names(self.connection, "rollup")).is_equal_to({"rollupID"})
+
+        # A failed step leaves neither its changes nor a version bump behind.
+        assert_that(write_schema).raises(ValueError).when_called_with(
+            self.connection, migrations + [failing_migration]
+        )
+        assert_that(select_schema_version(self.connection)).is_equal_to(len(migrations))
+        assert_that(select_table_column_names(self.connection, "halfDone")).is_empty()
+
     def test_station_crud(self):
         new_station = Station.new(
             "01:02:03:04:05:06", {"foo": [1, 2, 3], "bar": [4, 5, 6]}
@@ -323,6 +402,199 @@ class QueriesUnitTest(TestCase):
         self.assert_stations_equal(new_station_2, stations[1])
         self.assert_data_counters_equal(my_counter, stations[1].data_counters)
 
+    def insert_station_counters(self, counters_by_mac):
+        with transaction_wrapper(self.connection) as t:
+            measurement_id = insert_measurement(t, Measurement.new(1.0, 2.0, 1.0, 6, []))
+            for mac_address, counters in counters_by_mac.items():
+                station_id = insert_station(t, Station.new(mac_address, {}))
+                insert_measurement_station(t, measurement_id, station_id, counters)
+        return measurement_id
+
+    def test_measurement_data_counters_power_rollup(self):
+        near_powers, far_powers = [-30, -32, -34, -31], [-80, -85]
+        near, far = DataCounters.zero(), DataCounters.zero()
+        for power in near_powers:
+            near.add_power_measurement(power)
+        for power in far_powers:
+            far.add_power_measurement(power)
+        measurement_id = self.insert_station_counters({"01:02:03:04:05:06": near, "01:02:03:04:05:07": far})
+
+        data_counters = select_data_counters_for_measurements(self.connection, [measurement_id])[measurement_id]
+        assert_that(data_counters.power_statistics.count).is_equal_to(6)
+        assert_that(data_counters.average_power).is_close_to(statistics.mean(near_powers + far_powers), 1e-9)
+        assert_that(data_counters.std_dev_power).is_close_to(statistics.stdev(near_powers + far_powers), 1e-9)
+
+        stations = select_stations_for_measurement(self.connection, measurement_id)
+        rollup = stations[0].data_counters + stations[1].data_counters
+        assert_that(rollup.average_power).is_close_to(data_counters.average_power, 1e-9)
+        assert_that(rollup.std_dev_power).is_close_to(data_counters.std_dev_power, 1e-9)
+
+    def test_measurement_data_counters_legacy_power_rollup(self):
+        # Rows written before the power sums were stored only have the average and standard deviation.
+        legacy = {
+            "01:02:03:04:05:06": DataCounters(0, 0, 0, 0, 0, 0, 0, 0, 2, 0, 0, 0, average_power=-30.0,
+                                              std_dev_power=0.0),
+            "01:02:03:04:05:07": DataCounters(0, 0, 0, 0, 0, 0, 0, 0, 2, 0, 0, 0, average_power=-80.0,
+                                              std_dev_power=0.0)
+        }
+        measurement_id = self.insert_station_counters(legacy)
+
+        data_counters = select_data_counters_for_measurements(self.connection, [measurement_id])[measurement_id]
+        assert_that(data_counters.power_statistics.count).is_equal_to(0)
+        assert_that(data_counters.average_power).is_equal_to(-55.0)
+        assert_that(data_counters.std_dev_power).is_close_to(statistics.stdev([-30, -30, -80, -80]), 1e-9)
+
+    def test_measurement_data_counters_mixed_power_rollup(self):
+        exact = DataCounters.zero()
+        exact.data_frame_count = 2
+        for power in (-30, -30):
+            exact.add_power_measurement(power)
+        legacy = DataCounters(0, 0, 0, 0, 0, 0, 0, 0, 2, 0, 0, 0, average_power=-80.0, std_dev_power=0.0)
+        measurement_id = self.insert_station_counters({"01:02:03:04:05:06": exact, "01:02:03:04:05:07": legacy})
+
+        # Estimated from the averages, and not passed off as exact sums.
+        data_counters = select_data_counters_for_measurements(self.connection, [measurement_id])[measurement_id]
+        assert_that(data_counters.power_statistics_estimated).is_true()
+        assert_that(data_counters.average_power).is_equal_to(-55.0)
+        assert_that(data_counters.to_row()['powerCount']).is_none()
+
+    def test_staging_schema_once_per_connection(self):
+        statements = []
+        self.connection.set_trace_callback(statements.append)
+        write_staging_schema(self.connection)
+        self.connection.execute("BEGIN")
+        # Neither runs the script again nor commits the open transaction.
+        write_staging_schema(self.connection)
+        assert_that(self.connection.in_transaction).is_true()
+        self.connection.rollback()
+        self.connection.set_trace_callback(None)
+        assert_that([s for s in statements if "CREATE TEMP TABLE" in s]).is_length(4)
+
+        connection = create_connection(":memory:")
+        write_staging_schema(connection)
+        assert_that(connection.execute("SELECT COUNT(*) FROM stagingStation").fetchone()[0]).is_equal_to(0)
+        connection.close()
+
+    def test_bulk_writes(self):
+        write_staging_schema(self.connection)
+        counters = DataCounters.zero()
+        counters.data_frame_count, counters.data_throughput_out = 4, 1200
+        with transaction_wrapper(self.connection) as t:
+            known_station_id = insert_station(t, Station.new("01:02:03:04:05:06", {}))
+            known_service_set_id = insert_service_set(t, ServiceSet.new("0a:00:00:00:00:01", network_name="old"))
+
+        for _ in range(2):
+            stations = [Station.new("01:02:03:04:05:06", {}), Station.new("01:02:03:04:05:07", {})]
+            service_sets = [ServiceSet.new("0a:00:00:00:00:01"), ServiceSet.new("0a:00:00:00:00:02", "net2")]
+            with transaction_wrapper(self.connection) as t:
+                measurement_id = insert_measurement(t, Measurement.new(1.0, 2.0, 1.0, 6, []))
+                bulk_insert_measurement_stations(
+                    t, measurement_id, stations, {station.mac_address: counters for station in stations}
+                )
+                bulk_insert_service_sets(t, service_sets)
+                insert_jitter_measurements(t, [ServiceSetJitterMeasurement.new(
+                    measurement_id, service_sets[1].service_set_id, [0.1, 0.2], 0.1024, include_histogram=False
+                )])
+                bulk_insert_service_set_stations(
+                    t, measurement_id, {"0a:00:00:00:00:01": {"01:02:03:04:05:06", "01:02:03:04:05:07"}},
+                    {"0a:00:00:00:00:02": {"01:02:03:04:05:07"}, "0a:00:00:00:00:03": {"01:02:03:04:05:06"}}
+                )
+                bulk_update_service_set_network_names(t, {"0a:00:00:00:00:01": "new", "0a:00:00:00:00:02": "net2"})
+
+            assert_that(stations[0].station_id).is_equal_to(known_station_id)
+            assert_that(service_sets[0].service_set_id).is_equal_to(known_service_set_id)
+            measurement_stations = select_stations_for_measurement(self.connection, measurement_id)
+            assert_that([station.station_id for station in measurement_stations]).is_equal_to(
+                [station.station_id for station in stations]
+            )
+            self.assert_data_counters_equal(counters, measurement_stations[1].data_counters)
+            assert_that(sorted(select_infrastructure_mac_addresses_for_measurement_service_set(
+                self.connection, measurement_id, known_service_set_id
+            ))).is_equal_to(["01:02:03:04:05:06", "01:02:03:04:05:07"])
+            assert_that(select_associated_mac_addresses_for_measurement_service_set(
+                self.connection, measurement_id, service_sets[1].service_set_id
+            )).is_equal_to(["01:02:03:04:05:07"])
+            assert_that(select_jitter_measurements_by_measurement_id(self.connection, measurement_id)).is_length(1)
+
+        assert_that(select_all_stations(self.connection)).is_length(2)
+        assert_that({service_set.bssid: service_set.network_name for service_set in select_all_service_sets(
+            self.connection
+        )}).is_equal_to({"0a:00:00:00:00:01": "new", "0a:00:00:00:00:02": "net2"})
+
+    def test_bulk_writes_with_known_ids(self):
+        write_staging_schema(self.connection)
+        with transaction_wrapper(self.connection) as t:
+            station_id = insert_station(t, Station.new("01:02:03:04:05:06", {}))
+            service_set_id = insert_service_set(t, ServiceSet.new("0a:00:00:00:00:01"))
+            measurement_id = insert_measurement(t, Measurement.new(1.0, 2.0, 1.0, 6, []))
+            stations = [Station(station_id, "01:02:03:04:05:06", {}), Station.new("01:02:03:04:05:07", {})]
+            bulk_insert_measurement_stations(
+                t, measurement_id, stations, {station.mac_address: DataCounters.zero() for station in stations}
+            )
+            bulk_insert_service_sets(t, [ServiceSet(service_set_id, "0a:00:00:00:00:01", None, {})])
+
+        assert_that(stations[1].station_id).is_not_none().is_not_equal_to(station_id)
+        assert_that(select_station_ids(self.connection)).is_equal_to(
+            [("01:02:03:04:05:07", stations[1].station_id), ("01:02:03:04:05:06", station_id)]
+        )
+        assert_that(select_station_ids(self.connection, limit=1)).is_length(1)
+        assert_that(select_service_set_ids(self.connection)).is_equal_to([("0a:00:00:00:00:01", service_set_id)])
+        assert_that(
+            [station.station_id for station in select_stations_for_measurement(self.connection, measurement_id)]
+        ).is_equal_to([station_id, stations[1].station_id])
+
+    def test_delete_orphans(self):
+        with transaction_wrapper(self.connection) as t:
+            kept_station_id = insert_station(t, Station.new("01:02:03:04:05:06", {}))
+            insert_station(t, Station.new("01:02:03:04:05:07", {}))
+            kept_service_set_id = insert_service_set(t, ServiceSet.new("0a:00:00:00:00:01"))
+            insert_service_set(t, ServiceSet.new("0a:00:00:00:00:02"))
+            measurement_id = insert_measurement(t, Measurement.new(1.0, 2.0, 1.0, 6, []))
+            insert_measurement_station(t, measurement_id, kept_station_id, DataCounters.zero())
+            insert_service_set_infrastructure_station(t, measurement_id, "0a:00:00:00:00:01", "01:02:03:04:05:06")
+
+        with transaction_wrapper(self.connection) as t:
+            assert_that(delete_orphaned_stations(t)).is_equal_to(1)
+            assert_that(delete_orphaned_service_sets(t)).is_equal_to(1)
+        assert_that(select_station_ids(self.connection)).is_equal_to([("01:02:03:04:05:06", kept_station_id)])
+        assert_that(select_service_set_ids(self.connection)).is_equal_to([("0a:00:00:00:00:01", kept_service_set_id)])
+
+    def test_stage_timings(self):
+        stage_timings = {"live_capture": (10.01, 0.5), "db_write": (0.02, 0.015), "sweep_latency": (121.5, None)}
+        with transaction_wrapper(self.connection) as t:
+            measurement_id = insert_measurement(t, Measurement.new(1.0, 2.0, 1.0, 6, []))
+            insert_stage_timings(t, measurement_id, stage_timings)
+        assert_that(select_stage_timings_for_measurement(self.connection, measurement_id)).is_equal_to(stage_timings)
+
+        with transaction_wrapper(self.connection) as t:
+            delete_old_measurements(t, 1)
+        assert_that(select_stage_timings_for_measurement(self.connection, measurement_id)).is_empty()
+
+    def test_channel_activity(self):
+        counters = DataCounters.zero()
+        counters.management_frame_count, counters.control_frame_count, counters.data_frame_count = 3, 2, 5
+        with transaction_wrapper(self.connection) as t:
+            station_id = insert_station(t, Station.new("01:02:03:04:05:06", {}))
+            other_station_id = insert_station(t, Station.new("01:02:03:04:05:07", {}))
+            service_set_id = insert_service_set(t, ServiceSet.new("01:02:03:04:05:06"))
+            for start_time, channel in ((1.0, 1), (100.0, 1), (110.0, 1), (120.0, 6)):
+                measurement_id = insert_measurement(
+                    t, Measurement.new(start_time, start_time + 5, 5.0, channel, [])
+                )
+                insert_measurement_station(t, measurement_id, station_id, counters)
+                if channel == 1:
+                    insert_measurement_station(t, measurement_id, other_station_id, counters)
+                    insert_jitter_measurement(t, ServiceSetJitterMeasurement.new(
+                        measurement_id, service_set_id, [0.1, 0.2], 0.1024, include_histogram=False
+                    ))
+
+        activity = select_channel_activity(self.connection, 50.0)
+        assert_that(activity).is_equal_to({
+            1: {"channel": 1, "totalDuration": 10.0, "frameCount": 40, "stationCount": 2, "serviceSetCount": 1},
+            6: {"channel": 6, "totalDuration": 5.0, "frameCount": 10, "stationCount": 1, "serviceSetCount": 0}
+        })
+        assert_that(select_channel_activity(self.connection, 500.0)).is_empty()
+
     def test_measurement_service_set(self):
         new_measurement = Measurement.new(
             1.0, 2.0, 0.9, 1, 
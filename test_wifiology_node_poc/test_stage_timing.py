@@ -0,0 +1,54 @@
+import time
+from unittest import TestCase
+from assertpy import assert_that
+
+from wifiology_node_poc.stage_timing import StageTimer, StageTimingSummary, percentile, STAGE_LIVE_CAPTURE, \
+    STAGE_DB_WRITE, SWEEP_LATENCY
+
+
+class StageTimingUnitTest(TestCase):
+    def test_stage_timer(self):
+        stage_timer = StageTimer()
+        with stage_timer.stage(STAGE_LIVE_CAPTURE):
+            time.sleep(0.01)
+        with stage_timer.stage(STAGE_DB_WRITE):
+            sum(range(100000))
+        wall_seconds, cpu_seconds = stage_timer.timings[STAGE_LIVE_CAPTURE]
+        assert_that(wall_seconds).is_greater_than_or_equal_to(0.01)
+        # Sleeping takes no CPU time.
+        assert_that(cpu_seconds).is_less_than(wall_seconds)
+        assert_that(stage_timer.timings[STAGE_DB_WRITE][1]).is_greater_than(0)
+
+        with stage_timer.stage(STAGE_LIVE_CAPTURE):
+            time.sleep(0.01)
+        assert_that(stage_timer.timings[STAGE_LIVE_CAPTURE][0]).is_greater_than_or_equal_to(0.02)
+
+        try:
+            with stage_timer.stage("failing"):
+                raise ValueError
+        except ValueError:
+            pass
+        assert_that(stage_timer.timings).contains_key("failing")
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        assert_that(percentile(values, 50)).is_equal_to(50)
+        assert_that(percentile(values, 99)).is_equal_to(99)
+        assert_that(percentile([3.0], 90)).is_equal_to(3.0)
+
+    def test_summary(self):
+        summary = StageTimingSummary(window_size=10)
+        for i in range(20):
+            stage_timer = StageTimer()
+            stage_timer.record(STAGE_LIVE_CAPTURE, float(i), i / 10.0)
+            stage_timer.record(SWEEP_LATENCY, 100.0 + i)
+            summary.record(stage_timer.timings)
+
+        percentiles = summary.percentiles()
+        assert_that(percentiles[STAGE_LIVE_CAPTURE]).is_equal_to({
+            "count": 10,
+            "wall": {"p50": 14.0, "p90": 18.0, "p99": 19.0, "max": 19.0},
+            "cpu": {"p50": 1.4, "p90": 1.8, "p99": 1.9, "max": 1.9}
+        })
+        assert_that(percentiles[SWEEP_LATENCY]).does_not_contain_key("cpu")
+        assert_that(percentiles[SWEEP_LATENCY]["wall"]["max"]).is_equal_to(119.0)
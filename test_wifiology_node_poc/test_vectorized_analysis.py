@@ -0,0 +1,199 @@
+import math
+import struct
+from unittest import TestCase
+from assertpy import assert_that
+
+from scapy.all import raw, Raw
+from scapy.layers.dot11 import Dot11
+
+from wifiology_node_poc.analysis import CaptureAnalyzer
+from wifiology_node_poc.decoders import DecodeError, parse_radiotap, parse_dot11_header, FCS_LENGTH, CTL_TYPE
+from wifiology_node_poc.vectorized_analysis import VectorizedCaptureAnalyzer, decode_frames, NO_MAC
+from test_wifiology_node_poc.test_analysis import AP_MAC, CLIENT_MAC, REMOTE_MAC, radiotap_header, beacon_frame, \
+    sample_frames
+
+FCS = b'\x00' * 4
+MALFORMED_AP_MAC = "de:ad:be:ef:00:02"
+
+
+def mixed_frames():
+    return sample_frames() + [
+        raw(radiotap_header(signal=-70, rate=6) / Dot11(type=1, subtype=11, addr1=AP_MAC, addr2=CLIENT_MAC)) + FCS,
+        raw(radiotap_header(flags='FCS+badFCS') / Dot11(type=1, subtype=12, addr1=CLIENT_MAC)) + FCS,
+        raw(radiotap_header(signal=-65) / Dot11(type=1, subtype=9, addr1=CLIENT_MAC, addr2=AP_MAC)) + FCS,
+        raw(radiotap_header(signal=-45, rate=54) /
+            Dot11(type=2, subtype=0, FCfield='from_DS+retry', addr1=CLIENT_MAC, addr2=AP_MAC, addr3=REMOTE_MAC) /
+            Raw(b'y' * 60)) + FCS,
+        raw(radiotap_header() / Dot11(type=0, subtype=4, addr1='ff:ff:ff:ff:ff:ff', addr2=CLIENT_MAC,
+                                      addr3='ff:ff:ff:ff:ff:ff')) + FCS,
+        raw(radiotap_header() / Dot11(type=0, subtype=0, addr1=AP_MAC, addr2=CLIENT_MAC, addr3=AP_MAC)) + FCS,
+        b'\x00\x00\x08\x00\x00\x00\x00\x00\x01',
+    ]
+
+
+def malformed_beacon_frame():
+    # A truncated body, so the beacon's fixed fields fail to decode.
+    return raw(
+        radiotap_header(signal=-30, rate=54, flags='FCS+badFCS') /
+        Dot11(type=0, subtype=8, FCfield='retry', addr1='ff:ff:ff:ff:ff:ff', addr2=MALFORMED_AP_MAC,
+              addr3=MALFORMED_AP_MAC) /
+        Raw(b'\x00' * 4)
+    ) + FCS
+
+
+def extended_radiotap_frame():
+    # TSFT, Flags and dBm_AntSignal after a second present word, so TSFT is aligned past 4 bytes of padding.
+    present = (1 << 31) | 0b100011
+    radiotap = struct.pack('<BBHII', 0, 0, 26, present, 0) + b'\x00' * 4 + b'\x01' * 8 + bytes([0x10, 0xc4])
+    return radiotap + raw(
+        Dot11(type=2, subtype=8, FCfield='to_DS+from_DS+order', addr1=AP_MAC, addr2=CLIENT_MAC, addr3=REMOTE_MAC,
+              addr4=MALFORMED_AP_MAC) / Raw(b'z' * 40)
+    ) + FCS
+
+
+def varied_frames():
+    frames = mixed_frames() + [
+        extended_radiotap_frame(),
+        raw(radiotap_header(flags=0) / Dot11(type=0, subtype=13, FCfield='order', addr1=AP_MAC, addr2=CLIENT_MAC,
+                                             addr3=AP_MAC) / Raw(b'a' * 10)),
+        raw(radiotap_header() / Dot11(type=3, subtype=0, addr1=AP_MAC)) + FCS,
+        b'\x01' + raw(radiotap_header() / Dot11(type=1, subtype=13, addr1=AP_MAC))[1:],
+    ]
+    # Cut short at every few bytes, to go through every bounds check.
+    return frames + [frame[:length] for frame in frames for length in range(0, len(frame), 3)]
+
+
+class VectorizedAnalysisUnitTest(TestCase):
+    def analyze(self, analyzer_class, frames, **kwargs):
+        analyzer = analyzer_class(6, **kwargs)
+        for frame in frames:
+            analyzer.process_frame(None, frame)
+        return analyzer.results(1.0, 2.0, 1)
+
+    def assert_matches_capture_analyzer(self, frames, **kwargs):
+        expected = self.analyze(CaptureAnalyzer, frames)
+        results = self.analyze(VectorizedCaptureAnalyzer, frames, **kwargs)
+
+        assert_that(results['measurement'].to_row()).is_equal_to(expected['measurement'].to_row())
+        assert_that(results['station_counters']).is_length(len(expected['station_counters']))
+        for mac, counters in expected['station_counters'].items():
+            row = results['station_counters'][mac].to_row()
+            for key, value in counters.to_row().items():
+                if isinstance(value, float):
+                    assert_that(row[key]).is_close_to(value, 1e-9)
+                else:
+                    assert_that(row[key]).is_equal_to(value)
+        for key in ('bssid_infra_macs', 'bssid_associated_macs', 'bssid_to_ssid_map', 'bssid_to_power_map',
+                    'bssid_to_jitter_map'):
+            assert_that(results[key]).is_equal_to(expected[key])
+        assert_that(sorted(s.mac_address for s in results['stations'])).is_equal_to(
+            sorted(s.mac_address for s in expected['stations'])
+        )
+
+    def test_matches_capture_analyzer(self):
+        self.assert_matches_capture_analyzer(mixed_frames())
+
+    def test_matches_capture_analyzer_with_malformed_beacon(self):
+        frames = mixed_frames() + [malformed_beacon_frame()]
+        self.assert_matches_capture_analyzer(frames)
+
+        malformed_ap = self.analyze(VectorizedCaptureAnalyzer, frames)['station_counters'][MALFORMED_AP_MAC]
+        assert_that(malformed_ap.management_frame_count).is_equal_to(1)
+        assert_that(malformed_ap.retry_frame_count).is_equal_to(0)
+        assert_that(malformed_ap.failed_fcs_count).is_equal_to(0)
+        assert_that(malformed_ap.average_power).is_none()
+
+    def test_matches_capture_analyzer_with_varied_frames(self):
+        self.assert_matches_capture_analyzer(varied_frames())
+
+    def test_aggregates_in_blocks(self):
+        frames = (mixed_frames() + [malformed_beacon_frame()]) * 3
+        self.assert_matches_capture_analyzer(frames, block_size=4)
+
+        analyzer = VectorizedCaptureAnalyzer(6, block_size=4)
+        for frame in frames:
+            analyzer.process_frame(None, frame)
+            assert_that(analyzer.frame_ends).is_length(len(analyzer.frame_ends) % 4)
+        partial = analyzer.partial()
+        assert_that(partial.block).is_empty()
+        assert_that(partial.frame_ends).is_empty()
+        assert_that(VectorizedCaptureAnalyzer).raises(ValueError).when_called_with(6, block_size=0)
+
+    def test_decode_frames_matches_decoders(self):
+        frames = varied_frames()
+        ends = [sum(len(frame) for frame in frames[:i + 1]) for i in range(len(frames))]
+        decoded = decode_frames(b''.join(frames), [0] + ends[:-1], ends)
+
+        def measurement(value):
+            return None if math.isnan(value) else value
+
+        for i, frame in enumerate(frames):
+            try:
+                radiotap = parse_radiotap(frame)
+            except DecodeError:
+                assert_that(bool(decoded.radiotap_decoded[i])).is_false()
+                assert_that(bool(decoded.decoded[i])).is_false()
+                continue
+            assert_that(bool(decoded.radiotap_decoded[i])).is_true()
+            assert_that(measurement(decoded.signal[i])).is_equal_to(radiotap.antenna_signal)
+            assert_that(measurement(decoded.noise[i])).is_equal_to(radiotap.antenna_noise)
+            assert_that(measurement(decoded.rate[i])).is_equal_to(radiotap.rate)
+            assert_that(decoded.bad_fcs[i]).is_equal_to(-1 if radiotap.bad_fcs is None else int(radiotap.bad_fcs))
+            frame_end = len(frame) - FCS_LENGTH if radiotap.has_fcs else len(frame)
+            try:
+                header = parse_dot11_header(frame, radiotap.length, frame_end)
+            except DecodeError:
+                assert_that(bool(decoded.decoded[i])).is_false()
+                continue
+            assert_that(bool(decoded.decoded[i])).is_true()
+            fields = header._replace(addr2=NO_MAC if header.addr2 is None else header.addr2,
+                                     addr3=NO_MAC if header.addr3 is None else header.addr3)
+            if header.frame_type == CTL_TYPE:
+                # Control frame bodies aren't used.
+                fields = fields._replace(body_offset=None, body_length=None)
+            assert_that(tuple(
+                None if fields[j] is None else int(getattr(decoded, name)[i]) for j, name in enumerate(fields._fields)
+            )).is_equal_to(tuple(fields))
+        assert_that(sum(decoded.decoded.tolist())).is_greater_than(len(mixed_frames()))
+
+    def test_counts_by_station(self):
+        results = self.analyze(VectorizedCaptureAnalyzer, mixed_frames())
+
+        client = results['station_counters'][CLIENT_MAC]
+        assert_that(client.data_frame_count).is_equal_to(2)
+        assert_that(client.data_throughput_in).is_equal_to(60)
+        assert_that(client.management_frame_count).is_equal_to(2)
+        assert_that(client.association_frame_count).is_equal_to(1)
+        assert_that(client.ack_frame_count).is_equal_to(1)
+        assert_that(client.rts_frame_count).is_equal_to(1)
+        assert_that(client.cts_frame_count).is_equal_to(1)
+        assert_that(client.failed_fcs_count).is_equal_to(0)
+        assert_that(results['bssid_associated_macs'][AP_MAC]).is_equal_to({CLIENT_MAC})
+        assert_that(results['measurement'].extra_data['weird_frame_count']).is_equal_to(1)
+
+    def test_merge(self):
+        frames = mixed_frames()
+        expected = self.analyze(CaptureAnalyzer, frames)
+        merged = VectorizedCaptureAnalyzer(6)
+        for chunk in (frames[:5], frames[5:]):
+            analyzer = VectorizedCaptureAnalyzer(6)
+            for frame in chunk:
+                analyzer.process_frame(None, frame)
+            merged.merge(analyzer.partial())
+        results = merged.results(1.0, 2.0, 1)
+
+        assert_that(results['measurement'].to_row()).is_equal_to(expected['measurement'].to_row())
+        assert_that(results['bssid_infra_macs']).is_equal_to(expected['bssid_infra_macs'])
+        assert_that(results['bssid_to_jitter_map']).is_equal_to(expected['bssid_to_jitter_map'])
+        for mac, counters in expected['station_counters'].items():
+            assert_that(results['station_counters'][mac].data_frame_count).is_equal_to(counters.data_frame_count)
+            assert_that(results['station_counters'][mac].average_power).is_close_to(counters.average_power, 1e-9)
+
+    def test_empty(self):
+        results = self.analyze(VectorizedCaptureAnalyzer, [])
+        assert_that(results['stations']).is_empty()
+        assert_that(results['measurement'].average_noise).is_none()
+
+    def test_keep_samples_unsupported(self):
+        assert_that(VectorizedCaptureAnalyzer).raises(ValueError).when_called_with(6, keep_samples=True)
+        assert_that(self.analyze(VectorizedCaptureAnalyzer, [beacon_frame(1000)])['service_sets']).is_length(1)
@@ -0,0 +1,129 @@
+import os
+import tempfile
+import threading
+from unittest import TestCase
+from assertpy import assert_that
+
+from wifiology_node_poc.core_sqlite import create_connection, transaction_wrapper
+from wifiology_node_poc.queries.kv import kv_store_get
+from wifiology_node_poc.queries.core import write_schema
+from wifiology_node_poc.write_behind import WriteBehindWriter
+
+
+class WriteBehindUnitTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.database_loc = os.path.join(self.tmp_dir.name, "test.db")
+        self.journal_dir = os.path.join(self.tmp_dir.name, "journal")
+        connection = create_connection(self.database_loc)
+        write_schema(connection)
+        connection.execute("CREATE TABLE written(value INTEGER)")
+        connection.close()
+        self.batches = []
+        self.release = threading.Event()
+        self.fail = False
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write_batch(self, db_conn, batch, transaction_hook):
+        self.release.wait()
+        if self.fail:
+            raise ValueError("Write failed")
+        with transaction_wrapper(db_conn) as t:
+            t.executemany("INSERT INTO written(value) VALUES (?)", [(value,) for value in batch])
+            if transaction_hook is not None:
+                transaction_hook(t)
+        self.batches.append(batch)
+
+    def written(self):
+        connection = create_connection(self.database_loc)
+        try:
+            return [r["value"] for r in connection.execute("SELECT value FROM written ORDER BY rowid")]
+        finally:
+            connection.close()
+
+    def test_batches_in_order(self):
+        writer = WriteBehindWriter(self.database_loc, self.write_batch, queue_size=10, max_batch_size=3).start()
+        for value in range(7):
+            writer.submit(value)
+        assert_that(writer.stats()["queue_depth"]).is_equal_to(7)
+        self.release.set()
+        writer.close()
+
+        assert_that(self.written()).is_equal_to(list(range(7)))
+        # The first batch may have been taken before everything was submitted.
+        assert_that(max(len(batch) for batch in self.batches)).is_equal_to(3)
+        stats = writer.stats()
+        assert_that(stats).contains_entry({"queue_depth": 0}, {"written": 7})
+        assert_that(stats["commit_latency_seconds"]).contains_key("p50", "p90", "p99", "max")
+
+    def test_backpressure(self):
+        heartbeats = []
+
+        def heartbeat_func():
+            heartbeats.append(1)
+            self.release.set()
+
+        writer = WriteBehindWriter(
+            self.database_loc, self.write_batch, queue_size=1, heartbeat_func=heartbeat_func, put_timeout_seconds=0.01
+        ).start()
+        writer.submit(1)
+        # Blocks until the writer made room, which it only does once the heartbeat released it.
+        writer.submit(2)
+        assert_that(heartbeats).is_not_empty()
+        writer.close()
+        assert_that(self.written()).is_equal_to([1, 2])
+
+    def test_journal_replay(self):
+        self.fail = True
+        writer = WriteBehindWriter(
+            self.database_loc, self.write_batch, queue_size=1, max_batch_size=2, journal_dir=self.journal_dir
+        ).start()
+        for value in range(4):
+            writer.submit(value)
+        stats = writer.stats()
+        assert_that(stats["queue_depth"]).is_equal_to(4)
+        # Only the first capture was kept in memory, the writer may have read the second one back for its batch.
+        assert_that(stats["journaled_only"]).is_between(2, 3)
+        self.release.set()
+        assert_that(writer.close).raises(RuntimeError).when_called_with()
+        assert_that(sorted(os.listdir(self.journal_dir))).is_length(4)
+
+        # The next start writes the journaled captures first, in order, and doesn't write them twice.
+        self.fail = False
+        writer = WriteBehindWriter(
+            self.database_loc, self.write_batch, max_batch_size=2, journal_dir=self.journal_dir
+        ).start()
+        writer.submit(4)
+        writer.close()
+        assert_that(self.written()).is_equal_to([0, 1, 2, 3, 4])
+        assert_that(os.listdir(self.journal_dir)).is_empty()
+        connection = create_connection(self.database_loc)
+        assert_that(kv_store_get(connection, writer.sequence_key)).is_equal_to(4)
+        connection.close()
+
+        writer = WriteBehindWriter(self.database_loc, self.write_batch, journal_dir=self.journal_dir).start()
+        assert_that(writer.next_sequence).is_equal_to(5)
+        writer.close()
+        assert_that(self.written()).is_length(5)
+
+    def test_set_kv(self):
+        writer = WriteBehindWriter(self.database_loc, self.write_batch).start()
+        # Written on their own, nothing is waiting.
+        writer.set_kv({"capture/current_script_round": 0})
+        writer.submit(1)
+        writer.set_kv({"capture/current_script_round": 1, "capture/last_sweep_seconds": 12.5})
+        self.release.set()
+        writer.close()
+
+        assert_that(self.written()).is_equal_to([1])
+        connection = create_connection(self.database_loc)
+        assert_that(kv_store_get(connection, "capture/current_script_round")).is_equal_to(1)
+        assert_that(kv_store_get(connection, "capture/last_sweep_seconds")).is_equal_to(12.5)
+        connection.close()
+
+    def test_journal_requires_database_file(self):
+        assert_that(WriteBehindWriter).raises(ValueError).when_called_with(
+            ":memory:", self.write_batch, journal_dir=self.journal_dir
+        )
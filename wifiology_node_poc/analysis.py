@@ -0,0 +1,514 @@
+import dpkt
+
+import logging
+import functools
+from collections import defaultdict, OrderedDict
+
+from wifiology_node_poc.utils import altered_stddev, altered_mean, bytes_to_str
+from wifiology_node_poc.models import Measurement, Station, ServiceSet, DataCounters
+from wifiology_node_poc.decoders import DecodeError, parse_radiotap, parse_dot11_header, parse_beacon_fields, \
+    iter_information_elements, information_elements_digest, BEACON_FIXED_FIELDS, FCS_LENGTH, MGMT_TYPE, CTL_TYPE, \
+    DATA_TYPE, FLAG_TO_DS, FLAG_FROM_DS, FLAG_RETRY, IE_SSID, IE_RATES, IE_DS_PARAMETER_SET, IE_COUNTRY, \
+    IE_POWER_CAPABILITY, IE_RSN, IE_EXTENDED_RATES, IE_VENDOR_SPECIFIC, MICROSOFT_WPA_PREFIX
+
+analysis_logger = logging.getLogger(__name__)
+
+DEFAULT_BEACON_CACHE_SIZE = 1024
+
+
+def binary_to_mac(bin):
+    if isinstance(bin, bytes):
+        return ':'.join(("{:02x}".format(c)) for c in bin)
+    else:
+        return ':'.join(("{:02x}".format(ord(c))) for c in bin)
+
+
+def int_to_mac(value):
+    digits = "{:012x}".format(value)
+    return ':'.join(digits[i:i + 2] for i in range(0, 12, 2))
+
+
+def calculate_beacon_jitter(timing_measurements, bssid):
+    if not timing_measurements or len(timing_measurements) < 2:
+        return None, None, None
+    measurements, intervals = zip(*timing_measurements)
+    sorted_measurements = sorted(measurements)
+    intervals = list(set(intervals))
+    if len(intervals) > 1:
+        analysis_logger.warning(
+            "BSSID {0} has multiple reported intervals! Something funny is going on...".format(bssid)
+        )
+        analysis_logger.warning("Intervals seen: {0}".format(intervals))
+        bad_intervals = True
+    else:
+        bad_intervals = False
+    chosen_interval = intervals[0]
+    jitter = [
+        (sorted_measurements[i] - sorted_measurements[i-1]) - (chosen_interval*1024)
+        for i in range(1, len(sorted_measurements))
+    ]
+    return jitter, bad_intervals, intervals
+
+
+def network_stats(beacon_fields, elements):
+    """
+    Summarize a beacon's information elements, given as (element id, info) pairs, into the service set's
+    extra data: SSID, channel, country, power capability, supported rates (raw rate bytes, see
+    rate_decoder) and the crypto in use.
+    """
+    summary = {}
+    crypto = set()
+    rates = None
+    for element_id, info in elements:
+        if element_id == IE_SSID:
+            summary["ssid"] = bytes_to_str(info)
+        elif element_id == IE_DS_PARAMETER_SET:
+            summary["channel"] = info[0]
+        elif element_id == IE_COUNTRY:
+            summary["country"] = bytes_to_str(info[0:2])
+        elif element_id == IE_POWER_CAPABILITY:
+            summary["power_capability"] = {
+                "min": info[0],
+                "max": info[1]
+            }
+        elif element_id == IE_RATES or element_id == IE_EXTENDED_RATES:
+            rates = (rates or []) + list(info)
+        elif element_id == IE_RSN:
+            crypto.add("WPA2")
+        elif element_id == IE_VENDOR_SPECIFIC:
+            if info.startswith(MICROSOFT_WPA_PREFIX):
+                crypto.add("WPA")
+    if rates is not None:
+        summary["rates"] = rates
+    if not crypto:
+        if beacon_fields.privacy:
+            crypto.add("WEP")
+        else:
+            crypto.add("OPN")
+    summary["crypto"] = list(crypto)
+    return summary
+
+
+def copy_network_stats(summary):
+    """
+    A copy of a network_stats summary sharing none of its lists or dicts, so that a cached summary can be handed
+    out again after the service set extra data made from it was changed.
+    """
+    return {key: value.copy() if isinstance(value, (list, dict)) else value for key, value in summary.items()}
+
+
+def find_ssid(elements):
+    ssid = None
+    for element_id, info in elements:
+        if element_id == IE_SSID:
+            ssid = info
+    return ssid
+
+
+def sum_data_counters(data_counters):
+    return functools.reduce(lambda x, y: x + y, data_counters, DataCounters.zero())
+
+
+class BeaconCache(object):
+    """
+    LRU cache of decoded beacons, keyed by BSSID, capability field and a digest of the beacon's
+    information elements. Beacons from an AP rarely change, so most of them can skip the IE decoding.
+    Meant to be shared by the analyzers of every channel and capture round.
+    """
+    def __init__(self, max_size=DEFAULT_BEACON_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
+class CaptureAnalyzer(object):
+    """
+    Incremental analyzer for the frames seen on a single channel. Frames are fed in one at a time with
+    process_frame, either from a pcap file or straight from a live capture handle, and the analysis
+    result dict is built by results once the sample is over. Stations and BSSIDs are tracked by their 48 bit
+    integer MAC addresses, which are only formatted as strings by results.
+
+    beacon_cache is an optional BeaconCache used to skip decoding beacons already seen. With keep_samples the
+    station counters also keep every power and rate measurement instead of just their running statistics.
+    """
+    def __init__(self, channel, beacon_cache=None, keep_samples=False):
+        self.channel = channel
+        self.beacon_cache = beacon_cache
+        self.beacon_cache_hits = 0
+        self.beacon_cache_misses = 0
+        self.frame_count = 0
+        self.weird_frame_count = 0
+
+        self.bssid_to_ssid_map = {}
+        self.bssid_infra_macs = defaultdict(set)
+        self.bssid_associated_macs = defaultdict(set)
+        self.bssid_beacon_timing_payloads = defaultdict(list)
+        self.bssid_beacon_data = {}
+        self.bssid_to_power_map = defaultdict(list)
+
+        self.noise_measurements = []
+        self.action_counter = 0
+        self.probe_req_counter = 0
+
+        self.station_counters = defaultdict(functools.partial(DataCounters.zero, keep_samples))
+
+    def process_frame(self, header, payload):
+        """
+        Analyze one captured frame. header is the pcap packet header (or None when the frame was captured
+        in full); its wire length is used to account for data frames truncated by a header only capture.
+        """
+        self.frame_count += 1
+        try:
+            self._process_frame(header, payload)
+        except dpkt.dpkt.UnpackError:
+            analysis_logger.warning(
+                "dpkt lacks support for some IE80211 features. This could be causing spurious decode problems.",
+                exc_info=True
+            )
+            self.weird_frame_count += 1
+        except DecodeError:
+            analysis_logger.warning("Failed to decode frame.", exc_info=True)
+            self.weird_frame_count += 1
+
+    def _process_frame(self, header, payload):
+        station_counters = self.station_counters
+        bssid_infra_macs = self.bssid_infra_macs
+        bssid_associated_macs = self.bssid_associated_macs
+
+        # dpkt's Radiotap decoder is totally broken, so decode the radiotap header ourselves.
+        radiotap = parse_radiotap(payload)
+        signal = radiotap.antenna_signal
+        rate = radiotap.rate
+        bad_fcs = radiotap.bad_fcs
+
+        if radiotap.antenna_noise is not None:
+            self.noise_measurements.append(radiotap.antenna_noise)
+
+        frame_end = len(payload) - FCS_LENGTH if radiotap.has_fcs else len(payload)
+        frame = parse_dot11_header(payload, radiotap.length, frame_end)
+        frame_type = frame.frame_type
+        frame_subtype = frame.subtype
+
+        if frame_type == MGMT_TYPE:
+            mac = frame.addr2
+            current_counter = station_counters[mac]
+            current_counter.management_frame_count += 1
+
+            if frame_subtype == dpkt.ieee80211.M_BEACON:
+                self._process_beacon(frame, payload, signal)
+            elif frame_subtype == dpkt.ieee80211.M_PROBE_RESP:
+                self._process_probe_response(frame, payload)
+
+            if frame_subtype in (dpkt.ieee80211.M_ASSOC_REQ, dpkt.ieee80211.M_ASSOC_RESP):
+                current_counter.association_frame_count += 1
+            if frame_subtype in (dpkt.ieee80211.M_REASSOC_REQ, dpkt.ieee80211.M_REASSOC_RESP):
+                current_counter.reassociation_frame_count += 1
+            if frame_subtype == dpkt.ieee80211.M_DISASSOC:
+                current_counter.disassociation_frame_count += 1
+            if frame_subtype == dpkt.ieee80211.M_ACTION:
+                self.action_counter += 1
+            if frame_subtype == dpkt.ieee80211.M_PROBE_REQ:
+                self.probe_req_counter += 1
+            if frame.flags & FLAG_RETRY:
+                current_counter.retry_frame_count += 1
+            if signal is not None:
+                current_counter.add_power_measurement(signal)
+            if rate is not None:
+                current_counter.add_rate_measurement(rate)
+            if bad_fcs is not None:
+                current_counter.failed_fcs_count += (1 if bad_fcs else 0)
+
+        elif frame_type == CTL_TYPE:
+            include_in_extra_measurements = True
+
+            if frame_subtype == dpkt.ieee80211.C_RTS:
+                current_counter = station_counters[frame.addr2]
+                current_counter.cts_frame_count += 1
+
+            elif frame_subtype == dpkt.ieee80211.C_CTS:
+                include_in_extra_measurements = False
+                current_counter = station_counters[frame.addr1]
+                current_counter.rts_frame_count += 1
+
+            elif frame_subtype == dpkt.ieee80211.C_ACK:
+                include_in_extra_measurements = False
+                current_counter = station_counters[frame.addr1]
+                current_counter.ack_frame_count += 1
+
+            elif frame_subtype in (dpkt.ieee80211.C_BLOCK_ACK, dpkt.ieee80211.C_BLOCK_ACK_REQ,
+                                   dpkt.ieee80211.C_CF_END):
+                current_counter = station_counters[frame.addr2]
+            else:
+                return
+            if frame.flags & FLAG_RETRY:
+                current_counter.retry_frame_count += 1
+            if include_in_extra_measurements:
+                current_counter.control_frame_count += 1
+                if signal is not None:
+                    current_counter.add_power_measurement(signal)
+                if rate is not None:
+                    current_counter.add_rate_measurement(rate)
+                if bad_fcs is not None:
+                    current_counter.failed_fcs_count += (1 if bad_fcs else 0)
+
+        elif frame_type == DATA_TYPE:
+            src_mac, dst_mac, bssid = frame.data_addresses()
+
+            current_counter = station_counters[src_mac]
+            dst_current_counter = station_counters[dst_mac]
+
+            if bssid is not None:
+                if frame.flags & FLAG_TO_DS:
+                    bssid_infra_macs[bssid].add(dst_mac)
+                    bssid_associated_macs[bssid].add(src_mac)
+                elif frame.flags & FLAG_FROM_DS:
+                    bssid_infra_macs[bssid].add(src_mac)
+                    bssid_associated_macs[bssid].add(dst_mac)
+            payload_length = frame.body_length
+            if header is not None:
+                payload_length += header.getlen() - header.getcaplen()
+            current_counter.data_throughput_out += payload_length
+            dst_current_counter.data_throughput_in += payload_length
+
+            current_counter.data_frame_count += 1
+            if frame.flags & FLAG_RETRY:
+                current_counter.retry_frame_count += 1
+            if signal is not None:
+                current_counter.add_power_measurement(signal)
+            if rate is not None:
+                current_counter.add_rate_measurement(rate)
+            if bad_fcs is not None:
+                current_counter.failed_fcs_count += (1 if bad_fcs else 0)
+
+    def _process_beacon(self, frame, payload, signal):
+        mac = frame.addr2
+        bssid = frame.addr3
+        body_end = frame.body_offset + frame.body_length
+        beacon_fields = parse_beacon_fields(payload, frame.body_offset, body_end)
+        ssid, beacon_data = self._decode_beacon(
+            bssid, beacon_fields, payload, frame.body_offset + BEACON_FIXED_FIELDS.size, body_end
+        )
+        if beacon_data is not None:
+            self.bssid_beacon_data[bssid] = beacon_data
+            target_channel = beacon_data.get("channel")
+        else:
+            target_channel = None
+
+        if ssid is not None:
+            self.bssid_to_ssid_map[bssid] = ssid
+            self.bssid_infra_macs[bssid].add(mac)
+        if target_channel is None or target_channel == self.channel:
+            self.bssid_beacon_timing_payloads[bssid].append(
+                (beacon_fields.timestamp, beacon_fields.beacon_interval)
+            )
+            if signal is not None:
+                self.bssid_to_power_map[bssid].append(signal)
+        else:
+            analysis_logger.warning(
+                "Off channel beacon ({0} vs {1}) seen for BSSID {2}"
+                "".format(target_channel, self.channel, int_to_mac(bssid))
+            )
+
+    def _process_probe_response(self, frame, payload):
+        body_end = frame.body_offset + frame.body_length
+        parse_beacon_fields(payload, frame.body_offset, body_end)
+        ssid = find_ssid(
+            iter_information_elements(payload, frame.body_offset + BEACON_FIXED_FIELDS.size, body_end)
+        )
+        if ssid is not None:
+            bssid = frame.addr3
+            self.bssid_to_ssid_map[bssid] = ssid
+            self.bssid_infra_macs[bssid].add(frame.addr2)
+
+    def _decode_beacon(self, bssid, beacon_fields, payload, offset, end):
+        """
+        The SSID and network stats of the beacon whose information elements are in payload[offset:end]. The
+        network stats are None if they could not be decoded.
+        """
+        beacon_cache = self.beacon_cache
+        if beacon_cache is not None:
+            cache_key = (bssid, beacon_fields.capability, information_elements_digest(payload, offset, end))
+            cached = beacon_cache.get(cache_key)
+            if cached is not None:
+                self.beacon_cache_hits += 1
+                ssid, beacon_data = cached
+                return ssid, None if beacon_data is None else copy_network_stats(beacon_data)
+            self.beacon_cache_misses += 1
+
+        elements = list(iter_information_elements(payload, offset, end))
+        ssid = find_ssid(elements)
+        try:
+            beacon_data = network_stats(beacon_fields, elements)
+        except:
+            analysis_logger.exception("Failed to decode network stats...")
+            beacon_data = None
+
+        if beacon_cache is not None:
+            beacon_cache.put(cache_key, (ssid, None if beacon_data is None else copy_network_stats(beacon_data)))
+        return ssid, beacon_data
+
+    def partial(self):
+        """
+        Turn this analyzer into partial aggregates for merge, e.g. to send the analysis of one chunk of a capture
+        back from a worker process. Detaches the beacon cache, which stays with the worker.
+        """
+        self.beacon_cache = None
+        return self
+
+    def merge(self, other):
+        """
+        Merge the partial aggregates of another analyzer of the same channel into this one. Beacon timings are
+        only collected here, the jitter is computed on the merged and sorted timestamps by results.
+        """
+        self.frame_count += other.frame_count
+        self.weird_frame_count += other.weird_frame_count
+        self.beacon_cache_hits += other.beacon_cache_hits
+        self.beacon_cache_misses += other.beacon_cache_misses
+        self.action_counter += other.action_counter
+        self.probe_req_counter += other.probe_req_counter
+        self.noise_measurements.extend(other.noise_measurements)
+
+        for mac, counters in other.station_counters.items():
+            self.station_counters[mac] = self.station_counters[mac] + counters
+        for bssid, macs in other.bssid_infra_macs.items():
+            self.bssid_infra_macs[bssid].update(macs)
+        for bssid, macs in other.bssid_associated_macs.items():
+            self.bssid_associated_macs[bssid].update(macs)
+        for bssid, timings in other.bssid_beacon_timing_payloads.items():
+            self.bssid_beacon_timing_payloads[bssid].extend(timings)
+        for bssid, powers in other.bssid_to_power_map.items():
+            self.bssid_to_power_map[bssid].extend(powers)
+        self.bssid_to_ssid_map.update(other.bssid_to_ssid_map)
+        self.bssid_beacon_data.update(other.bssid_beacon_data)
+        return self
+
+    def results(self, start_time, end_time, sample_seconds, capture_stats=None):
+        """
+        Build the analysis result dict. capture_stats is the statistics dict from the live capture: the pcap
+        counters and the channel switch time are stored on the measurement itself, everything else goes into its
+        extra data.
+        """
+        # Frames are tracked by integer MAC address, format each address only once here.
+        mac_names = {}
+
+        def mac_name(mac):
+            name = mac_names.get(mac)
+            if name is None:
+                name = mac_names[mac] = int_to_mac(mac)
+            return name
+
+        def by_mac_name(mac_map):
+            return {mac_name(mac): value for mac, value in mac_map.items()}
+
+        def by_mac_name_sets(mac_map):
+            return {mac_name(mac): {mac_name(value) for value in values} for mac, values in mac_map.items()}
+
+        station_counters = by_mac_name(self.station_counters)
+        bssid_infra_macs = by_mac_name_sets(self.bssid_infra_macs)
+        bssid_associated_macs = by_mac_name_sets(self.bssid_associated_macs)
+        bssid_to_ssid_map = by_mac_name(self.bssid_to_ssid_map)
+        bssid_beacon_data = by_mac_name(self.bssid_beacon_data)
+        bssid_beacon_timing_payloads = by_mac_name(self.bssid_beacon_timing_payloads)
+        bssid_to_power_map = by_mac_name(self.bssid_to_power_map)
+        bssid_to_jitter_map = {}
+        measurement_extra_data = dict(capture_stats or {})
+        pcap_received = measurement_extra_data.pop('pcap_received', None)
+        pcap_dropped = measurement_extra_data.pop('pcap_dropped', None)
+        pcap_interface_dropped = measurement_extra_data.pop('pcap_interface_dropped', None)
+        channel_switch_seconds = measurement_extra_data.pop('channel_switch_seconds', None)
+        measurement_extra_data['weird_frame_count'] = self.weird_frame_count
+        if self.beacon_cache is not None or self.beacon_cache_hits or self.beacon_cache_misses:
+            measurement_extra_data['beacon_cache_hits'] = self.beacon_cache_hits
+            measurement_extra_data['beacon_cache_misses'] = self.beacon_cache_misses
+
+        measurement = Measurement.new(
+            start_time,
+            end_time,
+            sample_seconds,
+            self.channel,
+            self.noise_measurements,
+            data_counters=sum_data_counters(station_counters.values()),
+            extra_data=measurement_extra_data,
+            pcap_received=pcap_received,
+            pcap_dropped=pcap_dropped,
+            pcap_interface_dropped=pcap_interface_dropped,
+            channel_switch_seconds=channel_switch_seconds
+        )
+
+        stations = [
+            Station.new(mac_addr) for mac_addr in station_counters.keys()
+        ]
+
+        service_sets = [
+            ServiceSet.new(
+                bssid, network_name=bssid_to_ssid_map.get(bssid),
+                extra_data=bssid_beacon_data.get(bssid, {})
+            )
+            for bssid in set(bssid_infra_macs.keys()).union(set(bssid_associated_macs.keys()))
+        ]
+        for service_set in service_sets:
+            jitter, bad_intervals, intervals = calculate_beacon_jitter(
+                bssid_beacon_timing_payloads.get(service_set.bssid), service_set.bssid
+            )
+            if jitter is not None:
+                bssid_to_jitter_map[service_set.bssid] = (
+                    jitter, bad_intervals, intervals
+                )
+        analysis_logger.info("-----------------")
+        analysis_logger.info("Analysis performed on channel: {0}".format(self.channel))
+        analysis_logger.info("Noise Level: {0} +/- {1} dBm".format(measurement.average_noise, measurement.std_dev_noise))
+        analysis_logger.info("Top level result:\n{0}".format(repr(measurement.data_counters)))
+        analysis_logger.info("Action Frames: {0}".format(self.action_counter))
+        analysis_logger.info("Probe Request Frames: {0}".format(self.probe_req_counter))
+        if service_sets:
+            analysis_logger.info("Service Sets seen:")
+            for service_set in service_sets:
+                jitter, bad_intervals, intervals = bssid_to_jitter_map.get(service_set.bssid, (None, None, None))
+                analysis_logger.info("-- {0} ({1})".format(service_set.bssid, service_set.network_name))
+                if bad_intervals:
+                    analysis_logger.info("---- Changing intervals detected!!!")
+                    analysis_logger.info("---- Intervals Seen: {0}".format(intervals))
+                if jitter:
+                    analysis_logger.info(
+                        "---- Avg +/- StdDev Beacon Jitter: {0} +/- {1} (ms)".format(
+                            altered_mean(jitter)/1000.0, altered_stddev(jitter)/1000.0
+                        )
+                    )
+                    analysis_logger.info(
+                        "---- Min/Max Beacon Jitter: {0}/{1} (ms)".format(
+                             min(jitter)/1000.0, max(jitter)/1000.0
+                        )
+                    )
+                    analysis_logger.info("---- Jitter Count: {0}".format(len(jitter)))
+        analysis_logger.info("{0} unique stations seen.".format(len(stations)))
+        analysis_logger.info("-----------------")
+        return {
+            'measurement': measurement,
+            'stations': stations,
+            'service_sets': service_sets,
+            'station_counters': station_counters,
+            'bssid_associated_macs': bssid_associated_macs,
+            'bssid_infra_macs': bssid_infra_macs,
+            'bssid_to_ssid_map': bssid_to_ssid_map,
+            'bssid_to_jitter_map': bssid_to_jitter_map,
+            'bssid_to_power_map': bssid_to_power_map
+        }
@@ -0,0 +1,251 @@
+import ctypes
+import logging
+import socket
+
+from wifiology_node_poc.decoders import DOT11_FOUR_ADDRESS_HEADER_LENGTH, QOS_CONTROL_LENGTH, HT_CONTROL_LENGTH, \
+    FCS_LENGTH
+
+capture_control_logger = logging.getLogger(__name__)
+
+MEGABYTE = 1024 * 1024
+DEFAULT_CAPTURE_BUFFER_SIZE = 15 * MEGABYTE
+
+
+def drop_rate(received, dropped):
+    """
+    Fraction of frames dropped by the kernel. On Linux, libpcap's ps_recv already includes the frames
+    counted in ps_drop.
+    """
+    if not received:
+        return 0.0
+    return min(1.0, dropped / received)
+
+
+class AdaptiveBufferSizer(object):
+    """
+    Picks a capture buffer size per channel from the kernel drop rate seen on previous captures of that
+    channel. The buffer doubles whenever the drop rate goes over grow_drop_rate and shrinks by
+    shrink_factor after shrink_after consecutive captures without drops, always staying between
+    min_size and max_size bytes.
+    """
+    def __init__(self, initial_size=DEFAULT_CAPTURE_BUFFER_SIZE, min_size=2 * MEGABYTE, max_size=64 * MEGABYTE,
+                 grow_drop_rate=0.001, growth_factor=2.0, shrink_factor=0.75, shrink_after=3):
+        if min_size > max_size:
+            raise ValueError("The minimum buffer size can not be larger than the maximum buffer size.")
+        self.initial_size = self._clamp(initial_size, min_size, max_size)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.grow_drop_rate = grow_drop_rate
+        self.growth_factor = growth_factor
+        self.shrink_factor = shrink_factor
+        self.shrink_after = shrink_after
+        self.channel_sizes = {}
+        self.channel_clean_captures = {}
+
+    @staticmethod
+    def _clamp(size, min_size, max_size):
+        return int(max(min_size, min(max_size, size)))
+
+    def buffer_size(self, channel):
+        return self.channel_sizes.get(channel, self.initial_size)
+
+    def record(self, channel, received, dropped):
+        """
+        Record the pcap counters of a finished capture on channel and return the buffer size to use for the
+        next capture on it.
+        """
+        current_size = self.buffer_size(channel)
+        rate = drop_rate(received, dropped)
+        if rate > self.grow_drop_rate:
+            new_size = self._clamp(current_size * self.growth_factor, self.min_size, self.max_size)
+            self.channel_clean_captures[channel] = 0
+        elif dropped:
+            new_size = current_size
+            self.channel_clean_captures[channel] = 0
+        else:
+            clean_captures = self.channel_clean_captures.get(channel, 0) + 1
+            if clean_captures >= self.shrink_after:
+                new_size = self._clamp(current_size * self.shrink_factor, self.min_size, self.max_size)
+                clean_captures = 0
+            else:
+                new_size = current_size
+            self.channel_clean_captures[channel] = clean_captures
+        if new_size != current_size:
+            capture_control_logger.info(
+                "Channel {0} drop rate {1:.4f}: capture buffer {2} -> {3} bytes".format(
+                    channel, rate, current_size, new_size
+                )
+            )
+        self.channel_sizes[channel] = new_size
+        return new_size
+
+
+# -----------------------------------
+#  DWELL TIME SCHEDULING
+# -----------------------------------
+
+CAPTURE_CHANNELS = tuple(range(1, 12))
+
+
+class DwellScheduler(object):
+    """
+    Splits a sweep budget of sweep_seconds across the channels in proportion to their recent activity (as
+    returned by select_channel_activity). Every channel gets at least min_dwell_seconds, so new APs are still
+    found on quiet channels. The rest of the budget is shared out by an activity score: the weighted sum of
+    the channel's share of the frame rate, of the unique stations and of the beaconing service sets seen.
+    Without any activity to go on, the budget is split evenly.
+    """
+    def __init__(self, sweep_seconds, channels=CAPTURE_CHANNELS, min_dwell_seconds=2.0, frame_rate_weight=1.0,
+                 station_weight=1.0, service_set_weight=1.0):
+        if sweep_seconds < min_dwell_seconds * len(channels):
+            raise ValueError("The sweep budget is too small to give every channel its minimum dwell time.")
+        self.sweep_seconds = sweep_seconds
+        self.channels = tuple(channels)
+        self.min_dwell_seconds = min_dwell_seconds
+        self.frame_rate_weight = frame_rate_weight
+        self.station_weight = station_weight
+        self.service_set_weight = service_set_weight
+
+    def _shares(self, values):
+        total = sum(values.values())
+        return {channel: (values[channel] / total if total else 0.0) for channel in self.channels}
+
+    def activity_scores(self, channel_activity):
+        frame_rates, stations, service_sets = {}, {}, {}
+        for channel in self.channels:
+            activity = channel_activity.get(channel)
+            if activity is None:
+                frame_rates[channel] = stations[channel] = service_sets[channel] = 0
+                continue
+            duration = activity['totalDuration']
+            frame_rates[channel] = activity['frameCount'] / duration if duration else 0
+            stations[channel] = activity['stationCount']
+            service_sets[channel] = activity['serviceSetCount']
+        frame_rate_shares = self._shares(frame_rates)
+        station_shares = self._shares(stations)
+        service_set_shares = self._shares(service_sets)
+        return {
+            channel: self.frame_rate_weight * frame_rate_shares[channel] +
+            self.station_weight * station_shares[channel] +
+            self.service_set_weight * service_set_shares[channel]
+            for channel in self.channels
+        }
+
+    def dwell_times(self, channel_activity):
+        """
+        The seconds to spend on each channel in the next sweep, given the recent channel activity.
+        """
+        scores = self.activity_scores(channel_activity)
+        total_score = sum(scores.values())
+        if not total_score:
+            return {channel: self.sweep_seconds / len(self.channels) for channel in self.channels}
+        spare_seconds = self.sweep_seconds - self.min_dwell_seconds * len(self.channels)
+        dwell_times = {
+            channel: self.min_dwell_seconds + spare_seconds * scores[channel] / total_score
+            for channel in self.channels
+        }
+        capture_control_logger.info("Channel dwell times: {0}".format(
+            ", ".join("{0}: {1:.1f}s".format(channel, dwell_times[channel]) for channel in self.channels)
+        ))
+        return dwell_times
+
+
+def split_channel_plan(dwell_times, interface_count):
+    """
+    Split a sweep's {channel: dwell seconds} between interface_count interfaces so that they all finish the
+    sweep at about the same time: each channel, longest dwell first, goes to the interface with the least
+    capture time so far. Returns one [(channel, dwell seconds), ...] plan per interface, in channel order.
+    """
+    if interface_count < 1:
+        raise ValueError("The channel plan needs at least one interface.")
+    plans = [[] for _ in range(interface_count)]
+    plan_seconds = [0.0] * interface_count
+    for channel in sorted(dwell_times, key=lambda c: (-dwell_times[c], c)):
+        index = plan_seconds.index(min(plan_seconds))
+        plans[index].append((channel, dwell_times[channel]))
+        plan_seconds[index] += dwell_times[channel]
+    return [sorted(plan) for plan in plans]
+
+
+# -----------------------------------
+#  HEADER ONLY CAPTURE
+# -----------------------------------
+
+MAX_SNAPLEN = 65535
+DEFAULT_DATA_SNAPLEN = 64
+# The longest data frame MAC header (four addresses, QoS and HT control) plus the FCS, which the decoders still
+# strip from the end of a truncated frame.
+MIN_DATA_SNAPLEN = DOT11_FOUR_ADDRESS_HEADER_LENGTH + QOS_CONTROL_LENGTH + HT_CONTROL_LENGTH + FCS_LENGTH
+SO_ATTACH_FILTER = 26
+
+# Classic BPF opcodes, see linux/filter.h
+BPF_LDB_ABS = 0x30
+BPF_LDB_IND = 0x50
+BPF_LSH_K = 0x64
+BPF_OR_X = 0x4c
+BPF_AND_K = 0x54
+BPF_ADD_K = 0x04
+BPF_JEQ_K = 0x15
+BPF_TAX = 0x07
+BPF_TXA = 0x87
+BPF_RET_A = 0x16
+BPF_RET_K = 0x06
+
+
+class SockFilter(ctypes.Structure):
+    _fields_ = [
+        ("code", ctypes.c_uint16),
+        ("jt", ctypes.c_uint8),
+        ("jf", ctypes.c_uint8),
+        ("k", ctypes.c_uint32)
+    ]
+
+
+class SockFprog(ctypes.Structure):
+    _fields_ = [
+        ("len", ctypes.c_uint16),
+        ("filter", ctypes.POINTER(SockFilter))
+    ]
+
+
+def header_only_filter_program(data_snaplen=DEFAULT_DATA_SNAPLEN, max_snaplen=MAX_SNAPLEN):
+    """
+    Classic BPF program for radiotap captures that keeps the radiotap header plus the first data_snaplen
+    bytes of 802.11 data frames and every other frame in full. The kernel truncates each frame to the
+    length the filter returns while still reporting its original wire length.
+
+    Returned as a list of (code, jt, jf, k) tuples. data_snaplen must be at least MIN_DATA_SNAPLEN, so that the
+    802.11 header of every data frame is kept.
+    """
+    if not MIN_DATA_SNAPLEN <= data_snaplen <= max_snaplen:
+        raise ValueError(
+            "The data snap length must be between {0} and {1} bytes.".format(MIN_DATA_SNAPLEN, max_snaplen)
+        )
+    return [
+        (BPF_LDB_ABS, 0, 0, 3),            # A = radiotap length (little endian u16 at offset 2)
+        (BPF_LSH_K, 0, 0, 8),
+        (BPF_TAX, 0, 0, 0),
+        (BPF_LDB_ABS, 0, 0, 2),
+        (BPF_OR_X, 0, 0, 0),
+        (BPF_TAX, 0, 0, 0),                # X = offset of the 802.11 header
+        (BPF_LDB_IND, 0, 0, 0),            # A = first frame control byte
+        (BPF_AND_K, 0, 0, 0x0c),           # A = frame type bits
+        (BPF_JEQ_K, 0, 3, 0x08),           # data frame?
+        (BPF_TXA, 0, 0, 0),
+        (BPF_ADD_K, 0, 0, data_snaplen),
+        (BPF_RET_A, 0, 0, 0),              # keep radiotap + data_snaplen bytes
+        (BPF_RET_K, 0, 0, max_snaplen)     # keep everything else in full
+    ]
+
+
+def attach_socket_filter(fd, program):
+    """
+    Attach a classic BPF program to the packet socket behind fd (e.g. a pcap handle's selectable fd).
+    """
+    filters = (SockFilter * len(program))(*[SockFilter(*instruction) for instruction in program])
+    fprog = SockFprog(len(program), ctypes.cast(filters, ctypes.POINTER(SockFilter)))
+    sock = socket.fromfd(fd, socket.AF_PACKET, socket.SOCK_RAW)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, bytes(fprog))
+    finally:
+        sock.close()
@@ -1,14 +1,89 @@
 import os
 import math
+import time
 from contextlib import contextmanager
 from functools import wraps
 from sqlite3 import dbapi2 as sqlite
 
+from wifiology_node_poc.utils import RunningStatistics
+
+
+# PRAGMA settings of the named connection profiles, see create_connection. "default" keeps SQLite's own defaults
+# (rollback journal, full fsync on every commit). The others switch the database to WAL, so readers no longer block
+# the capture writer and the other way around. With WAL, synchronous=NORMAL only fsyncs on checkpoints: a power cut
+# may lose the last few commits but never corrupts the database.
+CONNECTION_PROFILES = {
+    "default": {},
+    "writer": {
+        "busy_timeout": 60000,
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "mmap_size": 64 * 1024 * 1024,
+        "cache_size": -8192,
+        "temp_store": "MEMORY",
+    },
+    "reader": {
+        "busy_timeout": 5000,
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "mmap_size": 64 * 1024 * 1024,
+        "cache_size": -4096,
+        "temp_store": "MEMORY",
+    },
+    # VACUUM rebuilds the whole database in temp storage, which is kept on disk rather than in RAM.
+    "maintenance": {
+        "busy_timeout": 300000,
+        "journal_mode": "WAL",
+        "synchronous": "FULL",
+        "mmap_size": 0,
+        "cache_size": -16384,
+        "temp_store": "FILE",
+    },
+}
+
+# Profiles whose transaction_wrapper takes the write lock up front (BEGIN IMMEDIATE). In WAL mode a deferred
+# transaction that read before writing fails with SQLITE_BUSY instead of waiting when another connection wrote in
+# between; taking the lock at BEGIN also makes the time spent waiting for it measurable.
+IMMEDIATE_TRANSACTION_PROFILES = frozenset(["writer", "maintenance"])
+
+
+class ProfiledConnection(sqlite.Connection):
+    """
+    Connection that knows its profile and how long its immediate transactions waited for the database write lock.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.profile = "default"
+        self.lock_wait_seconds = 0.0
+        self.max_lock_wait_seconds = 0.0
+        self.lock_wait_count = 0
+        self.staging_schema_written = False
+
+    def record_lock_wait(self, seconds):
+        self.lock_wait_seconds += seconds
+        self.max_lock_wait_seconds = max(self.max_lock_wait_seconds, seconds)
+        self.lock_wait_count += 1
+
+    def lock_wait_stats(self):
+        return {
+            "profile": self.profile,
+            "transactions": self.lock_wait_count,
+            "total_seconds": self.lock_wait_seconds,
+            "max_seconds": self.max_lock_wait_seconds
+        }
+
+
+def begin_immediate_transaction(connection):
+    start = time.perf_counter()
+    connection.execute("BEGIN IMMEDIATE TRANSACTION")
+    if isinstance(connection, ProfiledConnection):
+        connection.record_lock_wait(time.perf_counter() - start)
+
 
 @contextmanager
 def immediate_transaction_wrapper(connection):
     try:
-        connection.execute("BEGIN IMMEDIATE TRANSACTION")
+        begin_immediate_transaction(connection)
         yield connection
     except:
         connection.rollback()
@@ -51,8 +126,29 @@ class WeightedStdDev(object):
             return None
 
 
+class PooledStdDev(object):
+    """
+    Sample standard deviation of the union of groups, each given by its mean, sample standard deviation and
+    size. Unlike weighted_std_dev this accounts for the spread between the group means.
+    """
+    def __init__(self):
+        self.statistics = RunningStatistics()
+
+    def step(self, avg, std_dev, weight):
+        if avg is not None and weight:
+            self.statistics = self.statistics.merge(
+                RunningStatistics(weight, avg, (std_dev or 0.0) ** 2 * (weight - 1))
+            )
+
+    def finalize(self):
+        return self.statistics.std_dev
+
+
 @contextmanager
-def transaction_wrapper(connection):
+def deferred_transaction_wrapper(connection):
+    """
+    Deferred transaction whatever the connection profile, for consistent reads that must not hold the write lock.
+    """
     try:
         connection.execute("BEGIN DEFERRED TRANSACTION")
         yield connection
@@ -63,6 +159,21 @@ def transaction_wrapper(connection):
         connection.commit()
 
 
+@contextmanager
+def transaction_wrapper(connection):
+    try:
+        if getattr(connection, "profile", None) in IMMEDIATE_TRANSACTION_PROFILES:
+            begin_immediate_transaction(connection)
+        else:
+            connection.execute("BEGIN DEFERRED TRANSACTION")
+        yield connection
+    except:
+        connection.rollback()
+        raise
+    else:
+        connection.commit()
+
+
 @contextmanager
 def cursor_manager(connection):
     cursor = connection.cursor()
@@ -87,15 +198,54 @@ def vacuum_db(connection):
         cursor.execute("VACUUM")
 
 
+def apply_connection_profile(connection, profile, set_busy_timeout=True):
+    """
+    Set the PRAGMAs of a CONNECTION_PROFILES profile. busy_timeout goes first, switching the journal mode needs
+    a lock another process might be holding.
+    """
+    if profile not in CONNECTION_PROFILES:
+        raise ValueError("Unknown connection profile: {0}".format(profile))
+    with cursor_manager(connection) as cursor:
+        for pragma, value in CONNECTION_PROFILES[profile].items():
+            if pragma != "busy_timeout" or set_busy_timeout:
+                cursor.execute("PRAGMA {0} = {1}".format(pragma, value))
+    if isinstance(connection, ProfiledConnection):
+        connection.profile = profile
+
+
 @wraps(sqlite.connect)
-def create_connection(*args, **kwargs):
-    conn = sqlite.connect(*args, **kwargs)
+def create_connection(*args, profile="default", **kwargs):
+    if profile not in CONNECTION_PROFILES:
+        raise ValueError("Unknown connection profile: {0}".format(profile))
+    # A timeout of None leaves it to the profile, like leaving it out.
+    if "timeout" in kwargs and kwargs["timeout"] is None:
+        del kwargs["timeout"]
+    conn = sqlite.connect(*args, factory=ProfiledConnection, **kwargs)
     conn.row_factory = sqlite.Row
     conn.create_aggregate("weighted_avg", 2, WeightedAverage)
     conn.create_aggregate("weighted_std_dev", 2, WeightedStdDev)
+    conn.create_aggregate("pooled_std_dev", 3, PooledStdDev)
+    # An explicit timeout (the second argument of sqlite3.connect) wins over the profile's busy_timeout.
+    apply_connection_profile(conn, profile, set_busy_timeout=len(args) < 2 and "timeout" not in kwargs)
     return conn
 
 
+def split_sql_script(script):
+    """
+    The statements of a SQL script, so that it can run inside a transaction (executescript always commits first).
+    """
+    statements = []
+    statement = ""
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite.complete_statement(statement):
+            statements.append(statement.strip())
+            statement = ""
+    if any(line.strip() and not line.strip().startswith("--") for line in statement.splitlines()):
+        raise ValueError("Incomplete SQL statement at the end of the script: {0}".format(statement.strip()))
+    return statements
+
+
 def load_raw_file(filename, folder):
     with open(os.path.join(folder, filename), 'r') as f:
         return f.read()
@@ -0,0 +1,306 @@
+import hashlib
+import struct
+from collections import namedtuple
+
+
+class DecodeError(ValueError):
+    pass
+
+
+# -----------------------------------
+#  RADIOTAP
+# -----------------------------------
+
+RADIOTAP_HEADER = struct.Struct('<BBHI')
+RADIOTAP_PRESENT_WORD = struct.Struct('<I')
+RADIOTAP_EXT_BIT = 1 << 31
+
+RADIOTAP_FLAGS_FCS = 0x10
+RADIOTAP_FLAGS_BAD_FCS = 0x40
+
+# (alignment, size) of the radiotap fields up to dBm_AntNoise, indexed by their present bit, see
+# https://www.radiotap.org/fields/defined
+RADIOTAP_FIELD_LAYOUT = (
+    (8, 8),  # TSFT
+    (1, 1),  # Flags
+    (1, 1),  # Rate
+    (2, 4),  # Channel
+    (2, 2),  # FHSS
+    (1, 1),  # dBm_AntSignal
+    (1, 1),  # dBm_AntNoise
+)
+RADIOTAP_FLAGS_BIT = 1
+RADIOTAP_RATE_BIT = 2
+RADIOTAP_SIGNAL_BIT = 5
+RADIOTAP_NOISE_BIT = 6
+RADIOTAP_USED_FIELDS_MASK = (1 << len(RADIOTAP_FIELD_LAYOUT)) - 1
+
+
+class RadiotapInfo(namedtuple('RadiotapInfo', ['length', 'flags', 'rate', 'antenna_signal', 'antenna_noise'])):
+    """
+    The radiotap fields the analysis uses. length is the offset of the 802.11 header in the frame, rate is
+    in Mbps and the antenna signal and noise are in dBm. Fields missing from the frame are None.
+    """
+    __slots__ = ()
+
+    @property
+    def has_fcs(self):
+        return self.flags is not None and bool(self.flags & RADIOTAP_FLAGS_FCS)
+
+    @property
+    def bad_fcs(self):
+        if self.flags is None:
+            return None
+        return bool(self.flags & RADIOTAP_FLAGS_BAD_FCS)
+
+
+def _signed_byte(value):
+    return value - 256 if value > 127 else value
+
+
+def parse_radiotap(buf):
+    """
+    Decode the radiotap header at the start of buf, walking the present bitmask once and only reading the
+    Flags, Rate, dBm_AntSignal and dBm_AntNoise fields. Raises DecodeError on a truncated header.
+    """
+    if len(buf) < RADIOTAP_HEADER.size:
+        raise DecodeError("Frame too short for a radiotap header: {0} bytes".format(len(buf)))
+    version, _, length, present = RADIOTAP_HEADER.unpack_from(buf, 0)
+    if version != 0:
+        raise DecodeError("Unsupported radiotap version {0}".format(version))
+    if length < RADIOTAP_HEADER.size or length > len(buf):
+        raise DecodeError("Bad radiotap length {0} for a {1} byte frame".format(length, len(buf)))
+
+    # Only the first present word describes radiotap namespace fields; skip any extended words.
+    offset = RADIOTAP_HEADER.size
+    word = present
+    while word & RADIOTAP_EXT_BIT:
+        if offset + RADIOTAP_PRESENT_WORD.size > length:
+            raise DecodeError("Truncated radiotap present bitmask")
+        word, = RADIOTAP_PRESENT_WORD.unpack_from(buf, offset)
+        offset += RADIOTAP_PRESENT_WORD.size
+
+    flags = rate = antenna_signal = antenna_noise = None
+    if present & RADIOTAP_USED_FIELDS_MASK:
+        for bit, (alignment, size) in enumerate(RADIOTAP_FIELD_LAYOUT):
+            if not present & (1 << bit):
+                continue
+            offset = (offset + alignment - 1) & ~(alignment - 1)
+            if offset + size > length:
+                raise DecodeError("Truncated radiotap field {0}".format(bit))
+            if bit == RADIOTAP_FLAGS_BIT:
+                flags = buf[offset]
+            elif bit == RADIOTAP_RATE_BIT:
+                rate = buf[offset] * 0.5
+            elif bit == RADIOTAP_SIGNAL_BIT:
+                antenna_signal = _signed_byte(buf[offset])
+            elif bit == RADIOTAP_NOISE_BIT:
+                antenna_noise = _signed_byte(buf[offset])
+            offset += size
+    return RadiotapInfo(length, flags, rate, antenna_signal, antenna_noise)
+
+
+# -----------------------------------
+#  802.11 MAC HEADER
+# -----------------------------------
+
+FCS_LENGTH = 4
+
+MGMT_TYPE = 0
+CTL_TYPE = 1
+DATA_TYPE = 2
+
+FLAG_TO_DS = 0x01
+FLAG_FROM_DS = 0x02
+FLAG_RETRY = 0x08
+FLAG_ORDER = 0x80
+
+DATA_SUBTYPE_QOS = 0x08
+HT_CONTROL_LENGTH = 4
+QOS_CONTROL_LENGTH = 2
+
+# Frame control, duration and three addresses, each address read as a big endian (u16, u32) pair.
+DOT11_THREE_ADDRESS_HEADER = struct.Struct('>BB2xHIHIHI')
+DOT11_THREE_ADDRESS_HEADER_LENGTH = 24
+DOT11_FOUR_ADDRESS_HEADER_LENGTH = 30
+DOT11_ONE_ADDRESS_HEADER = struct.Struct('>BB2xHI')
+DOT11_TWO_ADDRESS_HEADER = struct.Struct('>BB2xHIHI')
+
+# Control frame subtypes carrying a transmitter address: PS-Poll, RTS, CF-End, CF-End + CF-Ack,
+# Block Ack Request and Block Ack.
+CTL_TWO_ADDRESS_SUBTYPES = frozenset((10, 11, 14, 15, 8, 9))
+
+
+class Dot11Header(namedtuple(
+        'Dot11Header', ['frame_type', 'subtype', 'flags', 'addr1', 'addr2', 'addr3', 'body_offset', 'body_length'])):
+    """
+    A decoded 802.11 MAC header. Addresses are 48 bit integers (None when the frame does not carry them) and
+    the frame body spans body_length bytes from body_offset in the decoded buffer.
+    """
+    __slots__ = ()
+
+    @property
+    def to_ds(self):
+        return bool(self.flags & FLAG_TO_DS)
+
+    @property
+    def from_ds(self):
+        return bool(self.flags & FLAG_FROM_DS)
+
+    @property
+    def retry(self):
+        return bool(self.flags & FLAG_RETRY)
+
+    def data_addresses(self):
+        """
+        The (source, destination, bssid) of a data frame. Frames between distribution systems do not carry a
+        BSSID, their transmitter and receiver addresses are reported as the source and destination.
+        """
+        ds_bits = self.flags & (FLAG_TO_DS | FLAG_FROM_DS)
+        if ds_bits == 0:
+            return self.addr2, self.addr1, self.addr3
+        elif ds_bits == FLAG_TO_DS:
+            return self.addr2, self.addr3, self.addr1
+        elif ds_bits == FLAG_FROM_DS:
+            return self.addr3, self.addr1, self.addr2
+        else:
+            return self.addr2, self.addr1, None
+
+
+def parse_dot11_header(buf, offset=0, end=None):
+    """
+    Decode the 802.11 MAC header starting at offset in buf. end is where the frame stops in buf (i.e. before
+    any FCS) and defaults to the end of buf. Raises DecodeError for truncated headers and for extension
+    frames.
+    """
+    if end is None:
+        end = len(buf)
+    if end - offset < DOT11_ONE_ADDRESS_HEADER.size:
+        raise DecodeError("Frame too short for an 802.11 header: {0} bytes".format(end - offset))
+    frame_control = buf[offset]
+    frame_type = (frame_control >> 2) & 0x03
+    subtype = frame_control >> 4
+
+    if frame_type == CTL_TYPE:
+        if subtype in CTL_TWO_ADDRESS_SUBTYPES:
+            if end - offset < DOT11_TWO_ADDRESS_HEADER.size:
+                raise DecodeError("Truncated control frame header")
+            _, flags, addr1_high, addr1_low, addr2_high, addr2_low = DOT11_TWO_ADDRESS_HEADER.unpack_from(
+                buf, offset
+            )
+            addr2 = (addr2_high << 32) | addr2_low
+            body_offset = offset + DOT11_TWO_ADDRESS_HEADER.size
+        else:
+            _, flags, addr1_high, addr1_low = DOT11_ONE_ADDRESS_HEADER.unpack_from(buf, offset)
+            addr2 = None
+            body_offset = offset + DOT11_ONE_ADDRESS_HEADER.size
+        return Dot11Header(
+            frame_type, subtype, flags, (addr1_high << 32) | addr1_low, addr2, None,
+            body_offset, end - body_offset
+        )
+    elif frame_type != MGMT_TYPE and frame_type != DATA_TYPE:
+        raise DecodeError("Unsupported 802.11 frame type {0}".format(frame_type))
+
+    if end - offset < DOT11_THREE_ADDRESS_HEADER_LENGTH:
+        raise DecodeError("Truncated 802.11 header")
+    (_, flags, addr1_high, addr1_low, addr2_high, addr2_low,
+     addr3_high, addr3_low) = DOT11_THREE_ADDRESS_HEADER.unpack_from(buf, offset)
+    body_offset = offset + DOT11_THREE_ADDRESS_HEADER_LENGTH
+    if frame_type == DATA_TYPE:
+        if flags & FLAG_TO_DS and flags & FLAG_FROM_DS:
+            body_offset = offset + DOT11_FOUR_ADDRESS_HEADER_LENGTH
+        if subtype & DATA_SUBTYPE_QOS:
+            body_offset += QOS_CONTROL_LENGTH
+            if flags & FLAG_ORDER:
+                body_offset += HT_CONTROL_LENGTH
+    elif flags & FLAG_ORDER:
+        body_offset += HT_CONTROL_LENGTH
+    if body_offset > end:
+        raise DecodeError("Truncated 802.11 header")
+    return Dot11Header(
+        frame_type, subtype, flags,
+        (addr1_high << 32) | addr1_low, (addr2_high << 32) | addr2_low, (addr3_high << 32) | addr3_low,
+        body_offset, end - body_offset
+    )
+
+
+# -----------------------------------
+#  BEACONS AND INFORMATION ELEMENTS
+# -----------------------------------
+
+BEACON_FIXED_FIELDS = struct.Struct('<QHH')
+CAPABILITY_PRIVACY = 0x0010
+
+IE_SSID = 0
+IE_RATES = 1
+IE_DS_PARAMETER_SET = 3
+IE_TIM = 5
+IE_COUNTRY = 7
+IE_POWER_CAPABILITY = 33
+IE_RSN = 48
+IE_EXTENDED_RATES = 50
+IE_VENDOR_SPECIFIC = 221
+
+MICROSOFT_WPA_PREFIX = b'\x00\x50\xf2\x01'
+
+
+class BeaconFields(namedtuple('BeaconFields', ['timestamp', 'beacon_interval', 'capability'])):
+    """
+    The fixed fields at the start of a beacon or probe response body. The timestamp is in microseconds and
+    the beacon interval in time units of 1024 microseconds.
+    """
+    __slots__ = ()
+
+    @property
+    def privacy(self):
+        return bool(self.capability & CAPABILITY_PRIVACY)
+
+
+def parse_beacon_fields(buf, offset, end):
+    """
+    Decode the fixed fields of the beacon or probe response body spanning buf[offset:end]. Raises
+    DecodeError if the body is too short.
+    """
+    if end - offset < BEACON_FIXED_FIELDS.size:
+        raise DecodeError("Truncated beacon body")
+    return BeaconFields(*BEACON_FIXED_FIELDS.unpack_from(buf, offset))
+
+
+def iter_information_elements(buf, offset, end):
+    """
+    Walk the information element TLVs in buf[offset:end], yielding (element id, info bytes) pairs. A final
+    element running past end is yielded with its info truncated.
+    """
+    while end - offset >= 2:
+        element_id = buf[offset]
+        info_end = min(offset + 2 + buf[offset + 1], end)
+        yield element_id, bytes(buf[offset + 2:info_end])
+        offset = info_end
+
+
+def information_elements_digest(buf, offset, end):
+    """
+    Digest of the information elements in buf[offset:end], leaving out the TIM element which changes
+    from one beacon to the next.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    # Released on the way out, buf may be a frame of a mapped capture file that is closed afterwards.
+    with memoryview(buf) as view:
+        start = offset
+        while end - offset >= 2:
+            element_end = min(offset + 2 + buf[offset + 1], end)
+            if buf[offset] == IE_TIM:
+                digest.update(view[start:offset])
+                start = element_end
+            offset = element_end
+        digest.update(view[start:end])
+    return digest.digest()
+
+
+def rate_decoder(raw_rate):
+    rates = []
+    for byte in raw_rate:
+        rate_mandatory = bool(byte & 0b10000000)
+        rate_speed_mbps = (byte & 0b01111111) * 0.5
+        rates.append((rate_speed_mbps, rate_mandatory))
+    return rates
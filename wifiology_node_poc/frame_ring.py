@@ -0,0 +1,223 @@
+import multiprocessing
+import struct
+import time
+from multiprocessing import shared_memory
+
+from wifiology_node_poc.pcap_file import PcapRecordHeader
+
+# Control block layout. The producer's fields and the consumer's read position sit on separate cache lines,
+# each field is only ever written by one side.
+HEAD_OFFSET = 0
+OVERRUNS_OFFSET = 8
+HIGH_WATER_OFFSET = 16
+CLOSED_OFFSET = 24
+TAIL_OFFSET = 64
+DATA_OFFSET = 128
+
+POSITION = struct.Struct('<Q')
+# kind, captured length, wire length, timestamp seconds, timestamp microseconds
+RECORD_HEADER = struct.Struct('<IIIII')
+RECORD_ALIGNMENT = 8
+
+RECORD_FRAME = 0
+RECORD_SAMPLE_START = 1
+RECORD_SAMPLE_END = 2
+# Fills the end of the data area when the next record does not fit before it.
+RECORD_WRAP = 0xffffffff
+
+
+def _aligned(size):
+    return (size + RECORD_ALIGNMENT - 1) & ~(RECORD_ALIGNMENT - 1)
+
+
+class FrameRing(object):
+    """
+    Single producer, single consumer ring buffer of frame records in shared memory. The capture process writes
+    each frame into the ring as it is captured and the analysis process reads the frames in place, so frames
+    neither go through a capture file nor get pickled.
+
+    The producer only moves the write position (head) and the consumer the read position (tail), both monotonic
+    byte counts stored as 64 bit words, and each side only publishes its position after it is done with the
+    record. The records themselves are copied without locking, but the positions and the other control words are
+    only read and written holding a multiprocessing lock shared by both sides: Python can't order plain stores to
+    shared memory, so on weakly ordered CPUs such as ARM the new head could otherwise become visible before the
+    record it publishes, and 64 bit stores aren't atomic on every platform. Taking the lock orders the record
+    bytes before the position on both sides. A frame that does not fit in the free space is dropped and counted as
+    an overrun rather than blocking the capture. Besides frames, the producer writes markers delimiting the
+    samples, which are never dropped.
+    """
+    def __init__(self, shared_memory_block, lock, owner=False):
+        self.shared_memory = shared_memory_block
+        self.lock = lock
+        self.owner = owner
+        self.buf = shared_memory_block.buf
+        self.capacity = shared_memory_block.size - DATA_OFFSET
+        self._head = self._load(HEAD_OFFSET)
+        self._tail = self._load(TAIL_OFFSET)
+
+    @classmethod
+    def create(cls, capacity):
+        shared_memory_block = shared_memory.SharedMemory(create=True, size=DATA_OFFSET + _aligned(capacity))
+        shared_memory_block.buf[:DATA_OFFSET] = bytes(DATA_OFFSET)
+        return cls(shared_memory_block, multiprocessing.Lock(), owner=True)
+
+    @classmethod
+    def attach(cls, name, lock):
+        """
+        Attach to the ring created under name, lock being the creating ring's lock, passed on to the process
+        attaching when it is started.
+        """
+        return cls(shared_memory.SharedMemory(name=name), lock)
+
+    @property
+    def name(self):
+        return self.shared_memory.name
+
+    def _load(self, offset):
+        with self.lock:
+            return POSITION.unpack_from(self.buf, offset)[0]
+
+    def _store(self, offset, value):
+        with self.lock:
+            POSITION.pack_into(self.buf, offset, value)
+
+    @property
+    def overrun_count(self):
+        return self._load(OVERRUNS_OFFSET)
+
+    @property
+    def high_water_mark(self):
+        """
+        The most bytes the ring has held since it was created or the mark was last reset.
+        """
+        return self._load(HIGH_WATER_OFFSET)
+
+    @property
+    def closed(self):
+        return bool(self._load(CLOSED_OFFSET))
+
+    # -----------------------------------
+    #  PRODUCER
+    # -----------------------------------
+
+    def _write(self, kind, caplen, length, ts_sec, ts_usec, payload):
+        size = _aligned(RECORD_HEADER.size + caplen)
+        head = self._head
+        position = head % self.capacity
+        contiguous = self.capacity - position
+        needed = size if size <= contiguous else contiguous + size
+        if size > self.capacity or head + needed - self._load(TAIL_OFFSET) > self.capacity:
+            return False
+
+        data = self.buf[DATA_OFFSET:]
+        try:
+            if size > contiguous:
+                if contiguous >= RECORD_HEADER.size:
+                    RECORD_HEADER.pack_into(data, position, RECORD_WRAP, 0, 0, 0, 0)
+                head += contiguous
+                position = 0
+            RECORD_HEADER.pack_into(data, position, kind, caplen, length, ts_sec, ts_usec)
+            if caplen:
+                start = position + RECORD_HEADER.size
+                data[start:start + caplen] = payload
+        finally:
+            data.release()
+        head += size
+        self._head = head
+        with self.lock:
+            used = head - POSITION.unpack_from(self.buf, TAIL_OFFSET)[0]
+            if used > POSITION.unpack_from(self.buf, HIGH_WATER_OFFSET)[0]:
+                POSITION.pack_into(self.buf, HIGH_WATER_OFFSET, used)
+            POSITION.pack_into(self.buf, HEAD_OFFSET, head)
+        return True
+
+    def write_frame(self, header, payload):
+        """
+        Write a captured frame, header being its pcapy (or PcapRecordHeader) packet header. Returns False if the
+        frame was dropped because the ring is full.
+        """
+        ts_sec, ts_usec = header.getts()
+        if self._write(RECORD_FRAME, len(payload), header.getlen(), ts_sec, ts_usec, payload):
+            return True
+        with self.lock:
+            POSITION.pack_into(self.buf, OVERRUNS_OFFSET, POSITION.unpack_from(self.buf, OVERRUNS_OFFSET)[0] + 1)
+        return False
+
+    def write_marker(self, kind, value=0, timeout_seconds=10, poll_seconds=0.001):
+        """
+        Write a marker record carrying value, waiting for the consumer to make room if needed. Raises
+        TimeoutError if the ring stays full for timeout_seconds.
+        """
+        deadline = time.monotonic() + timeout_seconds
+        while not self._write(kind, 0, value, 0, 0, b''):
+            if time.monotonic() > deadline:
+                raise TimeoutError("Frame ring stayed full for {0} seconds.".format(timeout_seconds))
+            time.sleep(poll_seconds)
+
+    def reset_high_water_mark(self):
+        self._store(HIGH_WATER_OFFSET, self._head - self._load(TAIL_OFFSET))
+
+    def close(self):
+        """
+        Mark the end of the records, the consumer stops once it has read the remaining ones.
+        """
+        self._store(CLOSED_OFFSET, 1)
+
+    # -----------------------------------
+    #  CONSUMER
+    # -----------------------------------
+
+    def records(self, wait=True, poll_seconds=0.001):
+        """
+        Yield (kind, header, frame) for each record until the producer closes the ring and the remaining records
+        are read, or until the ring is empty when not waiting. Frames come with a PcapRecordHeader and a
+        memoryview of the frame inside the ring, which is only valid until the next record is requested. Markers
+        come with their value in place of the header and no frame.
+        """
+        capacity = self.capacity
+        data = self.buf[DATA_OFFSET:]
+        try:
+            tail = head = self._tail
+            while True:
+                if tail == head:
+                    # Read closed along with head: the producer publishes its last head before closing.
+                    with self.lock:
+                        closed = POSITION.unpack_from(self.buf, CLOSED_OFFSET)[0]
+                        head = POSITION.unpack_from(self.buf, HEAD_OFFSET)[0]
+                    if tail == head:
+                        if closed or not wait:
+                            return
+                        time.sleep(poll_seconds)
+                        continue
+                position = tail % capacity
+                contiguous = capacity - position
+                if contiguous < RECORD_HEADER.size:
+                    kind = RECORD_WRAP
+                else:
+                    kind, caplen, length, ts_sec, ts_usec = RECORD_HEADER.unpack_from(data, position)
+                if kind == RECORD_WRAP:
+                    tail += contiguous
+                elif kind == RECORD_FRAME:
+                    start = position + RECORD_HEADER.size
+                    frame = data[start:start + caplen]
+                    try:
+                        yield kind, PcapRecordHeader(ts_sec, ts_usec, caplen, length), frame
+                    finally:
+                        frame.release()
+                    tail += _aligned(RECORD_HEADER.size + caplen)
+                else:
+                    yield kind, length, None
+                    tail += _aligned(RECORD_HEADER.size)
+                self._tail = tail
+                self._store(TAIL_OFFSET, tail)
+        finally:
+            data.release()
+
+    def release(self):
+        """
+        Detach from the shared memory, removing it if this side created the ring.
+        """
+        self.buf = None
+        self.shared_memory.close()
+        if self.owner:
+            self.shared_memory.unlink()
@@ -0,0 +1,108 @@
+from collections import OrderedDict
+
+from wifiology_node_poc.queries.core import select_station_ids, select_service_set_ids
+from wifiology_node_poc.queries.kv import kv_store_get, kv_store_set
+
+# Bumped by whoever deletes station or serviceSet rows (the janitor), so that the capture process drops the IDs it
+# cached for them instead of writing measurements against deleted or reused IDs.
+IDENTITY_GENERATION_KEY = "janitor/identity_generation"
+
+
+def bump_identity_generation(transaction):
+    kv_store_set(transaction, IDENTITY_GENERATION_KEY, kv_store_get(transaction, IDENTITY_GENERATION_KEY, 0) + 1)
+
+
+class LRUIdentityMap(object):
+    """
+    Bounded {key: row ID} map evicting the least recently used key, counting hits and misses.
+    """
+    def __init__(self, max_size):
+        if max_size < 1:
+            raise ValueError("The identity map size must be at least 1.")
+        self.max_size = max_size
+        self.ids = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get(self, key):
+        row_id = self.ids.get(key)
+        if row_id is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.ids.move_to_end(key)
+        return row_id
+
+    def put(self, key, row_id):
+        self.ids[key] = row_id
+        self.ids.move_to_end(key)
+        if len(self.ids) > self.max_size:
+            self.ids.popitem(last=False)
+
+    def clear(self):
+        self.ids.clear()
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else None
+
+    def stats(self):
+        return {"size": len(self.ids), "hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate()}
+
+
+class IdentityCache(object):
+    """
+    MAC address to station ID and BSSID to service set ID maps of the capture process's database writer, so that
+    the stations and service sets seen on earlier rounds are written without looking their IDs up again. Only
+    the writer thread may use it.
+
+    Call validate inside the write transaction before fill_ids, and remember only after that transaction
+    committed, so that neither IDs deleted by the janitor nor IDs of rolled back inserts end up in the cache.
+    """
+    def __init__(self, max_size=10000):
+        self.stations = LRUIdentityMap(max_size)
+        self.service_sets = LRUIdentityMap(max_size)
+        self.generation = None
+        self.invalidation_count = 0
+
+    def warm(self, connection):
+        self.generation = kv_store_get(connection, IDENTITY_GENERATION_KEY, 0)
+        # Oldest first, so that the most recently added rows end up as the most recently used.
+        for mac_address, station_id in reversed(select_station_ids(connection, self.stations.max_size)):
+            self.stations.put(mac_address, station_id)
+        for bssid, service_set_id in reversed(select_service_set_ids(connection, self.service_sets.max_size)):
+            self.service_sets.put(bssid, service_set_id)
+        return self
+
+    def validate(self, connection):
+        generation = kv_store_get(connection, IDENTITY_GENERATION_KEY, 0)
+        if generation != self.generation:
+            if self.generation is not None:
+                self.invalidation_count += 1
+            self.stations.clear()
+            self.service_sets.clear()
+            self.generation = generation
+
+    def fill_ids(self, stations, service_sets):
+        for station in stations:
+            if station.station_id is None:
+                station.station_id = self.stations.get(station.mac_address)
+        for service_set in service_sets:
+            if service_set.service_set_id is None:
+                service_set.service_set_id = self.service_sets.get(service_set.bssid)
+
+    def remember(self, stations, service_sets):
+        for station in stations:
+            self.stations.put(station.mac_address, station.station_id)
+        for service_set in service_sets:
+            self.service_sets.put(service_set.bssid, service_set.service_set_id)
+
+    def stats(self):
+        return {
+            "stations": self.stations.stats(),
+            "service_sets": self.service_sets.stats(),
+            "invalidations": self.invalidation_count
+        }
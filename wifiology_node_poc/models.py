@@ -1,9 +1,8 @@
 import inspect
-import math
 from bottle import json_dumps, json_loads
 from hdrh.histogram import HdrHistogram
 
-from wifiology_node_poc.utils import altered_mean, altered_stddev, bytes_to_str
+from wifiology_node_poc.utils import altered_mean, altered_stddev, bytes_to_str, RunningStatistics
 
 
 class RecordObject(object):
@@ -48,7 +47,8 @@ class RecordObject(object):
 
 class Measurement(RecordObject):
     def __init__(self, measurement_id, measurement_start_time, measurement_end_time, measurement_duration,
-                 channel, average_noise, std_dev_noise, has_been_uploaded, extra_data, data_counters=None):
+                 channel, average_noise, std_dev_noise, has_been_uploaded, extra_data, data_counters=None,
+                 pcap_received=None, pcap_dropped=None, pcap_interface_dropped=None, channel_switch_seconds=None):
         self.measurement_id = measurement_id
         self.measurement_start_time = measurement_start_time
         self.measurement_end_time = measurement_end_time
@@ -59,6 +59,10 @@ class Measurement(RecordObject):
         self.has_been_uploaded = has_been_uploaded
         self.extra_data = extra_data
         self.data_counters = data_counters
+        self.pcap_received = pcap_received
+        self.pcap_dropped = pcap_dropped
+        self.pcap_interface_dropped = pcap_interface_dropped
+        self.channel_switch_seconds = channel_switch_seconds
 
     def __repr__(self):
         return "Measurement(measurementID={id}, startTime={st}, endTime={et}, duration={d}, channel={c}, " \
@@ -82,12 +86,17 @@ class Measurement(RecordObject):
                 row[prefix + "stdDevNoise"],
                 row[prefix + "hasBeenUploaded"],
                 cls._json_loads(row[prefix + "extraJSONData"]),
-                data_counters=data_counters
+                data_counters=data_counters,
+                pcap_received=row[prefix + "pcapReceived"],
+                pcap_dropped=row[prefix + "pcapDropped"],
+                pcap_interface_dropped=row[prefix + "pcapInterfaceDropped"],
+                channel_switch_seconds=row[prefix + "channelSwitchSeconds"]
             )
 
     @classmethod
     def new(cls, start_time, end_time, duration, channel, noise_measurements, has_been_uploaded=False,
-            extra_data=None, data_counters=None):
+            extra_data=None, data_counters=None, pcap_received=None, pcap_dropped=None,
+            pcap_interface_dropped=None, channel_switch_seconds=None):
         return cls(
             None,
             start_time,
@@ -98,7 +107,11 @@ class Measurement(RecordObject):
             altered_stddev(noise_measurements),
             has_been_uploaded,
             extra_data or {},
-            data_counters=data_counters
+            data_counters=data_counters,
+            pcap_received=pcap_received,
+            pcap_dropped=pcap_dropped,
+            pcap_interface_dropped=pcap_interface_dropped,
+            channel_switch_seconds=channel_switch_seconds
         )
 
     def to_row(self, prefix=""):
@@ -111,7 +124,11 @@ class Measurement(RecordObject):
             prefix + 'averageNoise': self.average_noise,
             prefix + 'stdDevNoise': self.std_dev_noise,
             prefix + 'hasBeenUploaded': 1 if self.has_been_uploaded else 0,
-            prefix + 'extraJSONData': self._json_dumps(self.extra_data)
+            prefix + 'extraJSONData': self._json_dumps(self.extra_data),
+            prefix + 'pcapReceived': self.pcap_received,
+            prefix + 'pcapDropped': self.pcap_dropped,
+            prefix + 'pcapInterfaceDropped': self.pcap_interface_dropped,
+            prefix + 'channelSwitchSeconds': self.channel_switch_seconds
         }
         return base_row
 
@@ -125,7 +142,11 @@ class Measurement(RecordObject):
             'averageNoise': self.average_noise,
             'stdDevNoise': self.std_dev_noise,
             'hasBeenUploaded': self.has_been_uploaded,
-            'extraData': self.extra_data
+            'extraData': self.extra_data,
+            'pcapReceived': self.pcap_received,
+            'pcapDropped': self.pcap_dropped,
+            'pcapInterfaceDropped': self.pcap_interface_dropped,
+            'channelSwitchSeconds': self.channel_switch_seconds
         }
         if self.data_counters:
             base_response.update(self.data_counters.to_api_response())
@@ -284,12 +305,17 @@ class ServiceSet(RecordObject):
 
 
 class DataCounters(RecordObject):
+    """
+    Frame counters for a station (or a whole measurement). Power and rate measurements are folded into
+    running statistics as they are added; the raw samples are only kept in power_measurements and
+    rate_measurements with keep_samples (or when they are passed in).
+    """
     def __init__(self, management_frame_count, association_frame_count, reassocation_frame_coumt,
                  disassociation_frame_count, control_frame_count, rts_frame_count, cts_frame_count,
                  ack_frame_count, data_frame_count, data_throughput_in, data_throughput_out,
                  retry_frame_count, average_power=None, std_dev_power=None,
                  lowest_rate=None, higest_rate=None, failed_fcs_count=None,
-                 power_measurements=None, rate_measurements=None):
+                 power_measurements=None, rate_measurements=None, keep_samples=False):
         self.management_frame_count = management_frame_count
         self.association_frame_count = association_frame_count
         self.reassociation_frame_count = reassocation_frame_coumt
@@ -306,8 +332,15 @@ class DataCounters(RecordObject):
         self._std_dev_power = std_dev_power
         self._lowest_rate = lowest_rate
         self._highest_rate = higest_rate
-        self.power_measurements = power_measurements or []
-        self.rate_measurements = rate_measurements or []
+        self.keep_samples = keep_samples or bool(power_measurements) or bool(rate_measurements)
+        self.power_measurements = list(power_measurements or [])
+        self.rate_measurements = list(rate_measurements or [])
+        self.power_statistics = RunningStatistics()
+        self.rate_statistics = RunningStatistics()
+        for power in self.power_measurements:
+            self.power_statistics.push(power)
+        for rate in self.rate_measurements:
+            self.rate_statistics.push(rate)
         self.failed_fcs_count = failed_fcs_count
 
     def __repr__(self):
@@ -330,34 +363,62 @@ DataCounters(
             ffcs=self.failed_fcs_count
         ).strip()
 
+    def add_power_measurement(self, power):
+        self.power_statistics.push(power)
+        if self.keep_samples:
+            self.power_measurements.append(power)
+
+    def add_rate_measurement(self, rate):
+        self.rate_statistics.push(rate)
+        if self.keep_samples:
+            self.rate_measurements.append(rate)
+
     @property
     def average_power(self):
-        if self.power_measurements:
-            return altered_mean(self.power_measurements)
+        if self.power_statistics.count:
+            return self.power_statistics.average
         else:
             return self._average_power
 
     @property
     def std_dev_power(self):
-        if self.power_measurements:
-            return altered_stddev(self.power_measurements)
+        if self.power_statistics.count:
+            return self.power_statistics.std_dev
         else:
             return self._std_dev_power
 
     @property
     def highest_rate(self):
-        if self.rate_measurements:
-            return max(self.rate_measurements)
+        if self.rate_statistics.count:
+            return self.rate_statistics.maximum
         else:
             return self._highest_rate
 
     @property
     def lowest_rate(self):
-        if self.rate_measurements:
-            return min(self.rate_measurements)
+        if self.rate_statistics.count:
+            return self.rate_statistics.minimum
         else:
             return self._lowest_rate
 
+    @property
+    def power_statistics_estimated(self):
+        """
+        Whether the power statistics are only known from a stored average and standard deviation, i.e. counters
+        loaded from rows written without the power sums or added up from such counters.
+        """
+        return not self.power_statistics.count and self._average_power is not None
+
+    def _power_statistics_estimate(self):
+        """
+        The power statistics, approximated from the stored average and standard deviation (weighted by the
+        frame count) for counters loaded from rows written without the power sums.
+        """
+        if not self.power_statistics_estimated:
+            return self.power_statistics
+        count = max(self.total_frame_count, 1)
+        return RunningStatistics(count, self._average_power, (self._std_dev_power or 0.0) ** 2 * (count - 1))
+
     @property
     def total_frame_count(self):
         return self.management_frame_count + self.control_frame_count + self.data_frame_count
@@ -367,7 +428,7 @@ DataCounters(
         if row is None:
             return None
         else:
-            return cls(
+            data_counters = cls(
                 row[prefix + "managementFrameCount"],
                 row[prefix + "associationFrameCount"],
                 row[prefix + "reassociationFrameCount"],
@@ -386,14 +447,19 @@ DataCounters(
                 higest_rate=row[prefix + "highestRate"],
                 failed_fcs_count=row["failedFCSCount"]
             )
+            if prefix + "powerCount" in row.keys() and row[prefix + "powerCount"]:
+                data_counters.power_statistics = RunningStatistics.from_sums(
+                    row[prefix + "powerCount"], row[prefix + "powerSum"], row[prefix + "powerSumSquares"]
+                )
+            return data_counters
 
     @classmethod
     def new(cls, *args, **kwargs):
         return cls(*args, **kwargs)
 
     @classmethod
-    def zero(cls):
-        return cls(0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, failed_fcs_count=0)
+    def zero(cls, keep_samples=False):
+        return cls(0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, failed_fcs_count=0, keep_samples=keep_samples)
 
     def add(self, other):
         if not isinstance(other, DataCounters):
@@ -413,28 +479,22 @@ DataCounters(
             self.retry_frame_count + other.retry_frame_count,
         )
         result.failed_fcs_count = (self.failed_fcs_count or 0) + (other.failed_fcs_count or 0)
-
-        if self.power_measurements and other.power_measurements:
+        result.keep_samples = self.keep_samples and other.keep_samples
+        if result.keep_samples:
             result.power_measurements = self.power_measurements + other.power_measurements
-        else:
-            power_frame_count = 0
-            power_weighted_avg_sum = 0
-            power_weighted_variance_sum = 0
-            if self.average_power is not None:
-                power_frame_count += self.total_frame_count
-                power_weighted_avg_sum += self.total_frame_count * self.average_power
-                power_weighted_variance_sum += self.total_frame_count * (self.std_dev_power**2)
-            if other.average_power is not None:
-                power_frame_count += other.total_frame_count
-                power_weighted_avg_sum += other.total_frame_count * other.average_power
-                power_weighted_variance_sum += other.total_frame_count * (other.std_dev_power**2)
-
-            if power_frame_count:
-                result._average_power = power_weighted_avg_sum/power_frame_count
-                result._std_dev_power = math.sqrt(power_weighted_variance_sum/power_frame_count)
-
-        if self.rate_measurements and other.rate_measurements:
             result.rate_measurements = self.rate_measurements + other.rate_measurements
+
+        power_statistics = self._power_statistics_estimate().merge(other._power_statistics_estimate())
+        if self.power_statistics_estimated or other.power_statistics_estimated:
+            # Kept as an average and standard deviation only, so the estimate is never written as exact sums.
+            result._average_power = power_statistics.average
+            result._std_dev_power = power_statistics.std_dev
+        else:
+            result.power_statistics = power_statistics
+
+        if (self.rate_statistics.count or self._lowest_rate is None) and \
+                (other.rate_statistics.count or other._lowest_rate is None):
+            result.rate_statistics = self.rate_statistics.merge(other.rate_statistics)
         else:
             if self.lowest_rate is not None and other.lowest_rate is not None:
                 result._lowest_rate = min(self.lowest_rate, other.lowest_rate)
@@ -454,6 +514,9 @@ DataCounters(
         return self.add(other)
 
     def to_row(self, prefix=""):
+        # Counters loaded from rows without the power sums (or added up from them) have no exact statistics to
+        # write back.
+        power_statistics = None if self.power_statistics_estimated else self.power_statistics
         return {
             prefix + 'managementFrameCount': self.management_frame_count,
             prefix + 'associationFrameCount': self.association_frame_count,
@@ -471,7 +534,10 @@ DataCounters(
             prefix + 'stdDevPower': self.std_dev_power,
             prefix + 'lowestRate': self.lowest_rate,
             prefix + 'highestRate': self.highest_rate,
-            prefix + 'failedFCSCount': self.failed_fcs_count
+            prefix + 'failedFCSCount': self.failed_fcs_count,
+            prefix + 'powerCount': power_statistics.count if power_statistics is not None else None,
+            prefix + 'powerSum': power_statistics.total if power_statistics is not None else None,
+            prefix + 'powerSumSquares': power_statistics.total_squares if power_statistics is not None else None
         }
 
     def to_api_response(self):
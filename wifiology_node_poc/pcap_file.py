@@ -0,0 +1,167 @@
+import mmap
+import os
+import struct
+import logging
+import weakref
+from array import array
+from collections import namedtuple
+
+from wifiology_node_poc.decoders import DecodeError
+
+pcap_logger = logging.getLogger(__name__)
+
+PCAP_MAGIC_MICROSECONDS = 0xa1b2c3d4
+PCAP_MAGIC_NANOSECONDS = 0xa1b23c4d
+PCAP_GLOBAL_HEADER_LENGTH = 24
+PCAP_RECORD_HEADER_LENGTH = 16
+
+LINKTYPE_IEEE802_11_RADIOTAP = 127
+
+
+class PcapRecordHeader(namedtuple('PcapRecordHeader', ['ts_sec', 'ts_usec', 'caplen', 'length'])):
+    """
+    A pcap record header, with the accessors of the pcapy packet header so it can be handed to
+    CaptureAnalyzer.process_frame in place of one.
+    """
+    __slots__ = ()
+
+    def getts(self):
+        return self.ts_sec, self.ts_usec
+
+    def getcaplen(self):
+        return self.caplen
+
+    def getlen(self):
+        return self.length
+
+
+class PcapFile(object):
+    """
+    Reader for pcap capture files that maps the file into memory instead of reading it. Frames are yielded as
+    memoryview slices of the mapping, released as soon as the next frame is requested, so they must be copied to be
+    kept around.
+
+    Frames can be read from any frame index on: index() finds the offset of every record in the file by hopping
+    from record header to record header, and frames() takes the offset of its first frame so that a resumed or
+    split analysis does not need to scan the file again.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self.file_size = os.fstat(self._file.fileno()).st_size
+            if self.file_size < PCAP_GLOBAL_HEADER_LENGTH:
+                raise DecodeError("{0} is too short for a pcap file: {1} bytes".format(path, self.file_size))
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except BaseException:
+            self._file.close()
+            raise
+        self._view = memoryview(self._mmap)
+        self._index = None
+        self._frame_iterators = weakref.WeakSet()
+
+        magic, = struct.unpack_from('<I', self._mmap, 0)
+        if magic in (PCAP_MAGIC_MICROSECONDS, PCAP_MAGIC_NANOSECONDS):
+            byte_order = '<'
+        else:
+            byte_order = '>'
+            magic, = struct.unpack_from('>I', self._mmap, 0)
+            if magic not in (PCAP_MAGIC_MICROSECONDS, PCAP_MAGIC_NANOSECONDS):
+                self.close()
+                raise DecodeError("{0} is not a pcap file, magic number {1:#x}".format(path, magic))
+        self.nanosecond_timestamps = magic == PCAP_MAGIC_NANOSECONDS
+        self._record_header = struct.Struct(byte_order + 'IIII')
+        (self.version_major, self.version_minor, _, _,
+         self.snaplen, self.linktype) = struct.unpack_from(byte_order + 'HHiIII', self._mmap, 4)
+        if self.linktype != LINKTYPE_IEEE802_11_RADIOTAP:
+            self.close()
+            raise ValueError("{0} is not a radiotap capture, link type {1}".format(path, self.linktype))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """
+        Unmap and close the file. Raises BufferError if a memoryview of the mapping other than the yielded frames
+        is still alive.
+        """
+        if self._file.closed:
+            return
+        # Release the current frame of unfinished iterations too, e.g. one left behind by an exception.
+        for frame_iterator in list(self._frame_iterators):
+            frame_iterator.close()
+        self._view.release()
+        try:
+            self._mmap.close()
+        finally:
+            self._file.close()
+
+    @property
+    def closed(self):
+        return self._mmap.closed
+
+    def index(self):
+        """
+        The file offsets of every record, in frame order. Built on the first call only.
+        """
+        if self._index is None:
+            index = array('Q')
+            unpack_from = self._record_header.unpack_from
+            offset = PCAP_GLOBAL_HEADER_LENGTH
+            file_size = self.file_size
+            while offset + PCAP_RECORD_HEADER_LENGTH <= file_size:
+                caplen = unpack_from(self._mmap, offset)[2]
+                if offset + PCAP_RECORD_HEADER_LENGTH + caplen > file_size:
+                    break
+                index.append(offset)
+                offset += PCAP_RECORD_HEADER_LENGTH + caplen
+            self._index = index
+        return self._index
+
+    def frame_count(self):
+        return len(self.index())
+
+    def frames(self, first_frame=0, end_frame=None, offset=None):
+        """
+        Yield the (record header, frame) pairs of frames first_frame up to (not including) end_frame. offset is
+        the file offset of first_frame's record if it is already known, otherwise it is looked up in index().
+        A record cut short by the end of the file, as left behind by an interrupted capture, ends the frames.
+        """
+        frame_iterator = self._frames(first_frame, end_frame, offset)
+        self._frame_iterators.add(frame_iterator)
+        return frame_iterator
+
+    def _frames(self, first_frame, end_frame, offset):
+        if offset is None:
+            if first_frame == 0:
+                offset = PCAP_GLOBAL_HEADER_LENGTH
+            else:
+                index = self.index()
+                if first_frame >= len(index):
+                    return
+                offset = index[first_frame]
+        remaining = -1 if end_frame is None else end_frame - first_frame
+
+        unpack_from = self._record_header.unpack_from
+        view = self._view
+        file_size = self.file_size
+        nanosecond_timestamps = self.nanosecond_timestamps
+        while remaining != 0 and offset + PCAP_RECORD_HEADER_LENGTH <= file_size:
+            ts_sec, ts_fraction, caplen, length = unpack_from(view, offset)
+            start = offset + PCAP_RECORD_HEADER_LENGTH
+            offset = start + caplen
+            if offset > file_size:
+                pcap_logger.warning("Truncated final record in {0}".format(self.path))
+                return
+            if nanosecond_timestamps:
+                ts_fraction //= 1000
+            frame = view[start:offset]
+            try:
+                yield PcapRecordHeader(ts_sec, ts_fraction, caplen, length), frame
+            finally:
+                # Released once the consumer moved on (or gave up), so that none keeps the mapping open.
+                frame.release()
+            remaining -= 1
@@ -1,36 +1,50 @@
-import pcapy
-import dpkt
+import pyric
 import pyric.pyw as pyw
 import timerfd
 import select
 import requests
 from urllib.parse import urljoin
-from scapy.layers import dot11
 
 import argparse
 import logging
 import time
-import functools
 import os
-from wifiology_node_poc.utils import altered_stddev, altered_mean, bytes_to_str
-from collections import defaultdict
+import re
+import csv
+import queue
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from wifiology_node_poc.utils import altered_mean
 from bottle import json_dumps
 
 
-from wifiology_node_poc.core_sqlite import create_connection, transaction_wrapper, optimize_db, vacuum_db
-from wifiology_node_poc.queries.core import write_schema, insert_measurement, insert_service_set_infrastructure_station, \
-    insert_station, insert_service_set, select_station_by_mac_address, \
-    select_service_set_by_bssid, insert_measurement_station, \
-    insert_service_set_associated_station, update_service_set_network_name, select_measurements_that_need_upload, \
+from wifiology_node_poc.core_sqlite import create_connection, transaction_wrapper, deferred_transaction_wrapper, \
+    optimize_db, vacuum_db, CONNECTION_PROFILES
+from wifiology_node_poc.queries.core import write_schema, insert_measurement, select_measurements_that_need_upload, \
     update_measurements_upload_status, select_stations_for_measurement, select_service_sets_for_measurement, \
     select_associated_mac_addresses_for_measurement_service_set, \
     select_infrastructure_mac_addresses_for_measurement_service_set, delete_old_measurements, \
-    insert_jitter_measurement, select_jitter_measurements_by_measurement_id
-from wifiology_node_poc.queries.kv import kv_store_set, kv_store_get
-from wifiology_node_poc.models import Measurement, \
-    Station, ServiceSet, DataCounters, ServiceSetJitterMeasurement
+    select_jitter_measurements_by_measurement_id, select_channel_activity, insert_stage_timings, \
+    write_staging_schema, bulk_insert_measurement_stations, bulk_insert_service_sets, insert_jitter_measurements, \
+    bulk_insert_service_set_stations, bulk_update_service_set_network_names, delete_orphaned_stations, \
+    delete_orphaned_service_sets
+from wifiology_node_poc.queries.kv import kv_store_set
+from wifiology_node_poc.models import ServiceSetJitterMeasurement
+from wifiology_node_poc.analysis import CaptureAnalyzer, BeaconCache
+from wifiology_node_poc.vectorized_analysis import VectorizedCaptureAnalyzer
+from wifiology_node_poc.pcap_file import PcapFile
+from wifiology_node_poc.frame_ring import FrameRing, RECORD_FRAME, RECORD_SAMPLE_START, RECORD_SAMPLE_END
+from wifiology_node_poc.stage_timing import StageTimer, StageTimingSummary, STAGE_CHANNEL_SWITCH, \
+    STAGE_LIVE_CAPTURE, STAGE_OFFLINE_ANALYSIS, STAGE_DB_WRITE, STAGE_OPTIMIZE_DB, SWEEP_LATENCY
+from wifiology_node_poc.identity_cache import IdentityCache, bump_identity_generation
+from wifiology_node_poc.write_behind import WriteBehindWriter
 from wifiology_node_poc import LOG_FORMAT
 from wifiology_node_poc.watchdog import run_monitored
+from wifiology_node_poc.capture_control import AdaptiveBufferSizer, DEFAULT_CAPTURE_BUFFER_SIZE, MEGABYTE, \
+    DEFAULT_DATA_SNAPLEN, MIN_DATA_SNAPLEN, MAX_SNAPLEN, attach_socket_filter, header_only_filter_program, \
+    DwellScheduler, CAPTURE_CHANNELS, split_channel_plan
 
 
 # -----------------------------------
@@ -40,6 +54,11 @@ from wifiology_node_poc.watchdog import run_monitored
 capture_argument_parser = argparse.ArgumentParser('wifiology_capture')
 capture_argument_parser.add_argument("interface", type=str, help="The WiFi interface to capture on.")
 capture_argument_parser.add_argument("tmp_dir", type=str, help="The temporary storage directory (preferably tmpfs)")
+capture_argument_parser.add_argument(
+    "-i", "--extra-interface", type=str, action="append", default=[], dest="extra_interfaces",
+    help="Another WiFi interface to capture on at the same time, may be given more than once. The channels of "
+         "each sweep are split between the interfaces."
+)
 capture_argument_parser.add_argument("-l", "--log-file", type=str, default="-", help="Log file.")
 capture_argument_parser.add_argument("-v", "--verbose", action="store_true", help="Verbose mode.")
 capture_argument_parser.add_argument(
@@ -48,6 +67,19 @@ capture_argument_parser.add_argument(
 capture_argument_parser.add_argument(
     "-db", "--database-loc", default=":memory:"
 )
+capture_argument_parser.add_argument(
+    "--sweep-seconds", type=float, default=None,
+    help="Split this many seconds per sweep across the channels by their recent activity, instead of sampling "
+         "every channel for --sample-seconds."
+)
+capture_argument_parser.add_argument(
+    "--min-dwell-seconds", type=float, default=2,
+    help="The least number of seconds spent on each channel per sweep when splitting a sweep budget."
+)
+capture_argument_parser.add_argument(
+    "--dwell-history-sweeps", type=int, default=3,
+    help="The number of past sweeps whose measurements decide the split of the sweep budget."
+)
 capture_argument_parser.add_argument(
     "-r", "--capture-rounds", default=0, type=int,
     help="The number of rounds of captures to run before exiting. 0 will run forever."
@@ -57,12 +89,111 @@ capture_argument_parser.add_argument(
     help="Ignore that the current user is not the root user."
 )
 capture_argument_parser.add_argument(
-    "--db-timeout-seconds", type=int, default=60,
-    help="The timeout to set on the database connection"
+    "--db-timeout-seconds", type=int, default=None,
+    help="The timeout to set on the database connection, instead of the busy timeout of its --db-profile."
+)
+capture_argument_parser.add_argument(
+    "--db-profile", type=str, choices=sorted(CONNECTION_PROFILES), default="writer",
+    help="The SQLite connection profile (journal mode, synchronous, cache and mmap sizes) to use."
+)
+capture_argument_parser.add_argument(
+    "--pipelined", action="store_true",
+    help="Capture the next channel while previous captures are analyzed and written in separate stages. "
+         "Requires an on-disk database."
+)
+capture_argument_parser.add_argument(
+    "--analysis-workers", type=int, default=1,
+    help="The number of offline analysis worker processes to use in pipelined mode."
+)
+capture_argument_parser.add_argument(
+    "--streaming-analysis", action="store_true",
+    help="Analyze frames as they are captured instead of writing them to a pcap file in the tmp dir first."
+)
+capture_argument_parser.add_argument(
+    "--ring-analysis", action="store_true",
+    help="Analyze frames as they are captured in a separate process, fed through a shared memory ring buffer."
+)
+capture_argument_parser.add_argument(
+    "--ring-mb", type=float, default=16,
+    help="The size of the shared memory ring buffer in megabytes in ring analysis mode."
+)
+capture_argument_parser.add_argument(
+    "--vectorized-analysis", action="store_true",
+    help="Decode and aggregate the frames of each capture in blocks with NumPy array operations instead of frame by "
+         "frame."
+)
+capture_argument_parser.add_argument(
+    "--analysis-chunks", type=int, default=0,
+    help="Split each capture file into chunks analyzed in parallel by this many worker processes. "
+         "Not supported together with pipelined or streaming analysis."
+)
+capture_argument_parser.add_argument(
+    "--keep-pcap", action="store_true",
+    help="Debug option: keep the raw capture files in the tmp dir instead of removing them after analysis."
+)
+capture_argument_parser.add_argument(
+    "--buffer-mb", type=float, default=DEFAULT_CAPTURE_BUFFER_SIZE / MEGABYTE,
+    help="The capture buffer size in megabytes (the starting size in adaptive buffer mode)."
+)
+capture_argument_parser.add_argument(
+    "--adaptive-buffer", action="store_true",
+    help="Grow or shrink the capture buffer of each channel based on the kernel drop rate seen on it."
+)
+capture_argument_parser.add_argument(
+    "--min-buffer-mb", type=float, default=2,
+    help="The smallest capture buffer size in megabytes allowed in adaptive buffer mode."
+)
+capture_argument_parser.add_argument(
+    "--max-buffer-mb", type=float, default=64,
+    help="The largest capture buffer size in megabytes allowed in adaptive buffer mode."
+)
+capture_argument_parser.add_argument(
+    "--header-only", action="store_true",
+    help="Only capture the headers of data frames. Management and control frames are still captured in full."
+)
+capture_argument_parser.add_argument(
+    "--header-only-snaplen", type=int, default=DEFAULT_DATA_SNAPLEN,
+    help="The number of bytes after the radiotap header to keep of each data frame in header only mode, at least "
+         "{0}.".format(MIN_DATA_SNAPLEN)
+)
+capture_argument_parser.add_argument(
+    "--pipeline-queue-size", type=int, default=2,
+    help="The maximum number of captures/results waiting between pipeline stages."
+)
+capture_argument_parser.add_argument(
+    "--write-behind", action="store_true",
+    help="Write the analysis results from a separate thread, several captures per transaction, so that database "
+         "locks held by the other scripts don't stall the capture. Not supported together with pipelined capture."
+)
+capture_argument_parser.add_argument(
+    "--write-queue-size", type=int, default=8,
+    help="The maximum number of analyzed captures kept in memory waiting for the write-behind writer."
+)
+capture_argument_parser.add_argument(
+    "--write-batch-size", type=int, default=4,
+    help="The maximum number of captures the write-behind writer writes in one transaction."
+)
+capture_argument_parser.add_argument(
+    "--write-journal", action="store_true",
+    help="Journal every analyzed capture to the tmp dir until it is written, instead of blocking the capture "
+         "when the write queue is full. Journaled captures left by a crash are written on the next start."
+)
+capture_argument_parser.add_argument(
+    "--identity-cache-size", type=int, default=10000,
+    help="The number of station and service set IDs each kept in memory by the database writer, 0 to disable."
 )
 
 procedure_logger = logging.getLogger(__name__)
 
+# Upper bound on how long the kernel holds captured frames back before making them readable.
+CAPTURE_BUFFER_TIMEOUT_MS = 100
+
+# Captures are not split into chunks smaller than this, the per chunk overhead would outweigh the gain.
+MIN_ANALYSIS_CHUNK_FRAMES = 10000
+
+# The beacon cache of an analysis worker process in a process pool, see worker_beacon_cache.
+_worker_beacon_cache = None
+
 
 class StopException(Exception):
     pass
@@ -72,90 +203,45 @@ def raise_stop(*args, **kwargs):
     raise StopException
 
 
-def binary_to_mac(bin):
-    if isinstance(bin, bytes):
-        return ':'.join(("{:02x}".format(c)) for c in bin)
-    else:
-        return ':'.join(("{:02x}".format(ord(c))) for c in bin)
-
-
-def calculate_beacon_jitter(timing_measurements, bssid):
-    if not timing_measurements or len(timing_measurements) < 2:
-        return None, None, None
-    measurements, intervals = zip(*timing_measurements)
-    sorted_measurements = sorted(measurements)
-    intervals = list(set(intervals))
-    if len(intervals) > 1:
-        procedure_logger.warning(
-            "BSSID {0} has multiple reported intervals! Something funny is going on...".format(bssid)
-        )
-        procedure_logger.warning("Intervals seen: {0}".format(intervals))
-        bad_intervals = True
-    else:
-        bad_intervals = False
-    chosen_interval = intervals[0]
-    jitter = [
-        (sorted_measurements[i] - sorted_measurements[i-1]) - (chosen_interval*1024)
-        for i in range(1, len(sorted_measurements))
-    ]
-    return jitter, bad_intervals, intervals
-
-
-def patched_network_stats(pkt):
-    summary = {}
-    crypto = set()
-    p = pkt.payload
-    while isinstance(p, dot11.Dot11Elt):
-        if p.ID == 0:
-            summary["ssid"] = bytes_to_str(p.info)
-        elif p.ID == 3:
-            summary["channel"] = p.info[0]
-        elif p.ID == 7:
-            summary["country"] = bytes_to_str(p.info[0:2])
-        elif p.ID == 33:
-            summary["power_capability"] = {
-                "min": p.info[0],
-                "max": p.info[1]
-            }
-        elif isinstance(p, dot11.Dot11EltRates):
-            summary["rates"] = p.rates
-        elif isinstance(p, dot11.Dot11EltRSN):
-            crypto.add("WPA2")
-        elif p.ID == 221:
-            if isinstance(p, dot11.Dot11EltMicrosoftWPA):
-                crypto.add("WPA")
-        p = p.payload
-    if not crypto:
-        if pkt.cap.privacy:
-            crypto.add("WEP")
-        else:
-            crypto.add("OPN")
-    summary["crypto"] = list(crypto)
-    return summary
-
-
-def has_bad_fcs(flags):
-    if len(flags.data) > 0:
-        return flags.data[0] & 0x40
-    else:
-        return False
-
-
-def sum_data_counters(data_counters):
-    return functools.reduce(lambda x, y: x + y, data_counters, DataCounters.zero())
-
-
 def capture_argparse_args_to_kwargs(args):
+    if args.header_only and not MIN_DATA_SNAPLEN <= args.header_only_snaplen <= MAX_SNAPLEN:
+        capture_argument_parser.error("--header-only-snaplen must be between {0} and {1} bytes.".format(
+            MIN_DATA_SNAPLEN, MAX_SNAPLEN
+        ))
     return {
         'wireless_interface': args.interface,
+        'extra_interfaces': args.extra_interfaces,
         'log_file': args.log_file,
         'tmp_dir': args.tmp_dir,
         'verbose': args.verbose,
         'sample_seconds': args.sample_seconds,
+        'sweep_seconds': args.sweep_seconds,
+        'min_dwell_seconds': args.min_dwell_seconds,
+        'dwell_history_sweeps': args.dwell_history_sweeps,
         'database_loc': args.database_loc,
         'rounds': args.capture_rounds,
         'ignore_non_root': args.ignore_non_root,
-        'db_timeout_seconds': args.db_timeout_seconds
+        'db_timeout_seconds': args.db_timeout_seconds,
+        'db_profile': args.db_profile,
+        'pipelined': args.pipelined,
+        'analysis_workers': args.analysis_workers,
+        'pipeline_queue_size': args.pipeline_queue_size,
+        'streaming_analysis': args.streaming_analysis,
+        'ring_analysis': args.ring_analysis,
+        'ring_size': int(args.ring_mb * MEGABYTE),
+        'vectorized_analysis': args.vectorized_analysis,
+        'analysis_chunks': args.analysis_chunks,
+        'keep_pcap': args.keep_pcap,
+        'buffer_size': int(args.buffer_mb * MEGABYTE),
+        'adaptive_buffer': args.adaptive_buffer,
+        'min_buffer_size': int(args.min_buffer_mb * MEGABYTE),
+        'max_buffer_size': int(args.max_buffer_mb * MEGABYTE),
+        'data_snaplen': args.header_only_snaplen if args.header_only else None,
+        'identity_cache_size': args.identity_cache_size,
+        'write_behind': args.write_behind,
+        'write_queue_size': args.write_queue_size,
+        'write_batch_size': args.write_batch_size,
+        'write_journal': args.write_journal
     }
 
 
@@ -178,15 +264,6 @@ def setup_logging(log_file, verbose):
         root_logger.setLevel(logging.WARNING)
 
 
-def rate_decoder(raw_rate):
-    rates = []
-    for byte in raw_rate:
-        rate_mandatory = bool(byte & 0b10000000)
-        rate_speed_mbps = (byte & 0b01111111) * 0.5
-        rates.append((rate_speed_mbps, rate_mandatory))
-    return rates
-
-
 def setup_capture_card(wireless_interface):
     procedure_logger.info("Loading card handle from interface name..")
     card = pyw.getcard(wireless_interface)
@@ -200,276 +277,282 @@ def setup_capture_card(wireless_interface):
     return card
 
 
-def run_live_capture(wireless_interface, capture_file, sample_seconds):
+def open_pcap_handle(wireless_interface, buffer_size=DEFAULT_CAPTURE_BUFFER_SIZE, data_snaplen=None):
+    """
+    Create and activate a non-blocking pcap handle on the interface. If data_snaplen is given, data frames are
+    truncated in the kernel to the radiotap header plus data_snaplen bytes, while management and control frames
+    are still captured in full.
+    """
+    # Imported here so that the analysis, ingest, upload and janitor code doesn't need libpcap.
+    import pcapy
+
     pcap_dev = pcapy.create(wireless_interface)
     pcap_dev.set_snaplen(65535)
-    pcap_dev.set_timeout(0)
+    pcap_dev.set_timeout(CAPTURE_BUFFER_TIMEOUT_MS)
     pcap_dev.set_promisc(True)
-    pcap_dev.set_buffer_size(15 * 1024 * 1024)
+    pcap_dev.set_buffer_size(buffer_size)
 
-    procedure_logger.info("Opening capture file: {0}".format(capture_file))
     procedure_logger.info("Arming and activating live capture...")
     pcap_dev.activate()
+    pcap_dev.setnonblock(1)
+    if data_snaplen is not None:
+        procedure_logger.info("Header only capture: data frames truncated to {0} bytes.".format(data_snaplen))
+        attach_socket_filter(pcap_dev.getfd(), header_only_filter_program(data_snaplen))
+    return pcap_dev
+
+
+def flush_pcap_handle(pcap_dev):
+    """
+    Discard the frames buffered on a non-blocking pcap handle, returning how many there were.
+    """
+    flushed_count = 0
+    while True:
+        count = pcap_dev.dispatch(-1, lambda hdr, data: None)
+        if count <= 0:
+            return flushed_count
+        flushed_count += count
+
+
+class CaptureInterface(object):
+    """
+    A monitor mode interface kept ready for capturing across channel hops. Channels are switched with a netlink
+    chset alone instead of taking the interface down and up first, and the pcap handle stays open from one
+    capture to the next instead of being created and activated for every channel. The frames still buffered from
+    the previous channel are flushed before each capture.
+
+    The dead air of a hop, from the start of the channel switch to the start of the next capture, is reported by
+    run_live_capture as channel_switch_seconds.
+    """
+    def __init__(self, wireless_interface):
+        self.wireless_interface = wireless_interface
+        self.card = setup_capture_card(wireless_interface)
+        self.pcap_dev = None
+        self.pcap_settings = None
+        self.switch_start_time = None
+        self.chset_only = True
+
+    def set_channel(self, channel):
+        procedure_logger.info("Changing to channel {0}".format(channel))
+        self.switch_start_time = time.time()
+        if self.chset_only:
+            try:
+                pyw.chset(self.card, channel, None)
+                return
+            except pyric.error as e:
+                procedure_logger.warning(
+                    "Changing channels on {0} without cycling the interface failed ({1}), cycling it from now "
+                    "on.".format(self.wireless_interface, e)
+                )
+                self.chset_only = False
+        # The pcap handle does not survive the interface going down.
+        self.close()
+        pyw.down(self.card)
+        pyw.up(self.card)
+        pyw.chset(self.card, channel, None)
+
+    def pcap_handle(self, buffer_size=DEFAULT_CAPTURE_BUFFER_SIZE, data_snaplen=None):
+        """
+        The open pcap handle, reopened if the buffer size or snap length changed since it was opened.
+        """
+        if self.pcap_dev is not None and self.pcap_settings != (buffer_size, data_snaplen):
+            self.close()
+        if self.pcap_dev is None:
+            self.pcap_dev = open_pcap_handle(self.wireless_interface, buffer_size, data_snaplen)
+            self.pcap_settings = (buffer_size, data_snaplen)
+        return self.pcap_dev
+
+    def close(self):
+        if self.pcap_dev is not None:
+            self.pcap_dev.close()
+            self.pcap_dev = None
+
+
+def run_live_capture(wireless_interface, capture_file, sample_seconds, frame_callback=None,
+                     buffer_size=DEFAULT_CAPTURE_BUFFER_SIZE, data_snaplen=None, capture_interface=None):
+    """
+    Capture on the interface for sample_seconds. Frames are dumped to capture_file (if not None) and/or
+    handed to frame_callback(header, payload) as they arrive.
+
+    The pcap handle is put in non-blocking mode and waited on together with the sample timer through
+    epoll; each wakeup drains all buffered frames with a single dispatch call. Returns the start and end
+    time, the sample duration and a dict of capture statistics, including the kernel's pcap counters.
+
+    If data_snaplen is given, data frames are truncated in the kernel to the radiotap header plus
+    data_snaplen bytes, while management and control frames are still captured in full.
+
+    With a CaptureInterface, its persistent pcap handle is used instead of a new one and the time since its
+    last channel switch is reported as channel_switch_seconds.
+    """
+    if capture_interface is None:
+        pcap_dev = open_pcap_handle(wireless_interface, buffer_size, data_snaplen)
+        flushed_count = 0
+    else:
+        pcap_dev = capture_interface.pcap_handle(buffer_size, data_snaplen)
+        flushed_count = flush_pcap_handle(pcap_dev)
+    # The pcap counters of a reused handle count from when it was activated.
+    received_before, dropped_before, interface_dropped_before = pcap_dev.stats()
+    procedure_logger.info("Opening capture file: {0}".format(capture_file))
     timer_fd = timerfd.create(timerfd.CLOCK_MONOTONIC, 0)
+    epoll = select.epoll()
     try:
+        epoll.register(timer_fd, select.EPOLLIN)
+        epoll.register(pcap_dev.getfd(), select.EPOLLIN)
         timerfd.settime(timer_fd, 0, sample_seconds, 0)
         start_time = time.time()
 
-        dumper = pcap_dev.dump_open(capture_file)
+        dumper = pcap_dev.dump_open(capture_file) if capture_file is not None else None
+        if dumper is not None and frame_callback is not None:
+            def on_frame(hdr, data):
+                dumper.dump(hdr, data)
+                frame_callback(hdr, data)
+        elif dumper is not None:
+            on_frame = dumper.dump
+        elif frame_callback is not None:
+            on_frame = frame_callback
+        else:
+            def on_frame(hdr, data):
+                pass
 
-        hdr, data = pcap_dev.next()
-        while hdr and not select.select([timer_fd], [], [], 0)[0]:
-            dumper.dump(hdr, data)
-            hdr, data = pcap_dev.next()
-        dumper.close()
-        pcap_dev.close()
+        frame_count = 0
+        loop_wakeups = 0
+        timer_expired = False
+        while not timer_expired:
+            events = epoll.poll()
+            loop_wakeups += 1
+            for fd, _ in events:
+                if fd == timer_fd:
+                    timer_expired = True
+                else:
+                    frame_count += pcap_dev.dispatch(-1, on_frame)
+        if dumper is not None:
+            dumper.close()
+        pcap_received, pcap_dropped, pcap_interface_dropped = pcap_dev.stats()
+        pcap_received -= received_before
+        pcap_dropped -= dropped_before
+        pcap_interface_dropped -= interface_dropped_before
+        if capture_interface is None:
+            pcap_dev.close()
         end_time = time.time()
-        return start_time, end_time, sample_seconds
+        capture_stats = {
+            'frame_count': frame_count,
+            'loop_wakeups': loop_wakeups,
+            'frames_per_second': frame_count / (end_time - start_time) if end_time > start_time else 0.0,
+            'capture_buffer_size': buffer_size,
+            'pcap_received': pcap_received,
+            'pcap_dropped': pcap_dropped,
+            'pcap_interface_dropped': pcap_interface_dropped
+        }
+        if capture_interface is not None:
+            capture_stats['flushed_frame_count'] = flushed_count
+            if capture_interface.switch_start_time is not None:
+                capture_stats['channel_switch_seconds'] = start_time - capture_interface.switch_start_time
+                capture_interface.switch_start_time = None
+        procedure_logger.info(
+            "Captured {0} frames ({1:.1f} frames/s) in {2} loop wakeups.".format(
+                frame_count, capture_stats['frames_per_second'], loop_wakeups
+            )
+        )
+        procedure_logger.info(
+            "pcap stats: {0} received, {1} dropped, {2} dropped by the interface.".format(
+                pcap_received, pcap_dropped, pcap_interface_dropped
+            )
+        )
+        return start_time, end_time, sample_seconds, capture_stats
     finally:
+        epoll.close()
         os.close(timer_fd)
 
 
-def run_offline_analysis(capture_file, start_time, end_time, sample_seconds, channel):
-    weird_frame_count = 0
-
-    bssid_to_ssid_map = {}
-    bssid_infra_macs = defaultdict(set)
-    bssid_associated_macs = defaultdict(set)
-    bssid_beacon_timing_payloads = defaultdict(list)
-    bssid_beacon_data = {}
-    bssid_to_jitter_map = {}
-    bssid_to_power_map = defaultdict(list)
-
-    noise_measurements = []
-    action_counter = 0
-    probe_req_counter = 0
-
-    station_counters = defaultdict(DataCounters.zero)
-
-    pcap_offline_dev = pcapy.open_offline(capture_file)
-    header, payload = pcap_offline_dev.next()
-
-    while header:
-        try:
-            # Use Scapy for the RadioTap decoding as dpkt's Radiotap decoder is totally broken.
-            radiotap_frame = dot11.RadioTap(payload)
+def create_analyzer(channel, beacon_cache=None, vectorized_analysis=False):
+    analyzer_class = VectorizedCaptureAnalyzer if vectorized_analysis else CaptureAnalyzer
+    return analyzer_class(channel, beacon_cache=beacon_cache)
 
-            if radiotap_frame.dBm_AntNoise is not None:
-                noise_measurements.append(radiotap_frame.dBm_AntNoise)
 
-            frame = dpkt.radiotap.Radiotap(payload).data
-            frame_type = frame.type
-            frame_subtype = frame.subtype
+def run_streaming_capture(wireless_interface, capture_file, sample_seconds, channel,
+                          buffer_size=DEFAULT_CAPTURE_BUFFER_SIZE, data_snaplen=None, beacon_cache=None,
+                          vectorized_analysis=False, capture_interface=None):
+    """
+    Capture and analyze in one pass, without going through a pcap file on disk. capture_file may be
+    given to additionally keep a copy of the raw frames for debugging. Returns the analysis data and
+    the capture statistics.
+    """
+    analyzer = create_analyzer(channel, beacon_cache=beacon_cache, vectorized_analysis=vectorized_analysis)
+    start_time, end_time, duration, capture_stats = run_live_capture(
+        wireless_interface, capture_file, sample_seconds, frame_callback=analyzer.process_frame,
+        buffer_size=buffer_size, data_snaplen=data_snaplen, capture_interface=capture_interface
+    )
+    return analyzer.results(start_time, end_time, duration, capture_stats=capture_stats), capture_stats
 
-            if frame_type == dpkt.ieee80211.MGMT_TYPE:
-                mac = binary_to_mac(frame.mgmt.src)
-                current_counter = station_counters[mac]
-                current_counter.management_frame_count += 1
 
-                if frame_subtype == dpkt.ieee80211.M_BEACON:
-                    beacon = dot11.Dot11Beacon(frame.beacon.pack())
-                    bssid = binary_to_mac(frame.mgmt.bssid)
+def analyze_capture_file(capture_file, channel, beacon_cache=None, vectorized_analysis=False):
+    analyzer = create_analyzer(channel, beacon_cache=beacon_cache, vectorized_analysis=vectorized_analysis)
+    with PcapFile(capture_file) as pcap:
+        for header, payload in pcap.frames():
+            analyzer.process_frame(header, payload)
+    return analyzer
 
-                    try:
-                        beacon_data = bssid_beacon_data[bssid] = patched_network_stats(beacon)
-                        target_channel = beacon_data.get("channel")
-                    except:
-                        procedure_logger.exception("Failed to decode network stats...")
-                        target_channel = None
-
-                    if hasattr(frame, 'ssid'):
-                        bssid_to_ssid_map[bssid] = frame.ssid.data
-                        bssid_infra_macs[bssid].add(mac)
-                    if target_channel is None or target_channel == channel:
-                        bssid_beacon_timing_payloads[bssid].append((beacon.timestamp, beacon.beacon_interval))
-                        if radiotap_frame.dBm_AntSignal is not None:
-                            bssid_to_power_map[bssid].append(radiotap_frame.dBm_AntSignal)
-                    else:
-                        procedure_logger.warning(
-                            "Off channel beacon ({0} vs {1}) seen for BSSID {2}"
-                            "".format(target_channel, channel, bssid)
-                        )
 
-                if frame_subtype == dpkt.ieee80211.M_PROBE_RESP:
-                    if hasattr(frame, 'ssid'):
-                        bssid = binary_to_mac(frame.mgmt.bssid)
-                        bssid_to_ssid_map[bssid] = frame.ssid.data
-                        bssid_infra_macs[bssid].add(mac)
-
-                if frame_subtype in (dpkt.ieee80211.M_ASSOC_REQ, dpkt.ieee80211.M_ASSOC_RESP):
-                    current_counter.association_frame_count += 1
-                if frame_subtype in (dpkt.ieee80211.M_REASSOC_REQ, dpkt.ieee80211.M_REASSOC_RESP):
-                    current_counter.reassociation_frame_count += 1
-                if frame_subtype == dpkt.ieee80211.M_DISASSOC:
-                    current_counter.disassociation_frame_count += 1
-                if frame_subtype == dpkt.ieee80211.M_ACTION:
-                    action_counter += 1
-                if frame_subtype == dpkt.ieee80211.M_PROBE_REQ:
-                    probe_req_counter += 1
-                if frame.retry:
-                    current_counter.retry_frame_count += 1
-                if radiotap_frame.dBm_AntSignal is not None:
-                    current_counter.power_measurements.append(radiotap_frame.dBm_AntSignal)
-                if radiotap_frame.Rate is not None:
-                    current_counter.rate_measurements.append(radiotap_frame.Rate)
-                if radiotap_frame.Flags.badFCS is not None:
-                    current_counter.failed_fcs_count += (1 if radiotap_frame.Flags.badFCS else 0)
-
-            elif frame_type == dpkt.ieee80211.CTL_TYPE:
-                include_in_extra_measurements = True
-
-                if frame_subtype == dpkt.ieee80211.C_RTS:
-                    mac = binary_to_mac(frame.rts.src)
-                    current_counter = station_counters[mac]
-                    current_counter.cts_frame_count += 1
-
-                elif frame_subtype == dpkt.ieee80211.C_CTS:
-                    mac = binary_to_mac(frame.cts.dst)
-                    include_in_extra_measurements = False
-                    current_counter = station_counters[mac]
-                    current_counter.rts_frame_count += 1
-
-                elif frame_subtype == dpkt.ieee80211.C_ACK:
-                    mac = binary_to_mac(frame.ack.dst)
-                    include_in_extra_measurements = False
-                    current_counter = station_counters[mac]
-                    current_counter.ack_frame_count += 1
-
-                elif frame_subtype == dpkt.ieee80211.C_BLOCK_ACK:
-                    mac = binary_to_mac(frame.back.src)
-                    current_counter = station_counters[mac]
-
-                elif frame_subtype == dpkt.ieee80211.C_BLOCK_ACK_REQ:
-                    mac = binary_to_mac(frame.bar.src)
-                    current_counter = station_counters[mac]
-
-                elif frame_subtype == dpkt.ieee80211.C_CF_END:
-                    mac = binary_to_mac(frame.cf_end.src)
-                    current_counter = station_counters[mac]
-                else:
-                    continue
-                if frame.retry:
-                    current_counter.retry_frame_count += 1
-                if include_in_extra_measurements:
-                    current_counter.control_frame_count += 1
-                    if radiotap_frame.dBm_AntSignal is not None:
-                        current_counter.power_measurements.append(radiotap_frame.dBm_AntSignal)
-                    if radiotap_frame.Rate is not None:
-                        current_counter.rate_measurements.append(radiotap_frame.Rate)
-                    if radiotap_frame.Flags.badFCS is not None:
-                        current_counter.failed_fcs_count += (1 if radiotap_frame.Flags.badFCS else 0)
-
-            elif frame_type == dpkt.ieee80211.DATA_TYPE:
-                src_mac = binary_to_mac(frame.data_frame.src)
-                dst_mac = binary_to_mac(frame.data_frame.dst)
-                if hasattr(frame.data_frame, 'bssid'):
-                    bssid = binary_to_mac(frame.data_frame.bssid)
-                else:
-                    bssid = None
-
-                current_counter = station_counters[src_mac]
-                dst_current_counter = station_counters[dst_mac]
-
-                if frame.to_ds and bssid:
-                    bssid_infra_macs[bssid].add(dst_mac)
-                    bssid_associated_macs[bssid].add(src_mac)
-                elif frame.from_ds and bssid:
-                    bssid_infra_macs[bssid].add(src_mac)
-                    bssid_associated_macs[bssid].add(dst_mac)
-                current_counter.data_throughput_out += len(frame.data_frame.data)
-                dst_current_counter.data_throughput_in += len(frame.data_frame.data)
-
-                current_counter.data_frame_count += 1
-                if frame.retry:
-                    current_counter.retry_frame_count += 1
-                if radiotap_frame.dBm_AntSignal is not None:
-                    current_counter.power_measurements.append(radiotap_frame.dBm_AntSignal)
-                if radiotap_frame.Rate is not None:
-                    current_counter.rate_measurements.append(radiotap_frame.Rate)
-                if radiotap_frame.Flags.badFCS is not None:
-                    current_counter.failed_fcs_count += (1 if radiotap_frame.Flags.badFCS else 0)
-            else:
-                pass
-
-        except dpkt.dpkt.UnpackError:
-            logging.warning(
-                "dpkt lacks support for some IE80211 features. This could be causing spurious decode problems.",
-                exc_info=True
-            )
-            weird_frame_count += 1
-        header, payload = pcap_offline_dev.next()
-    pcap_offline_dev.close()
-
-    measurement = Measurement.new(
-        start_time,
-        end_time,
-        sample_seconds,
-        channel,
-        noise_measurements,
-        data_counters=sum_data_counters(station_counters.values()),
-        extra_data={
-            'weird_frame_count': weird_frame_count
-        }
+def run_offline_analysis(capture_file, start_time, end_time, sample_seconds, channel, capture_stats=None,
+                         beacon_cache=None, vectorized_analysis=False):
+    analyzer = analyze_capture_file(
+        capture_file, channel, beacon_cache=beacon_cache, vectorized_analysis=vectorized_analysis
     )
-
-    stations = [
-        Station.new(mac_addr) for mac_addr in station_counters.keys()
-    ]
-
-    service_sets = [
-        ServiceSet.new(bssid, network_name=bssid_to_ssid_map.get(bssid), extra_data=bssid_beacon_data.get(bssid, {}))
-        for bssid in set(bssid_infra_macs.keys()).union(set(bssid_associated_macs.keys()))
-    ]
-    for service_set in service_sets:
-        jitter, bad_intervals, intervals = calculate_beacon_jitter(
-            bssid_beacon_timing_payloads.get(service_set.bssid), service_set.bssid
+    return analyzer.results(start_time, end_time, sample_seconds, capture_stats=capture_stats)
+
+
+def worker_beacon_cache():
+    """
+    The beacon cache of the current process pool worker, kept across the jobs the worker runs.
+    """
+    global _worker_beacon_cache
+    if _worker_beacon_cache is None:
+        _worker_beacon_cache = BeaconCache()
+    return _worker_beacon_cache
+
+
+def analyze_capture_chunk(capture_file, channel, first_frame, end_frame, offset, vectorized_analysis=False):
+    """
+    Map step of the chunked offline analysis: analyze frames first_frame up to (not including) end_frame
+    of the capture file, the first of them at file offset offset, and return the analyzer's partial
+    aggregates. Runs in a worker process, which keeps its own beacon cache across chunks.
+    """
+    analyzer = create_analyzer(channel, beacon_cache=worker_beacon_cache(), vectorized_analysis=vectorized_analysis)
+    with PcapFile(capture_file) as pcap:
+        for header, payload in pcap.frames(first_frame, end_frame, offset=offset):
+            analyzer.process_frame(header, payload)
+    return analyzer.partial()
+
+
+def run_chunked_offline_analysis(capture_file, start_time, end_time, sample_seconds, channel, executor,
+                                 chunk_count, capture_stats=None, vectorized_analysis=False):
+    """
+    Offline analysis split over chunk_count frame ranges of the capture file, analyzed on executor (a
+    ProcessPoolExecutor). The partial aggregates are merged in capture order, so the beacon jitter is
+    still computed on all the beacon timestamps of the capture.
+    """
+    with PcapFile(capture_file) as pcap:
+        frame_offsets = pcap.index()
+    frame_count = len(frame_offsets)
+    chunk_frames = max(-(-frame_count // max(chunk_count, 1)), MIN_ANALYSIS_CHUNK_FRAMES)
+    futures = [
+        executor.submit(
+            analyze_capture_chunk, capture_file, channel, first_frame, min(first_frame + chunk_frames, frame_count),
+            frame_offsets[first_frame], vectorized_analysis
         )
-        if jitter is not None:
-            bssid_to_jitter_map[service_set.bssid] = (
-                jitter, bad_intervals, intervals
-            )
-    procedure_logger.info("-----------------")
-    procedure_logger.info("Analysis performed on channel: {0}".format(channel))
-    procedure_logger.info("Noise Level: {0} +/- {1} dBm".format(measurement.average_noise, measurement.std_dev_noise))
-    procedure_logger.info("Top level result:\n{0}".format(repr(measurement.data_counters)))
-    procedure_logger.info("Action Frames: {0}".format(action_counter))
-    procedure_logger.info("Probe Request Frames: {0}".format(probe_req_counter))
-    if service_sets:
-        procedure_logger.info("Service Sets seen:")
-        for service_set in service_sets:
-            jitter, bad_intervals, intervals = bssid_to_jitter_map.get(service_set.bssid, (None, None, None))
-            procedure_logger.info("-- {0} ({1})".format(service_set.bssid, service_set.network_name))
-            if bad_intervals:
-                procedure_logger.info("---- Changing intervals detected!!!")
-                procedure_logger.info("---- Intervals Seen: {0}".format(intervals))
-            if jitter:
-                procedure_logger.info(
-                    "---- Avg +/- StdDev Beacon Jitter: {0} +/- {1} (ms)".format(
-                        altered_mean(jitter)/1000.0, altered_stddev(jitter)/1000.0
-                    )
-                )
-                procedure_logger.info(
-                    "---- Min/Max Beacon Jitter: {0}/{1} (ms)".format(
-                         min(jitter)/1000.0, max(jitter)/1000.0
-                    )
-                )
-                procedure_logger.info("---- Jitter Count: {0}".format(len(jitter)))
-    procedure_logger.info("{0} unique stations seen.".format(len(stations)))
-    procedure_logger.info("-----------------")
-    return {
-        'measurement': measurement,
-        'stations': stations,
-        'service_sets': service_sets,
-        'station_counters': station_counters,
-        'bssid_associated_macs': bssid_associated_macs,
-        'bssid_infra_macs': bssid_infra_macs,
-        'bssid_to_ssid_map': bssid_to_ssid_map,
-        'bssid_to_jitter_map': bssid_to_jitter_map,
-        'bssid_to_power_map': bssid_to_power_map
-    }
-
-
-def write_offline_analysis_to_database(db_conn, analysis_data):
+        for first_frame in range(0, frame_count, chunk_frames)
+    ]
+    procedure_logger.info("Analyzing {0} frames in {1} chunk(s)...".format(frame_count, len(futures)))
+    analyzer = create_analyzer(channel, vectorized_analysis=vectorized_analysis)
+    for future in futures:
+        analyzer.merge(future.result())
+    return analyzer.results(start_time, end_time, sample_seconds, capture_stats=capture_stats)
+
+
+def write_analysis_data(transaction, analysis_data, identity_cache=None):
+    """
+    Write the analysis data of a capture inside the caller's transaction. The caller validates the identity cache
+    in that transaction beforehand and remembers the IDs once it committed.
+    """
     measurement = analysis_data['measurement']
     stations = analysis_data['stations']
     service_sets = analysis_data['service_sets']
@@ -480,59 +563,564 @@ def write_offline_analysis_to_database(db_conn, analysis_data):
     bssid_to_jitter_map = analysis_data['bssid_to_jitter_map']
     bssid_to_power_map = analysis_data['bssid_to_power_map']
 
+    if identity_cache is not None:
+        identity_cache.fill_ids(stations, service_sets)
+    measurement.measurement_id = insert_measurement(
+        transaction, measurement
+    )
+    bulk_insert_measurement_stations(transaction, measurement.measurement_id, stations, station_counters)
+    bulk_insert_service_sets(transaction, service_sets)
+    jitter_measurements = []
+    for service_set in service_sets:
+        if service_set.bssid in bssid_to_jitter_map:
+            jitter, bad_intervals, intervals = bssid_to_jitter_map[service_set.bssid]
+            jitter_measurements.append(
+                ServiceSetJitterMeasurement.new(
+                    measurement.measurement_id, service_set.service_set_id, jitter,
+                    intervals[0], {
+                        'bad_intervals': bad_intervals,
+                        'average_power': altered_mean(bssid_to_power_map.get(service_set.bssid, []))
+                    }
+                )
+            )
+    insert_jitter_measurements(transaction, jitter_measurements)
+    bulk_insert_service_set_stations(
+        transaction, measurement.measurement_id, bssid_infra_macs, bssid_associated_macs
+    )
+    bulk_update_service_set_network_names(transaction, bssid_to_ssid_map)
+
+
+def write_analysis_batch(db_conn, analysis_batch, identity_cache=None, transaction_hook=None):
+    write_staging_schema(db_conn)
     with transaction_wrapper(db_conn) as t:
-        measurement.measurement_id = insert_measurement(
-            t, measurement
+        if identity_cache is not None:
+            identity_cache.validate(t)
+        for analysis_data in analysis_batch:
+            write_analysis_data(t, analysis_data, identity_cache)
+        if transaction_hook is not None:
+            transaction_hook(t)
+    if identity_cache is not None:
+        for analysis_data in analysis_batch:
+            identity_cache.remember(analysis_data['stations'], analysis_data['service_sets'])
+
+
+def write_offline_analysis_to_database(db_conn, analysis_data, optimize=True, identity_cache=None):
+    write_analysis_batch(db_conn, [analysis_data], identity_cache)
+    if optimize:
+        optimize_db(db_conn)
+
+
+def write_timed_analysis_batch_to_database(db_conn, analysis_batch, timing_summary=None, identity_cache=None,
+                                           transaction_hook=None):
+    """
+    Write the analysis data of several captures in one transaction, storing the stage timings each capture came
+    with (analysis_data["stage_timings"]) plus the database write in that same transaction. The stored write time
+    is split evenly between the captures and can't include the commit itself; the timing summary gets the whole
+    transaction including the commit, and the optimize_db time that follows it.
+    """
+    stage_timers = [StageTimer(analysis_data.get('stage_timings')) for analysis_data in analysis_batch]
+    wall_start, cpu_start = time.perf_counter(), time.thread_time()
+
+    def insert_timings(transaction):
+        if transaction_hook is not None:
+            transaction_hook(transaction)
+        wall_seconds = (time.perf_counter() - wall_start) / len(analysis_batch)
+        cpu_seconds = (time.thread_time() - cpu_start) / len(analysis_batch)
+        for analysis_data, stage_timer in zip(analysis_batch, stage_timers):
+            stage_timer.record(STAGE_DB_WRITE, wall_seconds, cpu_seconds)
+            insert_stage_timings(transaction, analysis_data['measurement'].measurement_id, stage_timer.timings)
+
+    write_analysis_batch(db_conn, analysis_batch, identity_cache, insert_timings)
+    batch_timer = StageTimer({STAGE_DB_WRITE: (time.perf_counter() - wall_start, time.thread_time() - cpu_start)})
+    with batch_timer.stage(STAGE_OPTIMIZE_DB):
+        optimize_db(db_conn)
+    if timing_summary is None:
+        return
+    for stage_timer in stage_timers:
+        for stage_name, (wall_seconds, cpu_seconds) in batch_timer.timings.items():
+            stage_timer.record(stage_name, wall_seconds / len(analysis_batch), cpu_seconds / len(analysis_batch))
+        timing_summary.record(stage_timer.timings)
+
+
+def write_timed_analysis_to_database(db_conn, analysis_data, timing_summary=None, identity_cache=None):
+    write_timed_analysis_batch_to_database(db_conn, [analysis_data], timing_summary, identity_cache)
+
+
+def remove_capture_file(capture_file):
+    procedure_logger.info("Cleaning up capture file..")
+    if os.path.exists(capture_file):
+        os.unlink(capture_file)
+
+
+def run_analysis_stage(analysis_queue, result_queue, keep_pcap=False, vectorized_analysis=False):
+    """
+    Worker process body for the analysis stage of the capture pipeline. Pulls capture jobs off of the
+    analysis queue until a None sentinel is seen, passing the sentinel on to the write stage.
+    """
+    beacon_cache = BeaconCache()
+    while True:
+        job = analysis_queue.get()
+        if job is None:
+            result_queue.put(None)
+            return
+        capture_file, start_time, end_time, duration, channel, capture_stats, stage_timings = job
+        try:
+            procedure_logger.info("Starting offline analysis of {0}...".format(capture_file))
+            stage_timer = StageTimer(stage_timings)
+            with stage_timer.stage(STAGE_OFFLINE_ANALYSIS):
+                data = run_offline_analysis(
+                    capture_file, start_time, end_time, duration, channel, capture_stats, beacon_cache=beacon_cache,
+                    vectorized_analysis=vectorized_analysis
+                )
+            data['stage_timings'] = stage_timer.timings
+            result_queue.put(data)
+        except Exception:
+            procedure_logger.exception("Offline analysis failed for capture file {0}".format(capture_file))
+        finally:
+            if not keep_pcap:
+                remove_capture_file(capture_file)
+
+
+class CapturePipeline(object):
+    """
+    Three stage capture pipeline: the caller captures, analysis worker processes decode the capture files
+    and a writer thread (with its own database connection) writes the results. The stages are connected
+    by bounded queues, so a slow analysis or write stage eventually blocks the capture stage instead of
+    piling up capture files in the tmp dir.
+
+    With zero analysis workers only the write stage runs, for captures that were already analyzed
+    while streaming (see submit_results).
+    """
+    def __init__(self, database_loc, db_timeout_seconds=None, analysis_workers=1, queue_size=2,
+                 heartbeat_func=lambda: None, put_timeout_seconds=1, keep_pcap=False, vectorized_analysis=False,
+                 timing_summary=None, identity_cache=None, db_profile="writer"):
+        if database_loc == ":memory:":
+            raise ValueError("Pipelined capture requires an on-disk database.")
+        if analysis_workers < 0:
+            raise ValueError("The number of analysis workers can not be negative.")
+        self.keep_pcap = keep_pcap
+        self.vectorized_analysis = vectorized_analysis
+        self.database_loc = database_loc
+        self.db_timeout_seconds = db_timeout_seconds
+        self.db_profile = db_profile
+        self.analysis_worker_count = analysis_workers
+        self.heartbeat_func = heartbeat_func
+        self.put_timeout_seconds = put_timeout_seconds
+        self.timing_summary = timing_summary
+        self.identity_cache = identity_cache
+
+        self.analysis_queue = multiprocessing.Queue(queue_size)
+        self.result_queue = multiprocessing.Queue(queue_size)
+        self.analysis_workers = []
+        self.writer_thread = None
+        self.writer_connection = None
+        self.writer_exception = None
+        self.written_count = 0
+
+    def start(self):
+        for _ in range(self.analysis_worker_count):
+            worker = multiprocessing.Process(
+                target=run_analysis_stage,
+                args=(self.analysis_queue, self.result_queue, self.keep_pcap, self.vectorized_analysis),
+                daemon=True
+            )
+            worker.start()
+            procedure_logger.info("Analysis worker started, PID: {0}".format(worker.pid))
+            self.analysis_workers.append(worker)
+        self.writer_thread = threading.Thread(target=self._write_stage, name="capture-db-writer", daemon=True)
+        self.writer_thread.start()
+        return self
+
+    def _write_stage(self):
+        db_conn = create_connection(self.database_loc, timeout=self.db_timeout_seconds, profile=self.db_profile)
+        self.writer_connection = db_conn
+        try:
+            workers_running = max(self.analysis_worker_count, 1)
+            while workers_running:
+                data = self.result_queue.get()
+                if data is None:
+                    workers_running -= 1
+                    continue
+                procedure_logger.info("Writing analysis data to database...")
+                write_timed_analysis_to_database(db_conn, data, self.timing_summary, self.identity_cache)
+                self.written_count += 1
+                procedure_logger.info("Data written...")
+        except BaseException as e:
+            procedure_logger.exception("Unhandled exception in the pipeline write stage!")
+            self.writer_exception = e
+        finally:
+            db_conn.close()
+
+    def check(self):
+        if self.writer_exception is not None:
+            raise RuntimeError("Pipeline write stage failed.") from self.writer_exception
+        if not self.writer_thread.is_alive():
+            raise RuntimeError("Pipeline write stage is not running.")
+        for worker in self.analysis_workers:
+            if not worker.is_alive():
+                raise RuntimeError("Analysis worker {0} died with exit code {1}".format(worker.pid, worker.exitcode))
+
+    def submit(self, capture_file, start_time, end_time, duration, channel, capture_stats=None, stage_timings=None):
+        """
+        Hand a finished capture to the analysis stage. Ownership of the capture file passes to the
+        pipeline, which removes it once analyzed. Blocks while the analysis queue is full.
+        """
+        if not self.analysis_workers:
+            raise ValueError("This pipeline has no analysis stage.")
+        self._put(
+            self.analysis_queue, (capture_file, start_time, end_time, duration, channel, capture_stats, stage_timings)
+        )
+
+    def submit_results(self, analysis_data):
+        """
+        Hand already analyzed capture data straight to the write stage.
+        """
+        self._put(self.result_queue, analysis_data)
+
+    def _put(self, target_queue, item):
+        while True:
+            self.check()
+            try:
+                target_queue.put(item, timeout=self.put_timeout_seconds)
+                return
+            except queue.Full:
+                self.heartbeat_func()
+
+    def close(self):
+        """
+        Drain the pipeline: every submitted capture is analyzed and written before this returns.
+        """
+        for _ in self.analysis_workers:
+            self.analysis_queue.put(None)
+        if not self.analysis_workers:
+            self.result_queue.put(None)
+        for worker in self.analysis_workers:
+            while worker.is_alive():
+                self.heartbeat_func()
+                worker.join(self.put_timeout_seconds)
+        while self.writer_thread.is_alive():
+            self.heartbeat_func()
+            self.writer_thread.join(self.put_timeout_seconds)
+        if self.writer_exception is not None:
+            raise RuntimeError("Pipeline write stage failed.") from self.writer_exception
+
+    def terminate(self):
+        for worker in self.analysis_workers:
+            if worker.is_alive():
+                worker.terminate()
+
+
+def run_ring_analysis_stage(ring_name, ring_lock, partial_queue, vectorized_analysis=False):
+    """
+    Process body of the ring analysis stage. Analyzes the frames of each sample in place in the frame ring,
+    sending the partial analysis back once the sample is over, until the ring is closed.
+    """
+    ring = FrameRing.attach(ring_name, ring_lock)
+    beacon_cache = BeaconCache()
+    analyzer = None
+    try:
+        for kind, header, payload in ring.records():
+            if kind == RECORD_FRAME:
+                if analyzer is not None:
+                    analyzer.process_frame(header, payload)
+            elif kind == RECORD_SAMPLE_START:
+                analyzer = create_analyzer(header, beacon_cache=beacon_cache, vectorized_analysis=vectorized_analysis)
+            elif kind == RECORD_SAMPLE_END and analyzer is not None:
+                partial_queue.put(analyzer.partial())
+                analyzer = None
+    finally:
+        ring.release()
+
+
+class RingAnalysisStage(object):
+    """
+    Streaming analysis in a separate process: the capture process writes frames straight into a shared memory
+    FrameRing and the analysis process reads them in place. Only the partial analysis of each sample is sent
+    back, through a queue. Frames dropped because the ring was full are reported in the capture statistics
+    along with the ring's high-water mark.
+    """
+    def __init__(self, ring_size, vectorized_analysis=False, heartbeat_func=lambda: None, poll_timeout_seconds=1):
+        self.ring_size = ring_size
+        self.vectorized_analysis = vectorized_analysis
+        self.heartbeat_func = heartbeat_func
+        self.poll_timeout_seconds = poll_timeout_seconds
+        self.ring = None
+        self.partial_queue = multiprocessing.Queue()
+        self.analysis_process = None
+
+    def start(self):
+        self.ring = FrameRing.create(self.ring_size)
+        self.analysis_process = multiprocessing.Process(
+            target=run_ring_analysis_stage,
+            args=(self.ring.name, self.ring.lock, self.partial_queue, self.vectorized_analysis), daemon=True
+        )
+        self.analysis_process.start()
+        procedure_logger.info("Ring analysis process started, PID: {0}".format(self.analysis_process.pid))
+        return self
+
+    def capture(self, wireless_interface, capture_file, sample_seconds, channel,
+                buffer_size=DEFAULT_CAPTURE_BUFFER_SIZE, data_snaplen=None, capture_interface=None):
+        """
+        Capture a sample into the ring, returning its analysis data and the capture statistics.
+        """
+        ring = self.ring
+        overruns_before = ring.overrun_count
+        ring.reset_high_water_mark()
+        ring.write_marker(RECORD_SAMPLE_START, channel)
+        start_time, end_time, duration, capture_stats = run_live_capture(
+            wireless_interface, capture_file, sample_seconds, frame_callback=ring.write_frame,
+            buffer_size=buffer_size, data_snaplen=data_snaplen, capture_interface=capture_interface
         )
-        for station in stations:
-            opt_station = select_station_by_mac_address(t, station.mac_address)
-            if opt_station:
-                station.station_id = opt_station.station_id
+        ring.write_marker(RECORD_SAMPLE_END)
+        capture_stats['ring_overruns'] = ring.overrun_count - overruns_before
+        capture_stats['ring_high_water_mark'] = ring.high_water_mark
+        if capture_stats['ring_overruns']:
+            procedure_logger.warning(
+                "{0} frames dropped, the frame ring was full.".format(capture_stats['ring_overruns'])
+            )
+
+        while True:
+            try:
+                analyzer = self.partial_queue.get(timeout=self.poll_timeout_seconds)
+                break
+            except queue.Empty:
+                self.heartbeat_func()
+                if not self.analysis_process.is_alive():
+                    raise RuntimeError("Ring analysis process died.")
+        return analyzer.results(start_time, end_time, duration, capture_stats=capture_stats), capture_stats
+
+    def close(self):
+        self.ring.close()
+        while self.analysis_process.is_alive():
+            self.heartbeat_func()
+            self.analysis_process.join(self.poll_timeout_seconds)
+        self.ring.release()
+        self.ring = None
+
+    def terminate(self):
+        if self.analysis_process is not None and self.analysis_process.is_alive():
+            self.analysis_process.terminate()
+        if self.ring is not None:
+            self.ring.release()
+            self.ring = None
+
+
+def run_interface_capture_stage(wireless_interface, tmp_dir, plan_queue, result_queue, streaming_analysis=False,
+                                vectorized_analysis=False, keep_pcap=False, buffer_size=DEFAULT_CAPTURE_BUFFER_SIZE,
+                                adaptive_buffer=False, min_buffer_size=2 * MEGABYTE, max_buffer_size=64 * MEGABYTE,
+                                data_snaplen=None):
+    """
+    Process body of the capture worker of one interface in multi-interface capture. Captures and analyzes the
+    [(channel, sample seconds), ...] plans pulled off of the plan queue until a None plan is seen, sending the
+    analysis data of each capture to the database writer and a None once the plan is done.
+    """
+    capture_interface = CaptureInterface(wireless_interface)
+    if adaptive_buffer:
+        buffer_sizer = AdaptiveBufferSizer(buffer_size, min_buffer_size, max_buffer_size)
+    else:
+        buffer_sizer = None
+    beacon_cache = BeaconCache()
+    channel_visit_times = {}
+    while True:
+        channel_plan = plan_queue.get()
+        if channel_plan is None:
+            capture_interface.close()
+            return
+        for channel, sample_seconds in channel_plan:
+            stage_timer = StageTimer()
+            with stage_timer.stage(STAGE_CHANNEL_SWITCH):
+                capture_interface.set_channel(channel)
+            visit_time = time.time()
+            if channel in channel_visit_times:
+                stage_timer.record(SWEEP_LATENCY, visit_time - channel_visit_times[channel])
+            channel_visit_times[channel] = visit_time
+            if keep_pcap or not streaming_analysis:
+                capture_file = os.path.join(tmp_dir, "channel{0}-{1}.pcap".format(channel, time.time()))
             else:
-                station.station_id = insert_station(t, station)
-            insert_measurement_station(
-                t, measurement.measurement_id, station.station_id, station_counters[station.mac_address]
+                capture_file = None
+            channel_buffer_size = buffer_sizer.buffer_size(channel) if buffer_sizer else buffer_size
+            try:
+                if streaming_analysis:
+                    procedure_logger.info("Beginning live capture on {0} with streaming analysis...".format(
+                        wireless_interface
+                    ))
+                    with stage_timer.stage(STAGE_LIVE_CAPTURE):
+                        data, capture_stats = run_streaming_capture(
+                            wireless_interface, capture_file, sample_seconds, channel,
+                            buffer_size=channel_buffer_size, data_snaplen=data_snaplen, beacon_cache=beacon_cache,
+                            vectorized_analysis=vectorized_analysis, capture_interface=capture_interface
+                        )
+                else:
+                    procedure_logger.info("Beginning live capture on {0}...".format(wireless_interface))
+                    with stage_timer.stage(STAGE_LIVE_CAPTURE):
+                        start_time, end_time, duration, capture_stats = run_live_capture(
+                            wireless_interface, capture_file, sample_seconds, buffer_size=channel_buffer_size,
+                            data_snaplen=data_snaplen, capture_interface=capture_interface
+                        )
+                    with stage_timer.stage(STAGE_OFFLINE_ANALYSIS):
+                        data = run_offline_analysis(
+                            capture_file, start_time, end_time, duration, channel, capture_stats,
+                            beacon_cache=beacon_cache, vectorized_analysis=vectorized_analysis
+                        )
+                if buffer_sizer is not None:
+                    buffer_sizer.record(channel, capture_stats['pcap_received'], capture_stats['pcap_dropped'])
+                data['stage_timings'] = stage_timer.timings
+                result_queue.put(data)
+            finally:
+                if capture_file is not None and not keep_pcap:
+                    remove_capture_file(capture_file)
+        result_queue.put(None)
+
+
+class MultiInterfaceCapture(object):
+    """
+    Captures on several interfaces at once, one capture worker process per interface. Each sweep's channels are
+    split between the interfaces and every worker captures and analyzes its own share, while all of the analysis
+    data comes back through a single queue to be written by the caller, so there is still only one database
+    writer.
+    """
+    def __init__(self, wireless_interfaces, tmp_dir, streaming_analysis=False, vectorized_analysis=False,
+                 keep_pcap=False, buffer_size=DEFAULT_CAPTURE_BUFFER_SIZE, adaptive_buffer=False,
+                 min_buffer_size=2 * MEGABYTE, max_buffer_size=64 * MEGABYTE, data_snaplen=None,
+                 heartbeat_func=lambda: None, poll_timeout_seconds=1):
+        self.wireless_interfaces = list(wireless_interfaces)
+        self.tmp_dir = tmp_dir
+        self.capture_kwargs = {
+            'streaming_analysis': streaming_analysis,
+            'vectorized_analysis': vectorized_analysis,
+            'keep_pcap': keep_pcap,
+            'buffer_size': buffer_size,
+            'adaptive_buffer': adaptive_buffer,
+            'min_buffer_size': min_buffer_size,
+            'max_buffer_size': max_buffer_size,
+            'data_snaplen': data_snaplen
+        }
+        self.heartbeat_func = heartbeat_func
+        self.poll_timeout_seconds = poll_timeout_seconds
+        self.result_queue = multiprocessing.Queue()
+        self.plan_queues = []
+        self.capture_workers = []
+
+    def start(self):
+        for wireless_interface in self.wireless_interfaces:
+            plan_queue = multiprocessing.Queue()
+            worker = multiprocessing.Process(
+                target=run_interface_capture_stage,
+                args=(wireless_interface, self.tmp_dir, plan_queue, self.result_queue),
+                kwargs=self.capture_kwargs, daemon=True
             )
-        for service_set in service_sets:
-            opt_service_set = select_service_set_by_bssid(t, service_set.bssid)
-            if opt_service_set:
-                service_set.service_set_id = opt_service_set.service_set_id
+            worker.start()
+            procedure_logger.info("Capture worker for {0} started, PID: {1}".format(wireless_interface, worker.pid))
+            self.plan_queues.append(plan_queue)
+            self.capture_workers.append(worker)
+        return self
+
+    def check(self):
+        for wireless_interface, worker in zip(self.wireless_interfaces, self.capture_workers):
+            if not worker.is_alive():
+                raise RuntimeError("Capture worker for {0} died with exit code {1}".format(
+                    wireless_interface, worker.exitcode
+                ))
+
+    def sweep(self, dwell_times, write_func):
+        """
+        Capture every channel of dwell_times ({channel: sample seconds}) once, spread over the interfaces, handing
+        the analysis data of each capture to write_func as it comes in.
+        """
+        channel_plans = split_channel_plan(dwell_times, len(self.wireless_interfaces))
+        for wireless_interface, plan_queue, channel_plan in zip(
+                self.wireless_interfaces, self.plan_queues, channel_plans):
+            procedure_logger.info("Channels for {0}: {1}".format(
+                wireless_interface, ", ".join(str(channel) for channel, _ in channel_plan)
+            ))
+            plan_queue.put(channel_plan)
+        workers_running = len(self.capture_workers)
+        while workers_running:
+            try:
+                data = self.result_queue.get(timeout=self.poll_timeout_seconds)
+            except queue.Empty:
+                self.heartbeat_func()
+                self.check()
+                continue
+            if data is None:
+                workers_running -= 1
             else:
-                service_set.service_set_id = insert_service_set(t, service_set)
-            if service_set.bssid in bssid_to_jitter_map:
-                jitter, bad_intervals, intervals = bssid_to_jitter_map[service_set.bssid]
-                insert_jitter_measurement(
-                    t, ServiceSetJitterMeasurement.new(
-                        measurement.measurement_id, service_set.service_set_id, jitter,
-                        intervals[0], {
-                            'bad_intervals': bad_intervals,
-                            'average_power': altered_mean(bssid_to_power_map.get(service_set.bssid, []))
-                        }
-                    )
-                )
-        for bssid, infra_macs in bssid_infra_macs.items():
-            for mac in infra_macs:
-                insert_service_set_infrastructure_station(t, measurement.measurement_id, bssid, mac)
-        for bssid, associated_macs in bssid_associated_macs.items():
-            for mac in associated_macs:
-                insert_service_set_associated_station(t, measurement.measurement_id, bssid, mac)
-        for bssid, ssid in bssid_to_ssid_map.items():
-            update_service_set_network_name(t, bssid, ssid)
-    optimize_db(db_conn)
+                write_func(data)
+            self.heartbeat_func()
+
+    def close(self):
+        for plan_queue in self.plan_queues:
+            plan_queue.put(None)
+        for worker in self.capture_workers:
+            while worker.is_alive():
+                self.heartbeat_func()
+                worker.join(self.poll_timeout_seconds)
+
+    def terminate(self):
+        for worker in self.capture_workers:
+            if worker.is_alive():
+                worker.terminate()
+
+
+def store_capture_kv(db_conn, kv_values, write_behind_writer=None):
+    """
+    Store the capture loop's kv values, through the write-behind writer when there is one so that the capture
+    loop doesn't wait for the database write lock.
+    """
+    if write_behind_writer is not None:
+        write_behind_writer.set_kv(kv_values)
+        return
+    with transaction_wrapper(db_conn) as t:
+        for key, value in kv_values.items():
+            kv_store_set(t, key, value)
 
 
 def run_capture(wireless_interface, log_file, tmp_dir, database_loc,
                 verbose=False, sample_seconds=10, rounds=0, ignore_non_root=False,
-                db_timeout_seconds=60, heartbeat_func=lambda: None, run_with_monitor=True):
+                db_timeout_seconds=None, db_profile="writer", pipelined=False, analysis_workers=1,
+                pipeline_queue_size=2, streaming_analysis=False, ring_analysis=False, ring_size=16 * MEGABYTE,
+                vectorized_analysis=False,
+                analysis_chunks=0, keep_pcap=False, buffer_size=DEFAULT_CAPTURE_BUFFER_SIZE, adaptive_buffer=False,
+                min_buffer_size=2 * MEGABYTE, max_buffer_size=64 * MEGABYTE, data_snaplen=None,
+                sweep_seconds=None, min_dwell_seconds=2, dwell_history_sweeps=3, extra_interfaces=(),
+                identity_cache_size=10000, write_behind=False, write_queue_size=8, write_batch_size=4,
+                write_journal=False, heartbeat_func=lambda: None, run_with_monitor=True):
     setup_logging(log_file, verbose)
     if run_with_monitor:
         return run_monitored(run_capture, always_restart=False)(
             wireless_interface, log_file, tmp_dir, database_loc,
             verbose, sample_seconds, rounds, ignore_non_root,
-            db_timeout_seconds, run_with_monitor=False
+            db_timeout_seconds, db_profile=db_profile, pipelined=pipelined, analysis_workers=analysis_workers,
+            pipeline_queue_size=pipeline_queue_size, streaming_analysis=streaming_analysis,
+            ring_analysis=ring_analysis, ring_size=ring_size, vectorized_analysis=vectorized_analysis,
+            analysis_chunks=analysis_chunks, keep_pcap=keep_pcap, buffer_size=buffer_size,
+            adaptive_buffer=adaptive_buffer, min_buffer_size=min_buffer_size, max_buffer_size=max_buffer_size,
+            data_snaplen=data_snaplen, sweep_seconds=sweep_seconds, min_dwell_seconds=min_dwell_seconds,
+            dwell_history_sweeps=dwell_history_sweeps, extra_interfaces=extra_interfaces,
+            identity_cache_size=identity_cache_size, write_behind=write_behind, write_queue_size=write_queue_size,
+            write_batch_size=write_batch_size, write_journal=write_journal, run_with_monitor=False
         )
+    pipeline = None
+    chunk_executor = None
+    ring_stage = None
+    multi_interface_capture = None
+    capture_interface = None
+    write_behind_writer = None
+    activity_db_conn = None
+    timing_summary = StageTimingSummary()
+    # Ring analysis is streaming analysis done in another process.
+    streaming_analysis = streaming_analysis or ring_analysis
     try:
         heartbeat_func()
+        if analysis_chunks > 1 and (pipelined or streaming_analysis):
+            raise ValueError("Chunked analysis can not be combined with pipelined or streaming analysis.")
+        if extra_interfaces and (pipelined or ring_analysis or analysis_chunks > 1):
+            raise ValueError("Capturing on several interfaces can not be combined with pipelined, ring or chunked "
+                             "analysis.")
+        if write_behind and pipelined:
+            raise ValueError("Write-behind can not be combined with pipelined capture, which has its own writer.")
+        if write_journal and not write_behind:
+            raise ValueError("The write journal requires write-behind.")
         effective_user_id = os.geteuid()
         if effective_user_id != 0 and ignore_non_root:
             procedure_logger.warning("Not running as root, attempting to proceed...")
@@ -543,64 +1131,429 @@ def run_capture(wireless_interface, log_file, tmp_dir, database_loc,
             )
         run_forever = rounds == 0
 
-        db_conn = create_connection(database_loc, db_timeout_seconds)
+        db_conn = create_connection(database_loc, timeout=db_timeout_seconds, profile=db_profile)
         write_schema(db_conn)
 
         with transaction_wrapper(db_conn) as t:
             kv_store_set(t, "capture/script_start_time", time.time())
             kv_store_set(t, 'capture/script_pid', os.getpid())
             kv_store_set(t, "capture/interface", wireless_interface)
+            kv_store_set(t, "capture/extra_interfaces", list(extra_interfaces))
             kv_store_set(t, "capture/sample_seconds", sample_seconds)
 
-        card = setup_capture_card(wireless_interface)
+        if identity_cache_size > 0:
+            identity_cache = IdentityCache(identity_cache_size).warm(db_conn)
+        else:
+            identity_cache = None
 
         if not os.path.exists(tmp_dir):
             procedure_logger.warning("Tmp dir {0} does not exist. Creating...".format(tmp_dir))
             os.makedirs(tmp_dir)
 
+        if extra_interfaces:
+            # The capture workers set up their own interfaces.
+            multi_interface_capture = MultiInterfaceCapture(
+                [wireless_interface] + list(extra_interfaces), tmp_dir, streaming_analysis=streaming_analysis,
+                vectorized_analysis=vectorized_analysis, keep_pcap=keep_pcap, buffer_size=buffer_size,
+                adaptive_buffer=adaptive_buffer, min_buffer_size=min_buffer_size, max_buffer_size=max_buffer_size,
+                data_snaplen=data_snaplen, heartbeat_func=heartbeat_func
+            ).start()
+        else:
+            capture_interface = CaptureInterface(wireless_interface)
+
+        if adaptive_buffer:
+            buffer_sizer = AdaptiveBufferSizer(buffer_size, min_buffer_size, max_buffer_size)
+        else:
+            buffer_sizer = None
+        if sweep_seconds is not None:
+            dwell_scheduler = DwellScheduler(sweep_seconds, min_dwell_seconds=min_dwell_seconds)
+        else:
+            dwell_scheduler = None
+        beacon_cache = BeaconCache()
+        if analysis_chunks > 1:
+            procedure_logger.info("Starting {0} chunked analysis worker(s)...".format(analysis_chunks))
+            chunk_executor = ProcessPoolExecutor(max_workers=analysis_chunks)
+
+        if ring_analysis:
+            ring_stage = RingAnalysisStage(
+                ring_size, vectorized_analysis=vectorized_analysis, heartbeat_func=heartbeat_func
+            ).start()
+
+        if write_behind:
+            procedure_logger.info("Starting the write-behind writer...")
+            write_behind_writer = WriteBehindWriter(
+                database_loc,
+                lambda writer_db_conn, analysis_batch, transaction_hook: write_timed_analysis_batch_to_database(
+                    writer_db_conn, analysis_batch, timing_summary, identity_cache, transaction_hook
+                ),
+                db_timeout_seconds, db_profile, queue_size=write_queue_size, max_batch_size=write_batch_size,
+                journal_dir=os.path.join(tmp_dir, "write-journal") if write_journal else None,
+                heartbeat_func=heartbeat_func
+            ).start()
+            if dwell_scheduler is not None:
+                # A WAL read doesn't wait for writers, unlike the capture connection's BEGIN IMMEDIATE.
+                activity_db_conn = create_connection(database_loc, profile="reader")
+
+        if pipelined:
+            procedure_logger.info("Starting capture pipeline with {0} analysis worker(s)...".format(analysis_workers))
+            pipeline = CapturePipeline(
+                database_loc, db_timeout_seconds, analysis_workers=0 if streaming_analysis else analysis_workers,
+                queue_size=pipeline_queue_size, heartbeat_func=heartbeat_func, keep_pcap=keep_pcap,
+                vectorized_analysis=vectorized_analysis, timing_summary=timing_summary,
+                identity_cache=identity_cache, db_profile=db_profile
+            ).start()
+
         procedure_logger.info("Beginning channel scan.")
 
         heartbeat_func()
         current_round = 0
+        channel_visit_times = {}
         while run_forever or rounds > 0:
             heartbeat_func()
             procedure_logger.info("Executing capture round {0}".format(current_round))
-            with transaction_wrapper(db_conn) as t:
-                kv_store_set(t, "capture/current_script_round", current_round)
-            for channel in range(1, 12):
-                heartbeat_func()
-                procedure_logger.info("Changing to channel {0}".format(channel))
-
-                pyw.down(card)
-                pyw.up(card)
-                pyw.chset(card, channel, None)
-                procedure_logger.info("Opening the pcap driver...")
-                capture_file = os.path.join(tmp_dir, "channel{0}-{1}.pcap".format(channel, time.time()))
-
-                try:
-                    procedure_logger.info("Beginning live capture...")
-                    start_time, end_time, duration = run_live_capture(wireless_interface, capture_file, sample_seconds)
-                    procedure_logger.info("Starting offline analysis...")
-                    data = run_offline_analysis(
-                        capture_file, start_time, end_time, duration, channel
+            round_start_time = time.time()
+            if dwell_scheduler is not None:
+                dwell_times = dwell_scheduler.dwell_times(
+                    select_channel_activity(
+                        activity_db_conn or db_conn, round_start_time - dwell_history_sweeps * sweep_seconds
                     )
-                    procedure_logger.info("Writing analysis data to database...")
-                    write_offline_analysis_to_database(
-                        db_conn, data
+                )
+            else:
+                dwell_times = {channel: sample_seconds for channel in CAPTURE_CHANNELS}
+            store_capture_kv(db_conn, {
+                "capture/current_script_round": current_round,
+                "capture/channel_dwell_seconds": dwell_times
+            }, write_behind_writer)
+            sweep_switch_seconds = 0.0
+            if multi_interface_capture is not None:
+                if write_behind_writer is not None:
+                    multi_interface_capture.sweep(dwell_times, write_behind_writer.submit)
+                else:
+                    multi_interface_capture.sweep(
+                        dwell_times,
+                        lambda analysis_data: write_timed_analysis_to_database(
+                            db_conn, analysis_data, timing_summary, identity_cache
+                        )
                     )
-                    procedure_logger.info("Data written...")
-                finally:
-                    procedure_logger.info("Cleaning up capture file..")
-                    if os.path.exists(capture_file):
-                        os.unlink(capture_file)
+            else:
+                for channel in CAPTURE_CHANNELS:
+                    heartbeat_func()
+                    stage_timer = StageTimer()
+                    with stage_timer.stage(STAGE_CHANNEL_SWITCH):
+                        capture_interface.set_channel(channel)
+                    visit_time = time.time()
+                    if channel in channel_visit_times:
+                        stage_timer.record(SWEEP_LATENCY, visit_time - channel_visit_times[channel])
+                    channel_visit_times[channel] = visit_time
+                    procedure_logger.info("Opening the pcap driver...")
+                    if keep_pcap or not streaming_analysis:
+                        capture_file = os.path.join(tmp_dir, "channel{0}-{1}.pcap".format(channel, time.time()))
+                    else:
+                        capture_file = None
+                    handed_off = False
+                    channel_buffer_size = buffer_sizer.buffer_size(channel) if buffer_sizer else buffer_size
+                    channel_sample_seconds = dwell_times[channel]
+
+                    try:
+                        with stage_timer.stage(STAGE_LIVE_CAPTURE):
+                            if ring_stage is not None:
+                                procedure_logger.info("Beginning live capture with ring analysis...")
+                                data, capture_stats = ring_stage.capture(
+                                    wireless_interface, capture_file, channel_sample_seconds, channel,
+                                    buffer_size=channel_buffer_size, data_snaplen=data_snaplen,
+                                    capture_interface=capture_interface
+                                )
+                            elif streaming_analysis:
+                                procedure_logger.info("Beginning live capture with streaming analysis...")
+                                data, capture_stats = run_streaming_capture(
+                                    wireless_interface, capture_file, channel_sample_seconds, channel,
+                                    buffer_size=channel_buffer_size, data_snaplen=data_snaplen,
+                                    beacon_cache=beacon_cache, vectorized_analysis=vectorized_analysis,
+                                    capture_interface=capture_interface
+                                )
+                            else:
+                                procedure_logger.info("Beginning live capture...")
+                                start_time, end_time, duration, capture_stats = run_live_capture(
+                                    wireless_interface, capture_file, channel_sample_seconds,
+                                    buffer_size=channel_buffer_size, data_snaplen=data_snaplen,
+                                    capture_interface=capture_interface
+                                )
+                        if buffer_sizer is not None:
+                            buffer_sizer.record(channel, capture_stats['pcap_received'], capture_stats['pcap_dropped'])
+                        sweep_switch_seconds += capture_stats.get('channel_switch_seconds', 0.0)
+                        if not streaming_analysis:
+                            if pipeline is not None:
+                                procedure_logger.info("Handing capture off to the analysis stage...")
+                                pipeline.submit(
+                                    capture_file, start_time, end_time, duration, channel, capture_stats,
+                                    stage_timings=stage_timer.timings
+                                )
+                                handed_off = True
+                                continue
+                            procedure_logger.info("Starting offline analysis...")
+                            with stage_timer.stage(STAGE_OFFLINE_ANALYSIS):
+                                if chunk_executor is not None:
+                                    data = run_chunked_offline_analysis(
+                                        capture_file, start_time, end_time, duration, channel, chunk_executor,
+                                        analysis_chunks, capture_stats, vectorized_analysis=vectorized_analysis
+                                    )
+                                else:
+                                    data = run_offline_analysis(
+                                        capture_file, start_time, end_time, duration, channel, capture_stats,
+                                        beacon_cache=beacon_cache, vectorized_analysis=vectorized_analysis
+                                    )
+                        data['stage_timings'] = stage_timer.timings
+                        if pipeline is not None:
+                            procedure_logger.info("Handing analysis data off to the write stage...")
+                            pipeline.submit_results(data)
+                        elif write_behind_writer is not None:
+                            procedure_logger.info("Handing analysis data off to the write-behind writer...")
+                            write_behind_writer.submit(data)
+                        else:
+                            procedure_logger.info("Writing analysis data to database...")
+                            write_timed_analysis_to_database(db_conn, data, timing_summary, identity_cache)
+                            procedure_logger.info("Data written...")
+                    finally:
+                        if capture_file is not None and not handed_off and not keep_pcap:
+                            remove_capture_file(capture_file)
+            round_kv = {
+                "capture/last_sweep_seconds": time.time() - round_start_time,
+                "capture/stage_timing_percentiles": timing_summary.percentiles(),
+                "capture/db_lock_wait": db_conn.lock_wait_stats()
+            }
+            if multi_interface_capture is None:
+                round_kv["capture/last_sweep_switch_seconds"] = sweep_switch_seconds
+            if identity_cache is not None:
+                round_kv["capture/identity_cache"] = identity_cache.stats()
+            if write_behind_writer is not None:
+                round_kv["capture/write_behind"] = write_behind_writer.stats()
+            if pipeline is not None and pipeline.writer_connection is not None:
+                round_kv["capture/pipeline_db_lock_wait"] = pipeline.writer_connection.lock_wait_stats()
+            store_capture_kv(db_conn, round_kv, write_behind_writer)
             if not run_forever:
                 rounds -= 1
             current_round += 1
+        if ring_stage is not None:
+            ring_stage.close()
+            ring_stage = None
+        if multi_interface_capture is not None:
+            multi_interface_capture.close()
+            multi_interface_capture = None
+        if pipeline is not None:
+            procedure_logger.info("Draining capture pipeline...")
+            pipeline.close()
+            pipeline = None
+        if write_behind_writer is not None:
+            procedure_logger.info("Draining the write-behind writer...")
+            write_behind_writer.close()
+            write_behind_writer = None
     except BaseException:
         procedure_logger.exception("Unhandled exception during capture! Aborting,...")
         raise
     else:
         procedure_logger.info("No more data. Ending...")
+    finally:
+        if pipeline is not None:
+            pipeline.terminate()
+        if chunk_executor is not None:
+            chunk_executor.shutdown(cancel_futures=True)
+        if ring_stage is not None:
+            ring_stage.terminate()
+        if multi_interface_capture is not None:
+            multi_interface_capture.terminate()
+        if capture_interface is not None:
+            capture_interface.close()
+        if write_behind_writer is not None:
+            # Still write the captures analyzed before the failure, journaled ones would wait for the next start.
+            try:
+                write_behind_writer.close()
+            except Exception:
+                procedure_logger.exception("Unable to drain the write-behind writer.")
+        if activity_db_conn is not None:
+            activity_db_conn.close()
+
+
+# -----------------------------------------------
+#  INGEST
+# -----------------------------------------------
+
+
+ingest_argument_parser = argparse.ArgumentParser('wifiology_ingest')
+ingest_argument_parser.add_argument("capture_dir", type=str, help="The directory of pcap files to ingest.")
+ingest_argument_parser.add_argument("database_loc", type=str, help="The database location on disk")
+ingest_argument_parser.add_argument("-l", "--log-file", type=str, default="-", help="Log file.")
+ingest_argument_parser.add_argument("-v", "--verbose", action="store_true", help="Verbose mode.")
+ingest_argument_parser.add_argument(
+    "-m", "--manifest", type=str, default=None,
+    help="CSV file with file, channel, start_time and (optionally) end_time columns describing the captures. "
+         "Without it, capture files are picked up by their channel{N}-{timestamp}.pcap name."
+)
+ingest_argument_parser.add_argument(
+    "-s", "--sample-seconds", type=float, default=10,
+    help="The capture length assumed for captures without an end time."
+)
+ingest_argument_parser.add_argument(
+    "-w", "--workers", type=int, default=os.cpu_count(),
+    help="The number of analysis worker processes."
+)
+ingest_argument_parser.add_argument(
+    "--vectorized-analysis", action="store_true",
+    help="Decode and aggregate the frames of each capture in blocks with NumPy array operations instead of frame by "
+         "frame."
+)
+ingest_argument_parser.add_argument(
+    "--db-timeout-seconds", type=int, default=None,
+    help="The timeout to set on the database connection, instead of the busy timeout of its --db-profile."
+)
+ingest_argument_parser.add_argument(
+    "--db-profile", type=str, choices=sorted(CONNECTION_PROFILES), default="writer",
+    help="The SQLite connection profile (journal mode, synchronous, cache and mmap sizes) to use."
+)
+
+CAPTURE_FILE_NAME_PATTERN = re.compile(r'^channel(?P<channel>\d+)-(?P<timestamp>\d+(?:\.\d*)?)\.pcap$')
+
+# How often (in files) the ingest progress is logged.
+INGEST_PROGRESS_INTERVAL = 10
+# How many files per worker process are submitted ahead of the one being written.
+INGEST_FILES_IN_FLIGHT_PER_WORKER = 2
+
+
+def ingest_argparse_args_to_kwargs(args):
+    return {
+        'capture_dir': args.capture_dir,
+        'database_loc': args.database_loc,
+        'log_file': args.log_file,
+        'verbose': args.verbose,
+        'manifest': args.manifest,
+        'sample_seconds': args.sample_seconds,
+        'workers': args.workers,
+        'vectorized_analysis': args.vectorized_analysis,
+        'db_timeout_seconds': args.db_timeout_seconds,
+        'db_profile': args.db_profile
+    }
+
+
+def find_capture_files(capture_dir, sample_seconds):
+    """
+    The (capture file, channel, start time, end time) of the pcap files in capture_dir named like the capture
+    files run_capture writes, oldest first.
+    """
+    captures = []
+    for file_name in os.listdir(capture_dir):
+        match = CAPTURE_FILE_NAME_PATTERN.match(file_name)
+        if match is None:
+            if file_name.endswith(".pcap"):
+                procedure_logger.warning("Skipping {0}: no channel and timestamp in the file name.".format(file_name))
+            continue
+        start_time = float(match.group('timestamp'))
+        captures.append((
+            os.path.join(capture_dir, file_name), int(match.group('channel')), start_time, start_time + sample_seconds
+        ))
+    return sorted(captures, key=lambda capture: capture[2])
+
+
+def read_capture_manifest(manifest, capture_dir, sample_seconds):
+    """
+    The (capture file, channel, start time, end time) of the captures listed in a manifest CSV file, oldest
+    first. Relative file paths are taken to be in capture_dir.
+    """
+    captures = []
+    with open(manifest, newline='') as manifest_file:
+        for row in csv.DictReader(manifest_file):
+            start_time = float(row['start_time'])
+            end_time = float(row['end_time']) if row.get('end_time') else start_time + sample_seconds
+            captures.append((os.path.join(capture_dir, row['file']), int(row['channel']), start_time, end_time))
+    return sorted(captures, key=lambda capture: capture[2])
+
+
+def submit_in_order(executor, func, argument_tuples, max_in_flight, **kwargs):
+    """
+    Submit func(*arguments, **kwargs) to executor for each tuple of arguments, yielding the arguments and the future
+    of each call in order. Only max_in_flight calls are submitted ahead of the one yielded and no future is kept
+    once yielded, so the results of a long list of calls don't pile up in memory.
+    """
+    argument_tuples = iter(argument_tuples)
+    in_flight = deque()
+
+    def submit_next():
+        arguments = next(argument_tuples, None)
+        if arguments is not None:
+            in_flight.append((arguments, executor.submit(func, *arguments, **kwargs)))
+
+    for _ in range(max(max_in_flight, 1)):
+        submit_next()
+    while in_flight:
+        arguments, future = in_flight.popleft()
+        submit_next()
+        yield arguments, future
+
+
+def ingest_capture_file(capture_file, channel, start_time, end_time, vectorized_analysis=False):
+    """
+    Worker process body of the ingest: analyze one capture file, returning the analysis data and the number of
+    frames analyzed.
+    """
+    analyzer = analyze_capture_file(
+        capture_file, channel, beacon_cache=worker_beacon_cache(), vectorized_analysis=vectorized_analysis
+    )
+    return analyzer.results(start_time, end_time, end_time - start_time), analyzer.frame_count
+
+
+def run_ingest(capture_dir, database_loc, log_file, verbose, manifest=None, sample_seconds=10,
+               workers=os.cpu_count(), vectorized_analysis=False, db_timeout_seconds=None, db_profile="writer"):
+    try:
+        setup_logging(log_file, verbose)
+
+        db_conn = create_connection(database_loc, timeout=db_timeout_seconds, profile=db_profile)
+        write_schema(db_conn)
+
+        with transaction_wrapper(db_conn) as t:
+            kv_store_set(t, "ingest/script_start_time", time.time())
+            kv_store_set(t, 'ingest/script_pid', os.getpid())
+
+        if manifest is not None:
+            captures = read_capture_manifest(manifest, capture_dir, sample_seconds)
+        else:
+            captures = find_capture_files(capture_dir, sample_seconds)
+        procedure_logger.info("Ingesting {0} capture files with {1} worker(s)...".format(len(captures), workers))
+
+        identity_cache = IdentityCache().warm(db_conn)
+        start = time.monotonic()
+        file_count = 0
+        frame_count = 0
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # Results are written in capture order by this process only, the workers never touch the database.
+            for capture, future in submit_in_order(
+                executor, ingest_capture_file, captures, INGEST_FILES_IN_FLIGHT_PER_WORKER * workers,
+                vectorized_analysis=vectorized_analysis
+            ):
+                capture_file = capture[0]
+                try:
+                    data, capture_frame_count = future.result()
+                except Exception:
+                    procedure_logger.exception("Analysis failed for capture file {0}".format(capture_file))
+                    continue
+                write_offline_analysis_to_database(db_conn, data, identity_cache=identity_cache)
+                file_count += 1
+                frame_count += capture_frame_count
+                if file_count % INGEST_PROGRESS_INTERVAL == 0:
+                    elapsed = time.monotonic() - start
+                    procedure_logger.info("{0}/{1} files ingested ({2:.2f} files/s, {3:.0f} frames/s)".format(
+                        file_count, len(captures), file_count / elapsed, frame_count / elapsed
+                    ))
+        elapsed = max(time.monotonic() - start, 1e-9)
+        procedure_logger.info(
+            "Ingested {0} files ({1} frames) in {2:.1f}s: {3:.2f} files/s, {4:.0f} frames/s".format(
+                file_count, frame_count, elapsed, file_count / elapsed, frame_count / elapsed
+            )
+        )
+        with transaction_wrapper(db_conn) as t:
+            kv_store_set(t, "ingest/db_lock_wait", db_conn.lock_wait_stats())
+    except BaseException:
+        procedure_logger.exception("Unhandled exception during ingest! Aborting,...")
+        raise
+    else:
+        procedure_logger.info("Ingest completed successfully. Ending...")
 
 
 # -----------------------------------------------
@@ -622,8 +1575,12 @@ upload_argument_parser.add_argument(
 upload_argument_parser.add_argument("-l", "--log-file", type=str, default="-", help="Log file.")
 upload_argument_parser.add_argument("-v", "--verbose", action="store_true", help="Verbose mode.")
 upload_argument_parser.add_argument(
-    "--db-timeout-seconds", type=int, default=60,
-    help="The timeout to set on the database connection"
+    "--db-timeout-seconds", type=int, default=None,
+    help="The timeout to set on the database connection, instead of the busy timeout of its --db-profile."
+)
+upload_argument_parser.add_argument(
+    "--db-profile", type=str, choices=sorted(CONNECTION_PROFILES), default="writer",
+    help="The SQLite connection profile (journal mode, synchronous, cache and mmap sizes) to use."
 )
 upload_argument_parser.add_argument(
     "--batch-size", type=int, default=1,
@@ -632,7 +1589,10 @@ upload_argument_parser.add_argument(
 
 
 def pull_and_upload_measurements(db_connection, remote_api_base_url, node_id, api_key, batch_size):
-    with transaction_wrapper(db_connection) as t:
+    # The uploads happen outside of any transaction, holding one across the HTTP requests would keep the capture
+    # writer from committing (or, in WAL mode, fail the upload status update once the capture wrote).
+    upload_payloads = []
+    with deferred_transaction_wrapper(db_connection) as t:
         target_measurements = select_measurements_that_need_upload(t, batch_size)
         for measurement in target_measurements:
             procedure_logger.info(
@@ -660,8 +1620,7 @@ def pull_and_upload_measurements(db_connection, remote_api_base_url, node_id, ap
                 ss.bssid: ss.nice_network_name for ss in service_sets if ss.nice_network_name
             }
 
-            procedure_logger.info("Attempting to do data upload for measurement {0}".format(measurement.measurement_id))
-            upload_data = measurement.to_api_upload_payload(
+            upload_payloads.append((measurement, measurement.to_api_upload_payload(
                 [s.to_api_upload_payload() for s in stations],
                 [
                     ss.to_api_upload_payload(
@@ -672,24 +1631,28 @@ def pull_and_upload_measurements(db_connection, remote_api_base_url, node_id, ap
                     for ss in service_sets
                 ],
                 bssid_to_network_name_map
-            )
-            response = requests.post(
-                urljoin(remote_api_base_url, '/api/1.0/nodes/{nid}/measurements'.format(nid=node_id)),
-                data=json_dumps(upload_data),
-                headers={
-                    'Content-Type': 'application/json',
-                    'X-API-Key': api_key
-                }
-            )
-            try:
-                import pprint
-                pprint.pprint(response.json())
-            except:
-                pass
-            response.raise_for_status()
-            procedure_logger.info(
-                "Info on uploaded measurement {0}: {0}".format(measurement.measurement_id, response.json())
-            )
+            )))
+
+    for measurement, upload_data in upload_payloads:
+        procedure_logger.info("Attempting to do data upload for measurement {0}".format(measurement.measurement_id))
+        response = requests.post(
+            urljoin(remote_api_base_url, '/api/1.0/nodes/{nid}/measurements'.format(nid=node_id)),
+            data=json_dumps(upload_data),
+            headers={
+                'Content-Type': 'application/json',
+                'X-API-Key': api_key
+            }
+        )
+        try:
+            import pprint
+            pprint.pprint(response.json())
+        except:
+            pass
+        response.raise_for_status()
+        procedure_logger.info(
+            "Info on uploaded measurement {0}: {0}".format(measurement.measurement_id, response.json())
+        )
+    with transaction_wrapper(db_connection) as t:
         update_measurements_upload_status(t, [m.measurement_id for m in target_measurements], True)
     return bool(target_measurements)
 
@@ -703,16 +1666,17 @@ def upload_argparse_args_to_kwargs(args):
         'log_file': args.log_file,
         'verbose': args.verbose,
         'db_timeout_seconds': args.db_timeout_seconds,
+        'db_profile': args.db_profile,
         'batch_size': args.batch_size
     }
 
 
 def run_upload(database_location, node_id, remote_api_base_url, api_key, log_file, verbose,
-               db_timeout_seconds=60, batch_size=2, round_delay=3):
+               db_timeout_seconds=None, batch_size=2, round_delay=3, db_profile="writer"):
     try:
         setup_logging(log_file, verbose)
 
-        db_conn = create_connection(database_location, db_timeout_seconds)
+        db_conn = create_connection(database_location, timeout=db_timeout_seconds, profile=db_profile)
         write_schema(db_conn)
 
         with transaction_wrapper(db_conn) as t:
@@ -723,6 +1687,8 @@ def run_upload(database_location, node_id, remote_api_base_url, api_key, log_fil
         while more_work_to_do:
             procedure_logger.info("Pulling and uploading...")
             more_work_to_do = pull_and_upload_measurements(db_conn, remote_api_base_url, node_id, api_key, batch_size)
+            with transaction_wrapper(db_conn) as t:
+                kv_store_set(t, "upload/db_lock_wait", db_conn.lock_wait_stats())
             procedure_logger.info("Snooze {0}".format(round_delay))
             time.sleep(round_delay)
     except BaseException:
@@ -741,12 +1707,20 @@ janitor_argument_parser.add_argument("database_location", type=str, help="The da
 janitor_argument_parser.add_argument("-l", "--log-file", type=str, default="-", help="Log file.")
 janitor_argument_parser.add_argument("-v", "--verbose", action="store_true", help="Verbose mode.")
 janitor_argument_parser.add_argument(
-    "--db-timeout-seconds", type=int, default=60,
-    help="The timeout to set on the database connection"
+    "--db-timeout-seconds", type=int, default=None,
+    help="The timeout to set on the database connection, instead of the busy timeout of its --db-profile."
+)
+janitor_argument_parser.add_argument(
+    "--db-profile", type=str, choices=sorted(CONNECTION_PROFILES), default="maintenance",
+    help="The SQLite connection profile (journal mode, synchronous, cache and mmap sizes) to use."
 )
 janitor_argument_parser.add_argument(
     "--measurement-max-age-days", type=int, default=14, help="The maximum number of days to keep measurements around."
 )
+janitor_argument_parser.add_argument(
+    "--delete-orphans", action="store_true",
+    help="Delete the stations and service sets no longer part of any measurement."
+)
 janitor_argument_parser.add_argument(
     "--do-vacuum", action="store_true", help="Run a VACUUM on the database."
 )
@@ -755,10 +1729,17 @@ janitor_argument_parser.add_argument(
 )
 
 
-def clean_db(db_connection, measuement_max_age_days, do_vacuum=False, do_optimize=False):
+def clean_db(db_connection, measuement_max_age_days, do_vacuum=False, do_optimize=False, delete_orphans=False):
     with transaction_wrapper(db_connection) as t:
         deleted_count = delete_old_measurements(t, measuement_max_age_days)
         procedure_logger.info("{0} old measurements deleted from the database".format(deleted_count))
+    if delete_orphans:
+        with transaction_wrapper(db_connection) as t:
+            orphan_count = delete_orphaned_stations(t) + delete_orphaned_service_sets(t)
+            if orphan_count:
+                # The capture process's identity cache may hold the deleted IDs.
+                bump_identity_generation(t)
+            procedure_logger.info("{0} orphaned stations and service sets deleted".format(orphan_count))
     if do_optimize:
         procedure_logger.info("Beginning DB optimize...")
         optimize_db(db_connection)
@@ -776,25 +1757,29 @@ def janitor_argparse_args_to_kwargs(args):
         'log_file': args.log_file,
         'verbose': args.verbose,
         'db_timeout_seconds': args.db_timeout_seconds,
+        'db_profile': args.db_profile,
         'measurement_max_age_days': args.measurement_max_age_days,
         'do_vacuum': args.do_vacuum,
-        'do_optimize': args.do_optimize
+        'do_optimize': args.do_optimize,
+        'delete_orphans': args.delete_orphans
     }
 
 
-def run_janitor(database_location, log_file, verbose, db_timeout_seconds=60, measurement_max_age_days=14,
-                do_vacuum=False, do_optimize=False):
+def run_janitor(database_location, log_file, verbose, db_timeout_seconds=None, measurement_max_age_days=14,
+                do_vacuum=False, do_optimize=False, delete_orphans=False, db_profile="maintenance"):
     try:
         setup_logging(log_file, verbose)
 
-        db_conn = create_connection(database_location, db_timeout_seconds)
+        db_conn = create_connection(database_location, timeout=db_timeout_seconds, profile=db_profile)
         write_schema(db_conn)
 
         with transaction_wrapper(db_conn) as t:
             kv_store_set(t, "janitor/script_start_time", time.time())
             kv_store_set(t, 'janitor/script_pid', os.getpid())
         procedure_logger.info("Sarting Janitorial tasks...")
-        clean_db(db_conn, measurement_max_age_days, do_vacuum, do_optimize)
+        clean_db(db_conn, measurement_max_age_days, do_vacuum, do_optimize, delete_orphans)
+        with transaction_wrapper(db_conn) as t:
+            kv_store_set(t, "janitor/db_lock_wait", db_conn.lock_wait_stats())
         procedure_logger.info("Database janitorial tasks finished")
     except BaseException:
         procedure_logger.exception("Unhandled exception during upload! Aborting,...")
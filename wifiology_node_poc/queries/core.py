@@ -1,4 +1,5 @@
-from wifiology_node_poc.core_sqlite import cursor_manager, load_raw_file
+from wifiology_node_poc.core_sqlite import cursor_manager, load_raw_file, split_sql_script, \
+    immediate_transaction_wrapper, ProfiledConnection
 from wifiology_node_poc.models import ServiceSet, Station, Measurement, DataCounters, ServiceSetJitterMeasurement
 from wifiology_node_poc.queries import limit_offset_helper, SQL_FOLDER, place_holder_generator
 
@@ -107,14 +108,14 @@ def insert_measurement_station(transaction, measurement_id, station_id, data_cou
                controlFrameCount, rtsFrameCount, ctsFrameCount,
                ackFrameCount, dataFrameCount, dataThroughputIn, dataThroughputOut,
                retryFrameCount, averagePower, stdDevPower, lowestRate, highestRate,
-               failedFCSCount
+               failedFCSCount, powerCount, powerSum, powerSumSquares
             ) VALUES (
                :measurementID, :stationID, :managementFrameCount, 
                :associationFrameCount, :reassociationFrameCount, :disassociationFrameCount,
                :controlFrameCount,  :rtsFrameCount, :ctsFrameCount, :ackFrameCount, 
                :dataFrameCount, :dataThroughputIn, :dataThroughputOut,
                :retryFrameCount, :averagePower, :stdDevPower, :lowestRate, :highestRate,
-               :failedFCSCount
+               :failedFCSCount, :powerCount, :powerSum, :powerSumSquares
             )         
             """,
             params
@@ -198,9 +199,74 @@ def select_stations_by_channel(connection, channel_num, limit=None, offset=None)
         return [Station.from_row(r) for r in c.fetchall()]
 
 
-def write_schema(connection):
-    schema = load_raw_file("schema.sql", SQL_FOLDER)
-    connection.executescript(schema)
+# Columns added to existing tables before the schema was versioned. CREATE TABLE IF NOT EXISTS won't add them
+# to older databases, so the baseline migration adds any that are missing. Later columns go into MIGRATIONS.
+ADDED_COLUMNS = [
+    ("measurement", "pcapReceived", "INTEGER"),
+    ("measurement", "pcapDropped", "INTEGER"),
+    ("measurement", "pcapInterfaceDropped", "INTEGER"),
+    ("measurement", "channelSwitchSeconds", "REAL"),
+    ("measurementStationMap", "powerCount", "INTEGER"),
+    ("measurementStationMap", "powerSum", "REAL"),
+    ("measurementStationMap", "powerSumSquares", "REAL")
+]
+
+
+def select_table_column_names(connection, table_name):
+    with cursor_manager(connection) as c:
+        # NOTE: table_name should NEVER be user specified, PRAGMA arguments can't be parameterized.
+        c.execute("PRAGMA table_info({0})".format(table_name))
+        return {r["name"] for r in c.fetchall()}
+
+
+def add_missing_columns(connection):
+    for table_name, column_name, column_definition in ADDED_COLUMNS:
+        if column_name not in select_table_column_names(connection, table_name):
+            connection.execute(
+                "ALTER TABLE {0} ADD COLUMN {1} {2}".format(table_name, column_name, column_definition)
+            )
+
+
+def migrate_baseline(connection):
+    """
+    The schema of the first versioned release. Also brings unversioned databases of any age up to it.
+    """
+    for statement in split_sql_script(load_raw_file("schema.sql", SQL_FOLDER)):
+        connection.execute(statement)
+    add_missing_columns(connection)
+
+
+# Ordered schema migrations, a database's PRAGMA user_version is the number of them it has had. Only ever append
+# to this list; schema.sql is the baseline, later tables, indexes and columns go into new steps.
+MIGRATIONS = [
+    migrate_baseline,
+]
+
+
+def select_schema_version(connection):
+    with cursor_manager(connection) as c:
+        c.execute("PRAGMA user_version")
+        return c.fetchone()[0]
+
+
+def write_schema(connection, migrations=None):
+    """
+    Apply the migrations the database hasn't had yet, each in its own transaction together with its user_version
+    bump. A current database costs a single PRAGMA read. Databases written by a newer release are left alone.
+    """
+    migrations = MIGRATIONS if migrations is None else migrations
+    # Per connection, not stored in the database.
+    connection.execute("PRAGMA foreign_keys = on")
+    if select_schema_version(connection) >= len(migrations):
+        return
+    while True:
+        with immediate_transaction_wrapper(connection) as t:
+            # Read again under the write lock, another process may have migrated in the meantime.
+            version = select_schema_version(t)
+            if version >= len(migrations):
+                return
+            migrations[version](t)
+            t.execute("PRAGMA user_version = {0:d}".format(version + 1))
 
 
 def insert_measurement(transaction, new_measurement):
@@ -210,11 +276,13 @@ def insert_measurement(transaction, new_measurement):
             INSERT INTO measurement(
                measurementStartTime, measurementEndTime, 
                measurementDuration, channel, averageNoise, stdDevNoise, 
-               hasBeenUploaded, extraJSONData
+               hasBeenUploaded, extraJSONData, pcapReceived, pcapDropped,
+               pcapInterfaceDropped, channelSwitchSeconds
             ) VALUES (
                :measurementStartTime, :measurementEndTime,
                :measurementDuration, :channel, :averageNoise, :stdDevNoise,
-               :hasBeenUploaded, :extraJSONData
+               :hasBeenUploaded, :extraJSONData, :pcapReceived, :pcapDropped,
+               :pcapInterfaceDropped, :channelSwitchSeconds
             )
             
             """,
@@ -261,10 +329,19 @@ def select_data_counters_for_measurements(connection, measurement_ids):
               SUM(m.dataThroughputOut) AS dataThroughputOut,
               SUM(m.retryFrameCount) AS retryFrameCount,
               weighted_avg(m.averagePower, m.managementFrameCount + m.controlFrameCount + m.dataFrameCount) AS averagePower,
-              weighted_std_dev(m.stdDevPower, m.managementFrameCount + m.controlFrameCount + m.dataFrameCount) AS stdDevPower,
+              pooled_std_dev(
+                m.averagePower, m.stdDevPower, m.managementFrameCount + m.controlFrameCount + m.dataFrameCount
+              ) AS stdDevPower,
               MIN(m.lowestRate) AS lowestRate,
               MAX(m.highestRate) AS highestRate,
-              SUM(m.failedFCSCount) AS failedFCSCount
+              SUM(m.failedFCSCount) AS failedFCSCount,
+              -- Only exact if no row had its power statistics without the sums.
+              CASE WHEN SUM(m.averagePower IS NOT NULL AND m.powerCount IS NULL) = 0
+                THEN SUM(m.powerCount) END AS powerCount,
+              CASE WHEN SUM(m.averagePower IS NOT NULL AND m.powerCount IS NULL) = 0
+                THEN SUM(m.powerSum) END AS powerSum,
+              CASE WHEN SUM(m.averagePower IS NOT NULL AND m.powerCount IS NULL) = 0
+                THEN SUM(m.powerSumSquares) END AS powerSumSquares
             FROM measurementStationMap AS m
             GROUP BY m.mapMeasurementID
             HAVING m.mapMeasurementID IN
@@ -313,6 +390,71 @@ def select_latest_channel_device_counts(connection, channel_num, limit=None, off
         return [dict(r) for r in c.fetchall()]
 
 
+def select_channel_activity(connection, since_time):
+    """
+    Per channel activity of the measurements started since since_time: their total duration, the frames and
+    unique stations seen and the number of service sets whose beacons were timed.
+    """
+    with cursor_manager(connection) as c:
+        c.execute(
+            """
+            WITH recent AS (
+              SELECT measurementID, channel, measurementDuration FROM measurement
+              WHERE measurementStartTime >= :sinceTime
+            )
+            SELECT r.channel AS channel, SUM(r.measurementDuration) AS totalDuration,
+              (
+                SELECT COALESCE(SUM(map.managementFrameCount + map.controlFrameCount + map.dataFrameCount), 0)
+                FROM measurementStationMap AS map JOIN recent AS rm ON map.mapMeasurementID = rm.measurementID
+                WHERE rm.channel = r.channel
+              ) AS frameCount,
+              (
+                SELECT COUNT(DISTINCT map.mapStationID)
+                FROM measurementStationMap AS map JOIN recent AS rm ON map.mapMeasurementID = rm.measurementID
+                WHERE rm.channel = r.channel
+              ) AS stationCount,
+              (
+                SELECT COUNT(DISTINCT j.serviceSetID)
+                FROM serviceSetJitterMeasurement AS j JOIN recent AS rm ON j.measurementID = rm.measurementID
+                WHERE rm.channel = r.channel
+              ) AS serviceSetCount
+            FROM recent AS r
+            GROUP BY r.channel
+            """,
+            {"sinceTime": since_time}
+        )
+        return {r["channel"]: dict(r) for r in c.fetchall()}
+
+
+def insert_stage_timings(transaction, measurement_id, stage_timings):
+    with cursor_manager(transaction) as c:
+        c.executemany(
+            """
+            INSERT INTO measurementStageTiming(
+              measurementID, stageName, wallSeconds, cpuSeconds
+            ) VALUES (
+              ?, ?, ?, ?
+            )
+            """,
+            [
+                (measurement_id, stage_name, wall_seconds, cpu_seconds)
+                for stage_name, (wall_seconds, cpu_seconds) in stage_timings.items()
+            ]
+        )
+
+
+def select_stage_timings_for_measurement(connection, measurement_id):
+    with cursor_manager(connection) as c:
+        c.execute(
+            """
+            SELECT stageName, wallSeconds, cpuSeconds FROM measurementStageTiming
+            WHERE measurementID = :measurementID
+            """,
+            {"measurementID": measurement_id}
+        )
+        return {r["stageName"]: (r["wallSeconds"], r["cpuSeconds"]) for r in c.fetchall()}
+
+
 def insert_station(transaction, new_radio_device):
     with cursor_manager(transaction) as c:
         c.execute(
@@ -344,6 +486,190 @@ def insert_jitter_measurement(transaction, new_jitter_measurement):
         )
 
 
+def insert_jitter_measurements(transaction, new_jitter_measurements):
+    with cursor_manager(transaction) as c:
+        c.executemany(
+            """
+            INSERT INTO serviceSetJitterMeasurement(
+                measurementID, serviceSetID, minJitter, maxJitter, avgJitter, stdDevJitter,
+                jitterHistogram, jitterHistogramOffset, interval, extraJSONData
+            ) VALUES (
+                :measurementID, :serviceSetID, :minJitter, :maxJitter, :avgJitter, :stdDevJitter,
+                :jitterHistogram, :jitterHistogramOffset, :interval, :extraJSONData
+            )
+            """,
+            [j.to_row() for j in new_jitter_measurements]
+        )
+
+
+# The data counter columns of measurementStationMap, mirrored by the stagingStation table.
+STATION_COUNTER_COLUMNS = (
+    "managementFrameCount", "associationFrameCount", "reassociationFrameCount", "disassociationFrameCount",
+    "controlFrameCount", "rtsFrameCount", "ctsFrameCount", "ackFrameCount", "dataFrameCount", "dataThroughputIn",
+    "dataThroughputOut", "retryFrameCount", "averagePower", "stdDevPower", "lowestRate", "highestRate",
+    "failedFCSCount", "powerCount", "powerSum", "powerSumSquares"
+)
+
+
+def write_staging_schema(connection):
+    """
+    Create the temp staging tables of the bulk writes on this connection, if they don't exist yet. Must be called
+    outside of a transaction, like write_schema. The script only runs once per connection made by
+    create_connection, the bulk writes clear the tables they use in each transaction.
+    """
+    if getattr(connection, "staging_schema_written", False):
+        return
+    connection.executescript(load_raw_file("staging.sql", SQL_FOLDER))
+    if isinstance(connection, ProfiledConnection):
+        connection.staging_schema_written = True
+
+
+def bulk_insert_measurement_stations(transaction, measurement_id, stations, station_counters):
+    """
+    Insert the stations not seen before and the measurement's counters of every station with a handful of set based
+    statements going through the stagingStation table, instead of a few statements per station. Stations that
+    already have a station ID (from an IdentityCache) are trusted and not looked up again; the station IDs of the
+    others are filled in.
+    """
+    columns = ("macAddress", "stationID", "extraJSONData") + STATION_COUNTER_COLUMNS
+    rows = []
+    for station in stations:
+        row = station_counters[station.mac_address].to_row()
+        row.update(station.to_row())
+        rows.append(row)
+    unknown_stations = [station for station in stations if station.station_id is None]
+    with cursor_manager(transaction) as c:
+        c.execute("DELETE FROM stagingStation")
+        c.executemany(
+            "INSERT INTO stagingStation({0}) VALUES ({1})".format(
+                ", ".join(columns), ", ".join(":" + column for column in columns)
+            ),
+            rows
+        )
+        if unknown_stations:
+            c.execute(
+                """
+                INSERT OR IGNORE INTO station(macAddress, extraJSONData)
+                SELECT macAddress, extraJSONData FROM stagingStation WHERE stationID IS NULL
+                """
+            )
+            c.execute(
+                """
+                UPDATE stagingStation
+                SET stationID = (SELECT s.stationID FROM station AS s WHERE s.macAddress = stagingStation.macAddress)
+                WHERE stationID IS NULL
+                """
+            )
+        c.execute(
+            """
+            INSERT INTO measurementStationMap(mapMeasurementID, mapStationID, {0})
+            SELECT :measurementID, stationID, {0} FROM stagingStation
+            """.format(", ".join(STATION_COUNTER_COLUMNS)),
+            {"measurementID": measurement_id}
+        )
+        if unknown_stations:
+            c.execute("SELECT macAddress, stationID FROM stagingStation")
+            station_ids = {r["macAddress"]: r["stationID"] for r in c.fetchall()}
+            for station in unknown_stations:
+                station.station_id = station_ids[station.mac_address]
+
+
+def bulk_insert_service_sets(transaction, service_sets):
+    """
+    Insert the service sets not seen before through the stagingServiceSet table and fill in the missing service
+    set IDs. Service sets that already have an ID are left alone.
+    """
+    unknown_service_sets = [service_set for service_set in service_sets if service_set.service_set_id is None]
+    if not unknown_service_sets:
+        return
+    with cursor_manager(transaction) as c:
+        c.execute("DELETE FROM stagingServiceSet")
+        c.executemany(
+            """
+            INSERT INTO stagingServiceSet(bssid, networkName, extraJSONData)
+            VALUES (:bssid, :networkName, :extraJSONData)
+            """,
+            [service_set.to_row() for service_set in unknown_service_sets]
+        )
+        c.execute(
+            """
+            INSERT OR IGNORE INTO serviceSet(bssid, networkName, extraJSONData)
+            SELECT bssid, networkName, extraJSONData FROM stagingServiceSet
+            """
+        )
+        c.execute(
+            """
+            SELECT ss.bssid, ss.serviceSetID
+            FROM stagingServiceSet AS st JOIN serviceSet AS ss ON ss.bssid = st.bssid
+            """
+        )
+        service_set_ids = {r["bssid"]: r["serviceSetID"] for r in c.fetchall()}
+    for service_set in unknown_service_sets:
+        service_set.service_set_id = service_set_ids[service_set.bssid]
+
+
+def bulk_insert_service_set_stations(transaction, measurement_id, bssid_infra_macs, bssid_associated_macs):
+    """
+    Set based counterpart of insert_service_set_infrastructure_station and insert_service_set_associated_station
+    for all of a measurement's {bssid: MAC addresses} maps at once.
+    """
+    rows = [
+        (bssid, mac, 1) for bssid, macs in bssid_infra_macs.items() for mac in macs
+    ] + [
+        (bssid, mac, 0) for bssid, macs in bssid_associated_macs.items() for mac in macs
+    ]
+    with cursor_manager(transaction) as c:
+        c.execute("DELETE FROM stagingServiceSetStation")
+        c.executemany(
+            "INSERT OR IGNORE INTO stagingServiceSetStation(bssid, macAddress, isInfrastructure) VALUES (?, ?, ?)",
+            rows
+        )
+        c.execute(
+            """
+            INSERT INTO infrastructureStationServiceSetMap(mapStationID, mapServiceSetID, measurementID)
+            SELECT s.stationID, ss.serviceSetID, :measurementID
+            FROM stagingServiceSetStation AS st
+            JOIN station AS s ON s.macAddress = st.macAddress
+            JOIN serviceSet AS ss ON ss.bssid = st.bssid
+            WHERE st.isInfrastructure = 1
+            """,
+            {"measurementID": measurement_id}
+        )
+        c.execute(
+            """
+            INSERT INTO associationStationServiceSetMap(associatedStationID, associatedServiceSetID, measurementID)
+            SELECT s.stationID, ss.serviceSetID, :measurementID
+            FROM stagingServiceSetStation AS st
+            JOIN station AS s ON s.macAddress = st.macAddress
+            JOIN serviceSet AS ss ON ss.bssid = st.bssid
+            WHERE st.isInfrastructure = 0
+            """,
+            {"measurementID": measurement_id}
+        )
+
+
+def bulk_update_service_set_network_names(transaction, bssid_to_network_name_map):
+    """
+    Set based counterpart of update_service_set_network_name for a whole {bssid: network name} map.
+    """
+    with cursor_manager(transaction) as c:
+        c.execute("DELETE FROM stagingNetworkName")
+        c.executemany(
+            "INSERT INTO stagingNetworkName(bssid, networkName) VALUES (?, ?)",
+            list(bssid_to_network_name_map.items())
+        )
+        c.execute(
+            """
+            UPDATE serviceSet
+            SET networkName = (SELECT n.networkName FROM stagingNetworkName AS n WHERE n.bssid = serviceSet.bssid)
+            WHERE EXISTS (
+              SELECT 1 FROM stagingNetworkName AS n
+              WHERE n.bssid = serviceSet.bssid AND n.networkName != serviceSet.networkName
+            )
+            """
+        )
+
+
 def select_jitter_measurements_by_measurement_id(connection, measurement_id):
     with cursor_manager(connection) as c:
         c.execute(
@@ -385,6 +711,26 @@ def select_station_by_id(connection, station_id):
         return Station.from_row(c.fetchone())
 
 
+def select_station_ids(connection, limit=None):
+    """
+    [(MAC address, station ID)] of the most recently added stations first.
+    """
+    clause, params = limit_offset_helper(limit, None, order_by="stationID DESC")
+    with cursor_manager(connection) as c:
+        c.execute("SELECT macAddress, stationID FROM station" + clause, params)
+        return [(r["macAddress"], r["stationID"]) for r in c.fetchall()]
+
+
+def select_service_set_ids(connection, limit=None):
+    """
+    [(BSSID, service set ID)] of the most recently added service sets first.
+    """
+    clause, params = limit_offset_helper(limit, None, order_by="serviceSetID DESC")
+    with cursor_manager(connection) as c:
+        c.execute("SELECT bssid, serviceSetID FROM serviceSet" + clause, params)
+        return [(r["bssid"], r["serviceSetID"]) for r in c.fetchall()]
+
+
 def select_station_by_mac_address(connection, mac_address):
     with cursor_manager(connection) as c:
         c.execute("SELECT * FROM station WHERE macAddress = ?", (mac_address,))
@@ -474,3 +820,35 @@ def delete_old_measurements(transaction, days_old):
             [start_time]
         )
         return c.rowcount
+
+
+def delete_orphaned_stations(transaction):
+    """
+    Delete the stations no longer part of any measurement, e.g. after delete_old_measurements.
+    """
+    with cursor_manager(transaction) as c:
+        c.execute(
+            """
+            DELETE FROM station
+            WHERE stationID NOT IN (SELECT mapStationID FROM measurementStationMap)
+            AND stationID NOT IN (SELECT mapStationID FROM infrastructureStationServiceSetMap)
+            AND stationID NOT IN (SELECT associatedStationID FROM associationStationServiceSetMap)
+            """
+        )
+        return c.rowcount
+
+
+def delete_orphaned_service_sets(transaction):
+    """
+    Delete the service sets no longer part of any measurement.
+    """
+    with cursor_manager(transaction) as c:
+        c.execute(
+            """
+            DELETE FROM serviceSet
+            WHERE serviceSetID NOT IN (SELECT mapServiceSetID FROM infrastructureStationServiceSetMap)
+            AND serviceSetID NOT IN (SELECT associatedServiceSetID FROM associationStationServiceSetMap)
+            AND serviceSetID NOT IN (SELECT serviceSetID FROM serviceSetJitterMeasurement)
+            """
+        )
+        return c.rowcount
@@ -15,7 +15,11 @@ CREATE TABLE IF NOT EXISTS measurement(
   averageNoise REAL,
   stdDevNoise REAL,
   hasBeenUploaded BOOLEAN NOT NULL DEFAULT 0,
-  extraJSONData TEXT NOT NULL DEFAULT '{}'
+  extraJSONData TEXT NOT NULL DEFAULT '{}',
+  pcapReceived INTEGER,
+  pcapDropped INTEGER,
+  pcapInterfaceDropped INTEGER,
+  channelSwitchSeconds REAL
 );
 
 CREATE INDEX IF NOT EXISTS measurementNeedsUpload_PARTIAL_IDX ON measurement(measurementStartTime) WHERE hasBeenUploaded = 0;
@@ -92,10 +96,21 @@ CREATE TABLE IF NOT EXISTS measurementStationMap(
   lowestRate INTEGER,
   highestRate INTEGER,
   failedFCSCount INTEGER,
+  powerCount INTEGER,
+  powerSum REAL,
+  powerSumSquares REAL,
   PRIMARY KEY(mapMeasurementID, mapStationID)
 );
 CREATE INDEX IF NOT EXISTS measurementStationMapMeasurement_IDX ON measurementStationMap(mapMeasurementID);
 
+CREATE TABLE IF NOT EXISTS measurementStageTiming(
+  measurementID INTEGER NOT NULL REFERENCES measurement(measurementID) ON DELETE CASCADE,
+  stageName TEXT NOT NULL,
+  wallSeconds REAL NOT NULL,
+  cpuSeconds REAL,
+  PRIMARY KEY(measurementID, stageName)
+);
+
 -- write select for this one and test it
 -- CREATE TABLE IF NOT EXISTS measurementServiceSetMap(
 --   mapMeasurementID INTEGER NOT NULL REFERENCES measurement(measurementID) ON DELETE CASCADE,
@@ -0,0 +1,46 @@
+-- DIALECT: SQLite3
+-- Per connection staging tables for the bulk measurement writes, see queries.core.write_staging_schema.
+
+CREATE TEMP TABLE IF NOT EXISTS stagingStation(
+  macAddress TEXT PRIMARY KEY,
+  stationID INTEGER,
+  extraJSONData TEXT NOT NULL DEFAULT '{}',
+  managementFrameCount INTEGER NOT NULL DEFAULT 0,
+  associationFrameCount INTEGER NOT NULL DEFAULT 0,
+  reassociationFrameCount INTEGER NOT NULL DEFAULT 0,
+  disassociationFrameCount INTEGER NOT NULL DEFAULT 0,
+  controlFrameCount INTEGER NOT NULL DEFAULT 0,
+  rtsFrameCount INTEGER NOT NULL DEFAULT 0,
+  ctsFrameCount INTEGER NOT NULL DEFAULT 0,
+  ackFrameCount INTEGER NOT NULL DEFAULT 0,
+  dataFrameCount INTEGER NOT NULL DEFAULT 0,
+  dataThroughputIn INTEGER NOT NULL DEFAULT 0,
+  dataThroughputOut INTEGER NOT NULL DEFAULT 0,
+  retryFrameCount INTEGER NOT NULL DEFAULT 0,
+  averagePower REAL,
+  stdDevPower REAL,
+  lowestRate INTEGER,
+  highestRate INTEGER,
+  failedFCSCount INTEGER,
+  powerCount INTEGER,
+  powerSum REAL,
+  powerSumSquares REAL
+);
+
+CREATE TEMP TABLE IF NOT EXISTS stagingServiceSet(
+  bssid TEXT PRIMARY KEY,
+  networkName TEXT,
+  extraJSONData TEXT NOT NULL DEFAULT '{}'
+);
+
+CREATE TEMP TABLE IF NOT EXISTS stagingServiceSetStation(
+  bssid TEXT NOT NULL,
+  macAddress TEXT NOT NULL,
+  isInfrastructure BOOLEAN NOT NULL,
+  PRIMARY KEY(bssid, macAddress, isInfrastructure)
+);
+
+CREATE TEMP TABLE IF NOT EXISTS stagingNetworkName(
+  bssid TEXT PRIMARY KEY,
+  networkName TEXT
+);
@@ -0,0 +1,85 @@
+import math
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+STAGE_CHANNEL_SWITCH = "channel_switch"
+STAGE_LIVE_CAPTURE = "live_capture"
+STAGE_OFFLINE_ANALYSIS = "offline_analysis"
+STAGE_DB_WRITE = "db_write"
+STAGE_OPTIMIZE_DB = "optimize_db"
+# Not a stage: the time since the previous capture on the same channel started, without a CPU time.
+SWEEP_LATENCY = "sweep_latency"
+
+SUMMARY_PERCENTILES = (50, 90, 99)
+
+
+class StageTimer(object):
+    """
+    Wall and CPU time of the stages of a single capture, as {stage name: (wall seconds, CPU seconds)}. The CPU time
+    is that of the calling thread, so stages running in other threads or processes at the same time don't count.
+    A stage timed more than once adds up.
+    """
+    def __init__(self, timings=None):
+        self.timings = dict(timings or {})
+
+    @contextmanager
+    def stage(self, name):
+        wall_start, cpu_start = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            wall_seconds, cpu_seconds = self.timings.get(name, (0.0, 0.0))
+            self.timings[name] = (
+                wall_seconds + time.perf_counter() - wall_start, cpu_seconds + time.thread_time() - cpu_start
+            )
+
+    def record(self, name, wall_seconds, cpu_seconds=None):
+        self.timings[name] = (wall_seconds, cpu_seconds)
+
+
+def percentile(sorted_values, percent):
+    """
+    Nearest-rank percentile of an already sorted, non-empty list.
+    """
+    rank = max(1, int(math.ceil(percent / 100.0 * len(sorted_values))))
+    return sorted_values[rank - 1]
+
+
+def summarize(values):
+    sorted_values = sorted(values)
+    summary = {"p{0}".format(percent): percentile(sorted_values, percent) for percent in SUMMARY_PERCENTILES}
+    summary["max"] = sorted_values[-1]
+    return summary
+
+
+class StageTimingSummary(object):
+    """
+    The stage timings of the last window_size captures, summarized as percentiles for the node dashboard. Timings
+    may be recorded from another thread (the pipeline's write stage) than the one summarizing them.
+    """
+    def __init__(self, window_size=200):
+        self.wall_seconds = defaultdict(lambda: deque(maxlen=window_size))
+        self.cpu_seconds = defaultdict(lambda: deque(maxlen=window_size))
+        self.lock = threading.Lock()
+
+    def record(self, timings):
+        with self.lock:
+            for name, (wall_seconds, cpu_seconds) in timings.items():
+                self.wall_seconds[name].append(wall_seconds)
+                if cpu_seconds is not None:
+                    self.cpu_seconds[name].append(cpu_seconds)
+
+    def percentiles(self):
+        """
+        {stage name: {"count": n, "wall": {"p50": .., "p90": .., "p99": .., "max": ..}, "cpu": {...}}}, the CPU
+        summary is left out for timings without CPU times.
+        """
+        summary = {}
+        with self.lock:
+            for name, wall_seconds in self.wall_seconds.items():
+                summary[name] = {"count": len(wall_seconds), "wall": summarize(wall_seconds)}
+                if self.cpu_seconds.get(name):
+                    summary[name]["cpu"] = summarize(self.cpu_seconds[name])
+        return summary
@@ -1,3 +1,4 @@
+import math
 import statistics
 import string
 
@@ -31,3 +32,113 @@ def bytes_to_str(b):
     else:
         result = b
     return result
+
+
+def _none_min(left, right):
+    if left is None:
+        return right
+    elif right is None:
+        return left
+    return min(left, right)
+
+
+def _none_max(left, right):
+    if left is None:
+        return right
+    elif right is None:
+        return left
+    return max(left, right)
+
+
+class RunningStatistics(object):
+    """
+    Count, mean, sum of squared deviations (Welford's M2), minimum and maximum of a stream of values,
+    updated in constant time and memory. Two instances merge exactly with merge.
+
+    The same statistics can be stored as the sufficient statistics (count, sum, sum of squares), see
+    from_sums. The minimum and maximum are None when unknown.
+    """
+    __slots__ = ('count', 'mean', 'm2', 'minimum', 'maximum')
+
+    def __init__(self, count=0, mean=0.0, m2=0.0, minimum=None, maximum=None):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def __repr__(self):
+        return "RunningStatistics(count={0}, mean={1}, m2={2}, minimum={3}, maximum={4})".format(
+            self.count, self.mean, self.m2, self.minimum, self.maximum
+        )
+
+    def __getstate__(self):
+        return self.count, self.mean, self.m2, self.minimum, self.maximum
+
+    def __setstate__(self, state):
+        self.count, self.mean, self.m2, self.minimum, self.maximum = state
+
+    @classmethod
+    def from_sums(cls, count, total, total_squares):
+        if not count:
+            return cls()
+        mean = total / count
+        return cls(count, mean, max(total_squares - total * mean, 0.0))
+
+    @property
+    def total(self):
+        return self.mean * self.count
+
+    @property
+    def total_squares(self):
+        return self.m2 + self.count * self.mean * self.mean
+
+    def push(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+
+    def merge(self, other):
+        """
+        The statistics of both streams combined (Chan et al.'s parallel variant of Welford's algorithm).
+        """
+        if not other.count:
+            return self.copy()
+        elif not self.count:
+            return other.copy()
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        return RunningStatistics(
+            count,
+            self.mean + delta * other.count / count,
+            self.m2 + other.m2 + delta * delta * self.count * other.count / count,
+            _none_min(self.minimum, other.minimum),
+            _none_max(self.maximum, other.maximum)
+        )
+
+    def copy(self):
+        return RunningStatistics(self.count, self.mean, self.m2, self.minimum, self.maximum)
+
+    @property
+    def average(self):
+        """
+        Mean of the values, None if there are none (see altered_mean).
+        """
+        return self.mean if self.count else None
+
+    @property
+    def std_dev(self):
+        """
+        Sample standard deviation of the values, None without values and 0.0 for a single one (see
+        altered_stddev).
+        """
+        if not self.count:
+            return None
+        elif self.count == 1:
+            return 0.0
+        return math.sqrt(max(self.m2, 0.0) / (self.count - 1))
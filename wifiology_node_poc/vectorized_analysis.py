@@ -0,0 +1,411 @@
+import logging
+import math
+from array import array
+from collections import namedtuple
+
+import dpkt
+import numpy as np
+
+from wifiology_node_poc.analysis import CaptureAnalyzer
+from wifiology_node_poc.decoders import DecodeError, Dot11Header, RADIOTAP_HEADER, RADIOTAP_PRESENT_WORD, \
+    RADIOTAP_EXT_BIT, RADIOTAP_FIELD_LAYOUT, RADIOTAP_FLAGS_BIT, RADIOTAP_RATE_BIT, RADIOTAP_SIGNAL_BIT, \
+    RADIOTAP_NOISE_BIT, RADIOTAP_FLAGS_FCS, RADIOTAP_FLAGS_BAD_FCS, DOT11_ONE_ADDRESS_HEADER, \
+    DOT11_TWO_ADDRESS_HEADER, DOT11_THREE_ADDRESS_HEADER_LENGTH, DOT11_FOUR_ADDRESS_HEADER_LENGTH, \
+    CTL_TWO_ADDRESS_SUBTYPES, QOS_CONTROL_LENGTH, HT_CONTROL_LENGTH, DATA_SUBTYPE_QOS, FCS_LENGTH, MGMT_TYPE, \
+    CTL_TYPE, DATA_TYPE, FLAG_TO_DS, FLAG_FROM_DS, FLAG_RETRY, FLAG_ORDER
+from wifiology_node_poc.utils import RunningStatistics
+
+vectorized_analysis_logger = logging.getLogger(__name__)
+
+# Stands in for a missing address, real MAC addresses only use the low 48 bits.
+NO_MAC = (1 << 64) - 1
+
+# Frames collected before they are decoded and aggregated into the station counters.
+DEFAULT_BLOCK_SIZE = 4096
+
+FRAME_DTYPE = np.dtype([
+    ('frame_type', np.uint8),
+    ('subtype', np.uint8),
+    ('flags', np.uint8),
+    ('src', np.uint64),
+    ('dst', np.uint64),
+    ('bssid', np.uint64),
+    ('signal', np.float64),
+    ('rate', np.float64),
+    ('bad_fcs', np.int8),
+    ('payload_length', np.int64)
+])
+
+# Control frames counted against their receiver and against their transmitter.
+CTL_RECEIVER_SUBTYPES = (dpkt.ieee80211.C_CTS, dpkt.ieee80211.C_ACK)
+CTL_TRANSMITTER_SUBTYPES = (
+    dpkt.ieee80211.C_RTS, dpkt.ieee80211.C_BLOCK_ACK, dpkt.ieee80211.C_BLOCK_ACK_REQ, dpkt.ieee80211.C_CF_END
+)
+# Management frames whose body is decoded, one by one, after the rest of their block.
+MGMT_BODY_SUBTYPES = (dpkt.ieee80211.M_BEACON, dpkt.ieee80211.M_PROBE_RESP)
+
+MAC_SHIFTS = np.arange(40, -8, -8, dtype=np.int64)
+
+
+class DecodedFrames(namedtuple('DecodedFrames', [
+        'radiotap_decoded', 'decoded', 'frame_type', 'subtype', 'flags', 'addr1', 'addr2', 'addr3', 'body_offset',
+        'body_length', 'signal', 'noise', 'rate', 'bad_fcs'])):
+    """
+    The radiotap and 802.11 header fields of a block of frames, one array element per frame, as decode_frames
+    reads them. radiotap_decoded and decoded tell which frames parse_radiotap and parse_dot11_header would have
+    decoded without a DecodeError; the other fields are only meaningful for those. Missing addresses are NO_MAC,
+    missing measurements NaN and missing FCS checks -1. body_offset is relative to the start of the frame.
+    """
+    __slots__ = ()
+
+
+def decode_frames(buf, starts, ends):
+    """
+    Decode the radiotap and 802.11 headers of the frames spanning buf[starts[i]:ends[i]] with array operations over
+    the whole of buf, following parse_radiotap and parse_dot11_header field for field.
+    """
+    data = np.frombuffer(buf, dtype=np.uint8)
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    count = len(starts)
+    if not len(data):
+        data = np.zeros(1, dtype=np.uint8)
+    last = len(data) - 1
+
+    # Reads past the end of a frame land in the next frame or are clipped to buf: harmless, as the bounds checks
+    # leave such frames undecoded.
+    def uint8_at(offsets):
+        return data[np.minimum(offsets, last)].astype(np.int64)
+
+    def uint16_at(offsets):
+        return uint8_at(offsets) | (uint8_at(offsets + 1) << 8)
+
+    def uint32_at(offsets):
+        return uint16_at(offsets) | (uint16_at(offsets + 2) << 16)
+
+    def mac_at(offsets):
+        octets = data[np.minimum(offsets[:, np.newaxis] + np.arange(6), last)].astype(np.int64)
+        return (octets << MAC_SHIFTS).sum(axis=1)
+
+    # Radiotap
+    lengths = ends - starts
+    decoded = lengths >= RADIOTAP_HEADER.size
+    decoded &= uint8_at(starts) == 0
+    radiotap_length = uint16_at(starts + 2)
+    decoded &= (radiotap_length >= RADIOTAP_HEADER.size) & (radiotap_length <= lengths)
+    present = uint32_at(starts + 4)
+
+    offset = np.full(count, RADIOTAP_HEADER.size, dtype=np.int64)
+    extended = decoded & ((present & RADIOTAP_EXT_BIT) != 0)
+    while extended.any():
+        truncated = extended & (offset + RADIOTAP_PRESENT_WORD.size > radiotap_length)
+        decoded &= ~truncated
+        extended &= ~truncated
+        word = uint32_at(starts + offset)
+        offset = np.where(extended, offset + RADIOTAP_PRESENT_WORD.size, offset)
+        extended &= (word & RADIOTAP_EXT_BIT) != 0
+
+    fields = {}
+    for bit, (alignment, size) in enumerate(RADIOTAP_FIELD_LAYOUT):
+        has_field = decoded & (((present >> bit) & 1) != 0)
+        aligned = (offset + alignment - 1) & ~(alignment - 1)
+        truncated = has_field & (aligned + size > radiotap_length)
+        decoded &= ~truncated
+        has_field &= ~truncated
+        fields[bit] = has_field, uint8_at(starts + aligned)
+        offset = np.where(has_field, aligned + size, offset)
+    # A later truncated field fails the whole radiotap header.
+    has_flags, radiotap_flags = fields[RADIOTAP_FLAGS_BIT]
+    has_flags &= decoded
+    has_rate, rate = fields[RADIOTAP_RATE_BIT]
+    has_signal, signal = fields[RADIOTAP_SIGNAL_BIT]
+    has_noise, noise = fields[RADIOTAP_NOISE_BIT]
+    rate = np.where(has_rate, rate * 0.5, np.nan)
+    signal = np.where(has_signal, np.where(signal > 127, signal - 256, signal), np.nan)
+    noise = np.where(has_noise, np.where(noise > 127, noise - 256, noise), np.nan)
+    bad_fcs = np.where(has_flags, (radiotap_flags & RADIOTAP_FLAGS_BAD_FCS) != 0, -1).astype(np.int8)
+    radiotap_decoded = decoded.copy()
+
+    # 802.11
+    header_start = starts + radiotap_length
+    frame_end = ends - np.where(has_flags & ((radiotap_flags & RADIOTAP_FLAGS_FCS) != 0), FCS_LENGTH, 0)
+    available = frame_end - header_start
+    decoded &= available >= DOT11_ONE_ADDRESS_HEADER.size
+    frame_control = uint8_at(header_start)
+    frame_type = (frame_control >> 2) & 0x03
+    subtype = frame_control >> 4
+    flags = uint8_at(header_start + 1)
+
+    is_control = frame_type == CTL_TYPE
+    is_data = frame_type == DATA_TYPE
+    three_addresses = (frame_type == MGMT_TYPE) | is_data
+    two_addresses = is_control & np.isin(subtype, tuple(CTL_TWO_ADDRESS_SUBTYPES))
+    decoded &= ~(two_addresses & (available < DOT11_TWO_ADDRESS_HEADER.size))
+    decoded &= is_control | three_addresses
+    decoded &= ~(three_addresses & (available < DOT11_THREE_ADDRESS_HEADER_LENGTH))
+
+    header_length = np.where(
+        is_control,
+        np.where(two_addresses, DOT11_TWO_ADDRESS_HEADER.size, DOT11_ONE_ADDRESS_HEADER.size),
+        DOT11_THREE_ADDRESS_HEADER_LENGTH
+    )
+    four_addresses = is_data & ((flags & (FLAG_TO_DS | FLAG_FROM_DS)) == (FLAG_TO_DS | FLAG_FROM_DS))
+    header_length = np.where(four_addresses, DOT11_FOUR_ADDRESS_HEADER_LENGTH, header_length)
+    qos = is_data & ((subtype & DATA_SUBTYPE_QOS) != 0)
+    header_length += np.where(qos, QOS_CONTROL_LENGTH, 0)
+    header_length += np.where(((frame_type == MGMT_TYPE) | qos) & ((flags & FLAG_ORDER) != 0), HT_CONTROL_LENGTH, 0)
+    decoded &= ~(three_addresses & (header_length > available))
+
+    addr1 = mac_at(header_start + 4).astype(np.uint64)
+    addr2 = np.where(is_control & ~two_addresses, NO_MAC, mac_at(header_start + 10).astype(np.uint64))
+    addr3 = np.where(is_control, NO_MAC, mac_at(header_start + 16).astype(np.uint64))
+    return DecodedFrames(
+        radiotap_decoded, decoded, frame_type.astype(np.uint8), subtype.astype(np.uint8), flags.astype(np.uint8),
+        addr1, addr2, addr3, radiotap_length + header_length, available - header_length, signal, noise, rate,
+        bad_fcs
+    )
+
+
+def grouped_statistics(group_index, values, group_count):
+    """
+    RunningStatistics of values for each of group_count groups, group_index giving the group of each value.
+    """
+    counts = np.bincount(group_index, minlength=group_count)
+    sums = np.bincount(group_index, weights=values, minlength=group_count)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts
+    m2s = np.bincount(group_index, weights=(values - means[group_index]) ** 2, minlength=group_count)
+    minimums = np.full(group_count, np.nan)
+    maximums = np.full(group_count, np.nan)
+    if len(values):
+        order = np.argsort(group_index, kind='stable')
+        sorted_index = group_index[order]
+        starts = np.flatnonzero(np.concatenate(([True], sorted_index[1:] != sorted_index[:-1])))
+        groups = sorted_index[starts]
+        minimums[groups] = np.minimum.reduceat(values[order], starts)
+        maximums[groups] = np.maximum.reduceat(values[order], starts)
+    return [
+        RunningStatistics(count, mean, m2, minimum, maximum) if count else RunningStatistics()
+        for count, mean, m2, minimum, maximum in zip(
+            counts.tolist(), means.tolist(), m2s.tolist(), minimums.tolist(), maximums.tolist()
+        )
+    ]
+
+
+class VectorizedCaptureAnalyzer(CaptureAnalyzer):
+    """
+    CaptureAnalyzer that only copies each frame into a block as it comes in. Every time block_size frames were
+    collected, and when partial or results are called, the headers of the whole block are decoded with
+    decode_frames and the station counters and service set memberships are updated from them with vectorized
+    group-bys, so memory doesn't grow with the number of frames. Only the bodies of beacons and probe responses
+    are still decoded frame by frame.
+    """
+    def __init__(self, channel, beacon_cache=None, keep_samples=False, block_size=DEFAULT_BLOCK_SIZE):
+        if keep_samples:
+            raise ValueError("The vectorized analyzer does not keep raw samples.")
+        if block_size < 1:
+            raise ValueError("The frame block size must be at least 1.")
+        super(VectorizedCaptureAnalyzer, self).__init__(channel, beacon_cache=beacon_cache)
+        self.block_size = block_size
+        self._new_block()
+
+    def _new_block(self):
+        self.block = bytearray()
+        self.frame_ends = array('q')
+        # How much of each frame a header only capture left out, see CaptureAnalyzer.process_frame.
+        self.uncaptured_lengths = array('q')
+
+    def process_frame(self, header, payload):
+        self.frame_count += 1
+        block = self.block
+        block += payload
+        self.frame_ends.append(len(block))
+        self.uncaptured_lengths.append(0 if header is None else header.getlen() - header.getcaplen())
+        if len(self.frame_ends) == self.block_size:
+            self.flush()
+
+    def _decode_block(self, block, frame_ends, uncaptured_lengths):
+        ends = np.frombuffer(frame_ends, dtype=np.int64)
+        starts = np.concatenate(([0], ends[:-1]))
+        frames = decode_frames(block, starts, ends)
+        self.noise_measurements.extend(frames.noise[frames.radiotap_decoded & ~np.isnan(frames.noise)].tolist())
+
+        decoded = frames.decoded
+        frame_type = frames.frame_type[decoded]
+        flags = frames.flags[decoded]
+        addr1, addr2, addr3 = frames.addr1[decoded], frames.addr2[decoded], frames.addr3[decoded]
+        is_data = frame_type == DATA_TYPE
+        ds_bits = np.where(is_data, flags & (FLAG_TO_DS | FLAG_FROM_DS), 0)
+        rows = np.empty(len(frame_type), dtype=FRAME_DTYPE)
+        rows['frame_type'] = frame_type
+        rows['subtype'] = frames.subtype[decoded]
+        rows['flags'] = flags
+        # See Dot11Header.data_addresses, other frames are counted by (addr2, addr1, addr3).
+        rows['src'] = np.where(ds_bits == FLAG_FROM_DS, addr3, addr2)
+        rows['dst'] = np.where(ds_bits == FLAG_TO_DS, addr3, addr1)
+        rows['bssid'] = np.select(
+            [ds_bits == FLAG_TO_DS, ds_bits == FLAG_FROM_DS, ds_bits == FLAG_TO_DS | FLAG_FROM_DS],
+            [addr1, addr2, np.full(len(addr3), NO_MAC, dtype=np.uint64)], addr3
+        )
+        rows['signal'] = frames.signal[decoded]
+        rows['rate'] = frames.rate[decoded]
+        rows['bad_fcs'] = frames.bad_fcs[decoded]
+        rows['payload_length'] = np.where(
+            is_data, frames.body_length[decoded] + np.frombuffer(uncaptured_lengths, dtype=np.int64)[decoded], 0
+        )
+
+        failed_count = len(ends) - len(rows)
+        with_body = np.flatnonzero((frame_type == MGMT_TYPE) & np.isin(rows['subtype'], MGMT_BODY_SUBTYPES))
+        if len(with_body):
+            frame_indexes = np.flatnonzero(decoded)[with_body]
+            headers = zip(*[field[frame_indexes].tolist() for field in (
+                frames.frame_type, frames.subtype, frames.flags, frames.addr1, frames.addr2, frames.addr3,
+                frames.body_offset, frames.body_length
+            )])
+            signals = [None if math.isnan(signal) else int(signal) for signal in rows['signal'][with_body].tolist()]
+            for row_index, start, end, header, signal in zip(
+                    with_body.tolist(), starts[frame_indexes].tolist(), ends[frame_indexes].tolist(), headers, signals):
+                frame = Dot11Header(*header)
+                try:
+                    if frame.subtype == dpkt.ieee80211.M_BEACON:
+                        self._process_beacon(frame, block[start:end], signal)
+                    else:
+                        self._process_probe_response(frame, block[start:end])
+                except DecodeError:
+                    vectorized_analysis_logger.debug("Failed to decode a beacon or probe response.", exc_info=True)
+                    failed_count += 1
+                    # CaptureAnalyzer has only counted the management frame when its body fails to decode, so keep
+                    # just that much of the row.
+                    row = rows[row_index]
+                    row['flags'] = 0
+                    row['signal'] = row['rate'] = np.nan
+                    row['bad_fcs'] = -1
+        if failed_count:
+            vectorized_analysis_logger.warning("Failed to decode {0} frame(s).".format(failed_count))
+            self.weird_frame_count += failed_count
+        self._aggregate(rows)
+
+    def _aggregate(self, frames):
+        frame_type = frames['frame_type']
+        subtype = frames['subtype']
+        flags = frames['flags']
+        is_management = frame_type == MGMT_TYPE
+        is_data = frame_type == DATA_TYPE
+        is_control = frame_type == CTL_TYPE
+        to_receiver = is_control & np.isin(subtype, CTL_RECEIVER_SUBTYPES)
+        to_transmitter = is_control & np.isin(subtype, CTL_TRANSMITTER_SUBTYPES)
+        counted = is_management | is_data | to_receiver | to_transmitter
+
+        self.action_counter += int(np.count_nonzero(is_management & (subtype == dpkt.ieee80211.M_ACTION)))
+        self.probe_req_counter += int(np.count_nonzero(is_management & (subtype == dpkt.ieee80211.M_PROBE_REQ)))
+
+        # Every counted frame belongs to one station, data frames also add to their destination's counters.
+        frames = frames[counted]
+        station = np.where(to_receiver[counted], frames['dst'], frames['src'])
+        is_data = is_data[counted]
+        macs, inverse = np.unique(np.concatenate((station, frames['dst'][is_data])), return_inverse=True)
+        station_count = len(macs)
+        index = inverse[:len(frames)]
+        destination_index = inverse[len(frames):]
+
+        def count(mask):
+            return np.bincount(index[mask], minlength=station_count).tolist()
+
+        frame_type = frames['frame_type']
+        subtype = frames['subtype']
+        flags = frames['flags']
+        is_management = frame_type == MGMT_TYPE
+        is_control = frame_type == CTL_TYPE
+        to_transmitter = to_transmitter[counted]
+        with_extras = is_management | is_data | to_transmitter
+        payload_length = frames['payload_length'].astype(np.float64)
+
+        management_frame_counts = count(is_management)
+        association_frame_counts = count(is_management & np.isin(
+            subtype, (dpkt.ieee80211.M_ASSOC_REQ, dpkt.ieee80211.M_ASSOC_RESP)
+        ))
+        reassociation_frame_counts = count(is_management & np.isin(
+            subtype, (dpkt.ieee80211.M_REASSOC_REQ, dpkt.ieee80211.M_REASSOC_RESP)
+        ))
+        disassociation_frame_counts = count(is_management & (subtype == dpkt.ieee80211.M_DISASSOC))
+        control_frame_counts = count(to_transmitter)
+        # Kept as the object analyzer counts them: RTS frames as CTS counts and vice versa.
+        cts_frame_counts = count(is_control & (subtype == dpkt.ieee80211.C_RTS))
+        rts_frame_counts = count(is_control & (subtype == dpkt.ieee80211.C_CTS))
+        ack_frame_counts = count(is_control & (subtype == dpkt.ieee80211.C_ACK))
+        data_frame_counts = count(is_data)
+        retry_frame_counts = count((flags & FLAG_RETRY) != 0)
+        failed_fcs_counts = count(with_extras & (frames['bad_fcs'] == 1))
+        throughput_out = np.bincount(
+            index[is_data], weights=payload_length[is_data], minlength=station_count
+        ).astype(np.int64).tolist()
+        throughput_in = np.bincount(
+            destination_index, weights=payload_length[is_data], minlength=station_count
+        ).astype(np.int64).tolist()
+
+        signal = frames['signal']
+        has_power = with_extras & ~np.isnan(signal)
+        power_statistics = grouped_statistics(index[has_power], signal[has_power], station_count)
+        rate = frames['rate']
+        has_rate = with_extras & ~np.isnan(rate)
+        rate_statistics = grouped_statistics(index[has_rate], rate[has_rate], station_count)
+
+        for i, mac in enumerate(macs.tolist()):
+            counters = self.station_counters[mac]
+            counters.management_frame_count += management_frame_counts[i]
+            counters.association_frame_count += association_frame_counts[i]
+            counters.reassociation_frame_count += reassociation_frame_counts[i]
+            counters.disassociation_frame_count += disassociation_frame_counts[i]
+            counters.control_frame_count += control_frame_counts[i]
+            counters.rts_frame_count += rts_frame_counts[i]
+            counters.cts_frame_count += cts_frame_counts[i]
+            counters.ack_frame_count += ack_frame_counts[i]
+            counters.data_frame_count += data_frame_counts[i]
+            counters.data_throughput_in += throughput_in[i]
+            counters.data_throughput_out += throughput_out[i]
+            counters.retry_frame_count += retry_frame_counts[i]
+            counters.failed_fcs_count += failed_fcs_counts[i]
+            counters.power_statistics = counters.power_statistics.merge(power_statistics[i])
+            counters.rate_statistics = counters.rate_statistics.merge(rate_statistics[i])
+
+        bssid = frames['bssid']
+        with_bssid = is_data & (bssid != NO_MAC)
+        to_ds = with_bssid & ((flags & FLAG_TO_DS) != 0)
+        from_ds = with_bssid & ~to_ds & ((flags & FLAG_FROM_DS) != 0)
+        self._add_memberships(
+            self.bssid_infra_macs,
+            np.concatenate((bssid[to_ds], bssid[from_ds])),
+            np.concatenate((frames['dst'][to_ds], frames['src'][from_ds]))
+        )
+        self._add_memberships(
+            self.bssid_associated_macs,
+            np.concatenate((bssid[to_ds], bssid[from_ds])),
+            np.concatenate((frames['src'][to_ds], frames['dst'][from_ds]))
+        )
+
+    @staticmethod
+    def _add_memberships(bssid_macs, bssids, macs):
+        if not len(bssids):
+            return
+        for bssid, mac in np.unique(np.stack((bssids, macs), axis=1), axis=0).tolist():
+            bssid_macs[bssid].add(mac)
+
+    def flush(self):
+        """
+        Decode the frames collected so far and aggregate them into the station counters and service set
+        memberships.
+        """
+        if self.frame_ends:
+            block, frame_ends, uncaptured_lengths = self.block, self.frame_ends, self.uncaptured_lengths
+            self._new_block()
+            self._decode_block(block, frame_ends, uncaptured_lengths)
+
+    def partial(self):
+        self.flush()
+        return super(VectorizedCaptureAnalyzer, self).partial()
+
+    def results(self, start_time, end_time, sample_seconds, capture_stats=None):
+        self.flush()
+        return super(VectorizedCaptureAnalyzer, self).results(
+            start_time, end_time, sample_seconds, capture_stats=capture_stats
+        )
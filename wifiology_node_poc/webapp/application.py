@@ -4,7 +4,7 @@ import datetime
 from manuf import manuf
 
 from wifiology_node_poc.procedures import setup_logging
-from wifiology_node_poc.core_sqlite import create_connection
+from wifiology_node_poc.core_sqlite import create_connection, CONNECTION_PROFILES
 from wifiology_node_poc.queries.core import write_schema
 from wifiology_node_poc.webapp import VIEWS_DIR
 from wifiology_node_poc.webapp.views import NodeViews
@@ -16,13 +16,18 @@ webapp_argument_parser.add_argument(
 )
 webapp_argument_parser.add_argument("-l", "--log-file", type=str, default="-", help="Log file.")
 webapp_argument_parser.add_argument("-v", "--verbose", action="store_true", help="Verbose mode.")
+webapp_argument_parser.add_argument(
+    "--db-profile", type=str, choices=sorted(CONNECTION_PROFILES), default="reader",
+    help="The SQLite connection profile (journal mode, synchronous, cache and mmap sizes) to use."
+)
 
 
 def webapp_argparse_args_to_kwargs(args):
     return {
         'database_loc': args.database_loc,
         'log_file': args.log_file,
-        'verbose': args.verbose
+        'verbose': args.verbose,
+        'db_profile': args.db_profile
     }
 
 
@@ -39,7 +44,7 @@ def webserver_info_hof():
     return webserver_info_generator
 
 
-def create_webapp(database_loc, log_file="-", verbose=False):
+def create_webapp(database_loc, log_file="-", verbose=False, db_profile="reader"):
     setup_logging(log_file, verbose)
 
     parser = manuf.MacParser(update=True)
@@ -55,7 +60,7 @@ def create_webapp(database_loc, log_file="-", verbose=False):
             return "Vendor: {0} ({1})".format(info.manuf, info.comment)
 
     app = bottle.Bottle()
-    db_conn = create_connection(database_loc)
+    db_conn = create_connection(database_loc, profile=db_profile)
     write_schema(db_conn)
     views = NodeViews(
         app,
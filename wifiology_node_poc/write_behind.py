@@ -0,0 +1,246 @@
+import logging
+import os
+import pickle
+import threading
+import time
+from collections import deque
+
+from wifiology_node_poc.core_sqlite import create_connection, transaction_wrapper
+from wifiology_node_poc.queries.kv import kv_store_get, kv_store_set
+from wifiology_node_poc.stage_timing import summarize
+
+write_behind_logger = logging.getLogger(__name__)
+
+JOURNAL_FILE_SUFFIX = ".pickle"
+
+
+class PendingWrite(object):
+    __slots__ = ("sequence", "data", "journal_file", "submit_time")
+
+    def __init__(self, sequence, data, journal_file, submit_time):
+        self.sequence = sequence
+        self.data = data
+        self.journal_file = journal_file
+        self.submit_time = submit_time
+
+
+class WriteBehindWriter(object):
+    """
+    Writes analysis data from its own thread and database connection, so that a lock held by the upload or
+    janitor scripts stalls the writer instead of the capture loop. Whatever is waiting when the writer gets to it
+    is written in batches of up to max_batch_size captures per transaction, in submission order.
+
+    Without a journal_dir at most queue_size captures wait in memory and submit blocks (calling heartbeat_func)
+    while the writer catches up. With a journal_dir every capture is first written to a journal file there and
+    submit never blocks; only the oldest queue_size pending captures are kept in memory, the others are read back
+    from their journal file when their turn comes. A journal file is removed once its capture is committed, and
+    the sequence number of the last committed capture is stored in the same transaction under sequence_key, so
+    that after a crash or a restart by the watchdog the journal is replayed in order and nothing is written twice.
+
+    The capture loop's own kv values go through set_kv, so that it doesn't take the write lock for them either.
+
+    write_batch_func(db_conn, batch, transaction_hook) must write the whole batch in one transaction and call
+    transaction_hook(transaction) before committing it.
+    """
+    def __init__(self, database_loc, write_batch_func, db_timeout_seconds=None, db_profile="writer", queue_size=8,
+                 max_batch_size=4, journal_dir=None, sequence_key="capture/write_behind_sequence",
+                 heartbeat_func=lambda: None, put_timeout_seconds=1, latency_window_size=200):
+        if queue_size < 1 or max_batch_size < 1:
+            raise ValueError("The write queue and batch sizes must be at least 1.")
+        if journal_dir is not None and database_loc == ":memory:":
+            raise ValueError("A write-behind journal requires an on-disk database.")
+        self.database_loc = database_loc
+        self.write_batch_func = write_batch_func
+        self.db_timeout_seconds = db_timeout_seconds
+        self.db_profile = db_profile
+        self.queue_size = queue_size
+        self.max_batch_size = max_batch_size
+        self.journal_dir = journal_dir
+        self.sequence_key = sequence_key
+        self.heartbeat_func = heartbeat_func
+        self.put_timeout_seconds = put_timeout_seconds
+
+        self.pending = deque()
+        self.pending_kv = {}
+        self.condition = threading.Condition()
+        self.closing = False
+        self.next_sequence = 0
+        self.writer_thread = None
+        self.writer_exception = None
+        self.db_conn = None
+        self.written_count = 0
+        self.batch_count = 0
+        self.batch_seconds = deque(maxlen=latency_window_size)
+        self.commit_latency_seconds = deque(maxlen=latency_window_size)
+
+    def journal_file(self, sequence):
+        return os.path.join(self.journal_dir, "{0:012d}{1}".format(sequence, JOURNAL_FILE_SUFFIX))
+
+    def recover_journal(self, db_conn):
+        """
+        Queue the journal files left behind by a previous run, skipping (and removing) those of captures that were
+        committed before it stopped.
+        """
+        committed_sequence = kv_store_get(db_conn, self.sequence_key, -1)
+        self.next_sequence = committed_sequence + 1
+        sequences = sorted(
+            int(file_name[:-len(JOURNAL_FILE_SUFFIX)]) for file_name in os.listdir(self.journal_dir)
+            if file_name.endswith(JOURNAL_FILE_SUFFIX)
+        )
+        for sequence in sequences:
+            if sequence <= committed_sequence:
+                os.remove(self.journal_file(sequence))
+            else:
+                self.pending.append(PendingWrite(sequence, None, self.journal_file(sequence), time.time()))
+                self.next_sequence = sequence + 1
+        if self.pending:
+            write_behind_logger.warning(
+                "Replaying {0} journaled capture(s) left by a previous run.".format(len(self.pending))
+            )
+
+    def start(self):
+        if self.journal_dir is not None:
+            os.makedirs(self.journal_dir, exist_ok=True)
+            db_conn = create_connection(self.database_loc, timeout=self.db_timeout_seconds, profile=self.db_profile)
+            try:
+                self.recover_journal(db_conn)
+            finally:
+                db_conn.close()
+        self.writer_thread = threading.Thread(target=self._write_stage, name="write-behind-writer", daemon=True)
+        self.writer_thread.start()
+        return self
+
+    def check(self):
+        if self.writer_exception is not None:
+            raise RuntimeError("Write-behind writer failed.") from self.writer_exception
+        if not self.writer_thread.is_alive():
+            raise RuntimeError("Write-behind writer is not running.")
+
+    def _write_journal_file(self, sequence, analysis_data):
+        journal_file = self.journal_file(sequence)
+        tmp_file = journal_file + ".tmp"
+        with open(tmp_file, "wb") as f:
+            pickle.dump(analysis_data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, journal_file)
+        return journal_file
+
+    def submit(self, analysis_data):
+        """
+        Queue a capture's analysis data for writing. Without a journal, blocks while queue_size captures are
+        already waiting.
+        """
+        self.check()
+        if self.journal_dir is not None:
+            # Captures are submitted from a single thread, so the sequence can be taken outside of the lock.
+            sequence = self.next_sequence
+            self.next_sequence += 1
+            journal_file = self._write_journal_file(sequence, analysis_data)
+            with self.condition:
+                in_memory = sum(1 for pending_write in self.pending if pending_write.data is not None)
+                self.pending.append(PendingWrite(
+                    sequence, analysis_data if in_memory < self.queue_size else None, journal_file, time.time()
+                ))
+                self.condition.notify_all()
+            return
+        with self.condition:
+            while len(self.pending) >= self.queue_size:
+                self.condition.wait(self.put_timeout_seconds)
+                if len(self.pending) >= self.queue_size:
+                    self.check()
+                    self.heartbeat_func()
+            self.pending.append(PendingWrite(self.next_sequence, analysis_data, None, time.time()))
+            self.next_sequence += 1
+            self.condition.notify_all()
+
+    def set_kv(self, kv_values):
+        """
+        Store kv_values ({key: value}) in the kv store with the next batch, or on their own if no capture is
+        waiting. Never blocks; a value not written yet is replaced by a later one for the same key.
+        """
+        self.check()
+        with self.condition:
+            self.pending_kv.update(kv_values)
+            self.condition.notify_all()
+
+    def _next_batch(self):
+        with self.condition:
+            while not self.pending and not self.pending_kv and not self.closing:
+                self.condition.wait()
+            kv_values, self.pending_kv = self.pending_kv, {}
+            # Left in pending until committed, so that queue depth and backpressure count them.
+            return list(self.pending)[:self.max_batch_size], kv_values
+
+    def _write_stage(self):
+        self.db_conn = create_connection(self.database_loc, timeout=self.db_timeout_seconds, profile=self.db_profile)
+        try:
+            while True:
+                batch, kv_values = self._next_batch()
+                if not batch:
+                    if not kv_values:
+                        return
+                    with transaction_wrapper(self.db_conn) as t:
+                        for key, value in kv_values.items():
+                            kv_store_set(t, key, value)
+                    continue
+                for pending_write in batch:
+                    if pending_write.data is None:
+                        with open(pending_write.journal_file, "rb") as f:
+                            pending_write.data = pickle.load(f)
+
+                def transaction_hook(transaction, sequence=batch[-1].sequence, kv_values=kv_values):
+                    for key, value in kv_values.items():
+                        kv_store_set(transaction, key, value)
+                    if self.journal_dir is not None:
+                        kv_store_set(transaction, self.sequence_key, sequence)
+                start = time.perf_counter()
+                self.write_batch_func(self.db_conn, [pending_write.data for pending_write in batch], transaction_hook)
+                commit_time = time.time()
+                self.batch_seconds.append(time.perf_counter() - start)
+                for pending_write in batch:
+                    if pending_write.journal_file is not None:
+                        os.remove(pending_write.journal_file)
+                    self.commit_latency_seconds.append(commit_time - pending_write.submit_time)
+                with self.condition:
+                    for _ in batch:
+                        self.pending.popleft()
+                    self.condition.notify_all()
+                self.written_count += len(batch)
+                self.batch_count += 1
+        except BaseException as e:
+            write_behind_logger.exception("Unhandled exception in the write-behind writer!")
+            self.writer_exception = e
+        finally:
+            self.db_conn.close()
+
+    def stats(self):
+        with self.condition:
+            queue_depth = len(self.pending)
+            journaled_only = sum(1 for pending_write in self.pending if pending_write.data is None)
+        stats = {
+            "queue_depth": queue_depth,
+            "journaled_only": journaled_only,
+            "written": self.written_count,
+            "batches": self.batch_count
+        }
+        if self.batch_seconds:
+            stats["batch_seconds"] = summarize(list(self.batch_seconds))
+        if self.commit_latency_seconds:
+            stats["commit_latency_seconds"] = summarize(list(self.commit_latency_seconds))
+        if self.db_conn is not None:
+            stats["db_lock_wait"] = self.db_conn.lock_wait_stats()
+        return stats
+
+    def close(self):
+        """
+        Write everything submitted so far before returning.
+        """
+        with self.condition:
+            self.closing = True
+            self.condition.notify_all()
+        while self.writer_thread.is_alive():
+            self.heartbeat_func()
+            self.writer_thread.join(self.put_timeout_seconds)
+        if self.writer_exception is not None:
+            raise RuntimeError("Write-behind writer failed.") from self.writer_exception